@@ -0,0 +1,137 @@
+import numpy as np
+import threading
+import time
+from include.AudioFrontend import AudioFrontend, WHISPER_RATE
+from include.Metrics import METRICS
+
+BUFFER_SECONDS = 30
+POLL_SECONDS = 0.5
+
+class AudioCapture:
+    '''
+    Long-lived capture from an AudioSource (see include/AudioSource.py). The source is opened
+    once at its native sample rate and channel count, and every chunk it delivers is converted
+    to 16-bit mono at rate (see AudioFrontend) into a preallocated int16 ring buffer, so audio
+    keeps being recorded while the recognizers are busy decoding.
+
+    Readers keep their own cursor, an absolute frame position since the capture started,
+    and pull windows with read(). Frames that were overwritten before a reader got to them
+    are counted as dropped. Sources that are not real time (files) are instead held back
+    until the reader has caught up.
+
+    Listeners added with add_listener(callback) get every converted chunk as
+    callback(samples, position) in the capture thread, before readers can see it, e.g. to
+    compute features while recording.
+    '''
+    def __init__(self, logger, source, chunk, rate=WHISPER_RATE, buffer_seconds=BUFFER_SECONDS) -> None:
+        self.__logger = logger
+        self.__source = source
+        self.rate = rate
+        self.channels = 1
+        self.chunk = chunk
+        self.__frontend = None
+        self.__capacity = int(rate * buffer_seconds)
+        self.__buffer = np.zeros((self.__capacity, self.channels), dtype=np.int16)
+        self.__position = 0
+        self.__read_position = 0
+        self.__running = False
+        self.__condition = threading.Condition()
+        self.__listeners = []
+        self.overflows = 0
+        self.dropped_frames = 0
+
+    @property
+    def position(self) -> int:
+        '''
+        Returns the number of frames captured since start().
+        '''
+        return self.__position
+
+    @property
+    def realtime(self) -> bool:
+        return self.__source.realtime
+
+    @property
+    def finite(self) -> bool:
+        return self.__source.finite
+
+    def add_listener(self, callback) -> None:
+        self.__listeners.append(callback)
+
+    def start(self) -> None:
+        self.__source.open()
+        self.__frontend = AudioFrontend(self.__source.rate, self.__source.channels, self.rate)
+        with self.__condition:
+            self.__read_position = self.__position
+            self.__running = True
+        self.__source.start(self.__callback, int(self.chunk * self.__source.rate / self.rate))
+        self.__logger.info("Capturing from %s at %d Hz, %d channel(s), converted to %d Hz mono",
+                           self.__source.name, self.__source.rate, self.__source.channels, self.rate)
+
+    def stop(self) -> None:
+        with self.__condition:
+            self.__running = False
+            self.__condition.notify_all()
+        self.__source.close()
+
+    def is_active(self) -> bool:
+        return self.__running and self.__source.is_active()
+
+    def __callback(self, in_data, overflow) -> None:
+        if overflow:
+            self.overflows += 1
+            METRICS.counter("mcms_capture_overflows_total").inc()
+        samples = self.__frontend.process(in_data)
+        self.__write(samples.reshape(-1, 1))
+
+    def __write(self, samples) -> None:
+        count = len(samples)
+        for listener in self.__listeners:
+            listener(samples, self.__position)
+        with self.__condition:
+            if not self.__source.realtime:
+                # Keep half of the buffer as history for overlapping reads
+                while self.__running and self.__position + count - self.__read_position > self.__capacity // 2:
+                    self.__condition.wait()
+            start = self.__position % self.__capacity
+            first = min(count, self.__capacity - start)
+            self.__buffer[start:start + first] = samples[:first]
+            self.__buffer[:count - first] = samples[first:]
+            self.__position += count
+            self.__condition.notify_all()
+
+    def read(self, cursor, frames, out, timeout=None) -> int:
+        '''
+        Blocks until the frames [cursor, cursor + frames) are captured and copies them into out,
+        an int16 array of shape (frames, channels). Returns the cursor for the next read.
+        If the reader fell behind by more than the buffer length, the oldest frames still
+        available are returned instead and the gap is counted in dropped_frames.
+        '''
+        deadline = None if timeout is None else time.monotonic() + timeout
+        start_time = time.perf_counter()
+        with self.__condition:
+            while self.__position < cursor + frames:
+                # Poll so that a source which ended on its own is noticed
+                if not self.is_active():
+                    raise EOFError(f"Audio capture from {self.__source.name} is not running")
+                remaining = POLL_SECONDS if deadline is None else min(POLL_SECONDS, deadline - time.monotonic())
+                if remaining <= 0:
+                    raise TimeoutError("No audio captured within %s seconds" % timeout)
+                self.__condition.wait(remaining)
+            METRICS.observe_stage("capture", time.perf_counter() - start_time)
+
+            oldest = self.__position - self.__capacity
+            if cursor < oldest:
+                self.dropped_frames += oldest - cursor
+                METRICS.counter("mcms_dropped_frames_total").inc(oldest - cursor)
+                self.__logger.warning("Reader fell behind, dropped %d frames (total dropped %d, overflows %d)",
+                                      oldest - cursor, self.dropped_frames, self.overflows)
+                cursor = oldest
+
+            start = cursor % self.__capacity
+            first = min(frames, self.__capacity - start)
+            out[:first] = self.__buffer[start:start + first]
+            out[first:frames] = self.__buffer[:frames - first]
+            self.__read_position = max(self.__read_position, cursor + frames)
+            self.__condition.notify_all()
+        return cursor + frames
@@ -0,0 +1,93 @@
+import numpy as np
+import wave
+
+WHISPER_RATE = 16000
+PCM16_SCALE = 1.0 / 32768.0
+FIR_TAPS = 31
+
+
+def pcm16_to_float32(pcm, channels=1, rate=WHISPER_RATE) -> np.ndarray:
+    '''
+    Converts interleaved int16 PCM (bytes or an int16 array) to the float32 mono 16 kHz
+    array that whisper.transcribe() accepts directly, without a file or ffmpeg.
+    '''
+    samples = np.frombuffer(pcm, dtype=np.int16) if isinstance(pcm, (bytes, bytearray)) else pcm.reshape(-1)
+    if channels > 1:
+        # Downmix and convert in one pass
+        audio = samples.reshape(-1, channels).mean(axis=1, dtype=np.float32)
+        audio *= PCM16_SCALE
+    else:
+        audio = np.multiply(samples, PCM16_SCALE, dtype=np.float32)
+
+    if rate != WHISPER_RATE:
+        positions = np.arange(0, len(audio) * WHISPER_RATE // rate, dtype=np.float64) * (rate / WHISPER_RATE)
+        audio = np.interp(positions, np.arange(len(audio)), audio).astype(np.float32)
+    return audio
+
+
+def lowpass_filter(cutoff, taps=FIR_TAPS) -> np.ndarray:
+    '''
+    Returns a Hamming-windowed sinc low-pass FIR, cutoff given as a fraction of the sample rate.
+    '''
+    n = np.arange(taps) - (taps - 1) / 2
+    fir = 2 * cutoff * np.sinc(2 * cutoff * n) * np.hamming(taps)
+    return (fir / fir.sum()).astype(np.float32)
+
+
+class AudioFrontend:
+    '''
+    Streaming conversion of the device's native format to 16-bit mono at the recognizer rate.
+    Each chunk is downmixed, low-pass filtered when downsampling and linearly resampled in a few
+    vectorized NumPy operations. Filter history and resampling phase carry over between chunks,
+    so the output is continuous across chunk boundaries.
+    '''
+    def __init__(self, source_rate, source_channels, target_rate=WHISPER_RATE, taps=FIR_TAPS) -> None:
+        self.source_rate = source_rate
+        self.source_channels = source_channels
+        self.target_rate = target_rate
+        self.__step = source_rate / target_rate
+        self.__fir = None
+        if source_rate > target_rate:
+            self.__fir = lowpass_filter(0.45 * target_rate / source_rate, taps)
+            self.__history = np.zeros(taps - 1, dtype=np.float32)
+        # Position of the next output sample, relative to the first sample of the next chunk
+        self.__phase = 0.0
+        self.__last = np.float32(0.0)
+
+    def process(self, pcm) -> np.ndarray:
+        '''
+        Converts one chunk of interleaved int16 PCM and returns the int16 mono samples at target_rate.
+        '''
+        samples = np.frombuffer(pcm, dtype=np.int16).reshape(-1, self.source_channels)
+        if self.source_rate == self.target_rate:
+            if self.source_channels == 1:
+                return samples[:, 0]
+            return samples.mean(axis=1, dtype=np.float32).astype(np.int16)
+
+        mono = samples.mean(axis=1, dtype=np.float32)
+        if self.__fir is not None:
+            padded = np.concatenate((self.__history, mono))
+            self.__history = padded[len(padded) - len(self.__history):]
+            mono = np.convolve(padded, self.__fir, mode='valid')
+
+        count = len(mono)
+        if count == 0:
+            return np.empty(0, dtype=np.int16)
+        outputs = int(np.floor((count - 1 - self.__phase) / self.__step)) + 1 if self.__phase <= count - 1 else 0
+        positions = self.__phase + self.__step * np.arange(outputs)
+        # Index -1 is the last sample of the previous chunk
+        resampled = np.interp(positions, np.arange(-1, count), np.concatenate(([self.__last], mono)))
+        self.__phase += outputs * self.__step - count
+        self.__last = mono[-1]
+        return np.clip(np.rint(resampled), -32768, 32767).astype(np.int16)
+
+
+def load_wav(path, rate=WHISPER_RATE) -> np.ndarray:
+    '''
+    Reads a 16-bit PCM WAV file of any rate and channel count as int16 mono samples at rate.
+    '''
+    with wave.open(path, 'rb') as wavFile:
+        if wavFile.getsampwidth() != 2:
+            raise ValueError(f"{path}: only 16-bit PCM is supported")
+        frontend = AudioFrontend(wavFile.getframerate(), wavFile.getnchannels(), rate)
+        return frontend.process(wavFile.readframes(wavFile.getnframes()))
@@ -0,0 +1,314 @@
+import pyaudio
+import os
+import socket
+import stat
+import sys
+import threading
+import time
+import wave
+
+MAX_DEVICE_CHANNELS = 2
+RECONNECT_SECONDS = 1.0
+
+class AudioSource:
+    '''
+    Interface of everything the controllers can listen to. open() determines the native
+    rate and channel count, start() delivers interleaved int16 chunks to
+    callback(data, overflow) from the source's own thread until close().
+
+    realtime is False for sources that can be read faster than real time (files); the
+    capture then applies back-pressure instead of overwriting unread audio. finite is True
+    for sources whose end is the end of the input (files, stdin), the controllers then stop
+    instead of restarting the capture.
+    '''
+    realtime = True
+    finite = False
+
+    def __init__(self, logger) -> None:
+        self._logger = logger
+        self.rate = None
+        self.channels = None
+        self.name = self.__class__.__name__
+
+    def open(self) -> None:
+        raise NotImplementedError
+
+    def start(self, callback, frames_per_chunk) -> None:
+        raise NotImplementedError
+
+    def close(self) -> None:
+        raise NotImplementedError
+
+    def is_active(self) -> bool:
+        raise NotImplementedError
+
+
+def find_input_device(audio, device):
+    '''
+    Returns the PyAudio device info of an input device given by index, by its name, or the
+    default input device for None. A name is matched exactly first, otherwise as a part of
+    one device's name; a part matching several devices raises ValueError, since two stations
+    could open the same device.
+    '''
+    if device is None or device == "":
+        return audio.get_default_input_device_info()
+    if isinstance(device, int) or str(device).isdigit():
+        return audio.get_device_info_by_index(int(device))
+
+    inputs = [info for info in (audio.get_device_info_by_index(index) for index in range(audio.get_device_count()))
+              if info['maxInputChannels'] > 0]
+    wanted = str(device).lower()
+    for info in inputs:
+        if info['name'].lower() == wanted:
+            return info
+    matches = [info for info in inputs if wanted in info['name'].lower()]
+    if len(matches) == 1:
+        return matches[0]
+    names = [info['name'] for info in (matches or inputs)]
+    if matches:
+        raise ValueError(f"Input device '{device}' is ambiguous, it matches {names}")
+    raise ValueError(f"No input device matching '{device}', available: {names}")
+
+
+class PyAudioSource(AudioSource):
+    '''
+    Microphone opened through PyAudio in callback mode at its native rate, selected by name
+    (or index). Use test/device_index.py to list the device names.
+    '''
+    def __init__(self, logger, device=None) -> None:
+        super().__init__(logger)
+        self.__device = device
+        self.__audio = None
+        self.__stream = None
+        self.__info = None
+
+    def open(self) -> None:
+        self.__audio = pyaudio.PyAudio()
+        self.__info = find_input_device(self.__audio, self.__device)
+        self.rate = int(self.__info['defaultSampleRate'])
+        self.channels = max(1, min(int(self.__info['maxInputChannels']), MAX_DEVICE_CHANNELS))
+        self.name = f"mic '{self.__info['name']}'"
+
+    def start(self, callback, frames_per_chunk) -> None:
+        def stream_callback(in_data, frame_count, time_info, status):
+            callback(in_data, bool(status & pyaudio.paInputOverflow))
+            return (None, pyaudio.paContinue)
+
+        self.__stream = self.__audio.open(format=pyaudio.paInt16,
+                                          channels=self.channels,
+                                          rate=self.rate,
+                                          input=True,
+                                          input_device_index=self.__info['index'],
+                                          frames_per_buffer=frames_per_chunk,
+                                          stream_callback=stream_callback)
+        self.__stream.start_stream()
+
+    def close(self) -> None:
+        if self.__stream:
+            self.__stream.stop_stream()
+            self.__stream.close()
+            self.__stream = None
+        if self.__audio:
+            self.__audio.terminate()
+            self.__audio = None
+
+    def is_active(self) -> bool:
+        return self.__stream is not None and self.__stream.is_active()
+
+
+class StreamSource(AudioSource):
+    '''
+    Raw int16 PCM read from a file-like object by a reader thread. With realtime set the
+    reader is paced to the sample rate, otherwise it runs as fast as the consumer allows.
+    paced=False leaves the pace to a live producer that is real time on its own.
+    '''
+    def __init__(self, logger, rate, channels, realtime=True, paced=None) -> None:
+        super().__init__(logger)
+        self.rate = rate
+        self.channels = channels
+        self.realtime = realtime
+        self.__paced = realtime if paced is None else paced
+        self._file = None
+        self.__thread = None
+        self.__running = False
+
+    def open(self) -> None:
+        pass
+
+    def _connect(self):
+        '''
+        Returns the file-like object to read from, or None to stop.
+        '''
+        raise NotImplementedError
+
+    def start(self, callback, frames_per_chunk) -> None:
+        self.__running = True
+        self.__thread = threading.Thread(target=self.__read_loop, args=(callback, frames_per_chunk),
+                                         name=self.name, daemon=True)
+        self.__thread.start()
+
+    def __read_loop(self, callback, frames_per_chunk) -> None:
+        chunk_bytes = frames_per_chunk * self.channels * 2
+        try:
+            self._file = self._connect()
+            next_time = time.monotonic()
+            while self.__running and self._file is not None:
+                data = self._file.read(chunk_bytes)
+                if not data:
+                    self._logger.info("%s reached end of stream", self.name)
+                    self._file = self._connect() if self._reconnect() else None
+                    continue
+                # Keep whole frames only
+                data = data[:len(data) - len(data) % (self.channels * 2)]
+                callback(data, False)
+                if self.__paced:
+                    next_time += len(data) / (self.channels * 2) / self.rate
+                    time.sleep(max(0.0, next_time - time.monotonic()))
+        except Exception as e:
+            self._logger.error("%s failed: %s", self.name, e)
+        finally:
+            self.__running = False
+
+    def _reconnect(self) -> bool:
+        return False
+
+    def close(self) -> None:
+        self.__running = False
+        if self._file is not None and self._file is not sys.stdin.buffer:
+            self._file.close()
+        if self.__thread and self.__thread is not threading.current_thread():
+            self.__thread.join(timeout=1.0)
+        self._file = None
+
+    def is_active(self) -> bool:
+        return self.__running
+
+
+class WavFileSource(StreamSource):
+    '''
+    Plays a WAV file, by default faster than real time for headless load tests and replays.
+    '''
+    finite = True
+
+    def __init__(self, logger, path, realtime=False) -> None:
+        with wave.open(path, 'rb') as wavFile:
+            if wavFile.getsampwidth() != 2:
+                raise ValueError(f"{path}: only 16-bit PCM is supported")
+            super().__init__(logger, wavFile.getframerate(), wavFile.getnchannels(), realtime)
+        self.__path = path
+        self.name = f"wav '{path}'"
+
+    def _connect(self):
+        wavFile = wave.open(self.__path, 'rb')
+        return _WaveReader(wavFile)
+
+
+class _WaveReader:
+    '''
+    File-like view of a wave.Wave_read that returns raw frames from read(size in bytes).
+    '''
+    def __init__(self, wavFile) -> None:
+        self.__wav = wavFile
+        self.__frame_bytes = wavFile.getnchannels() * wavFile.getsampwidth()
+
+    def read(self, size) -> bytes:
+        return self.__wav.readframes(size // self.__frame_bytes)
+
+    def close(self) -> None:
+        self.__wav.close()
+
+
+class RawPcmSource(StreamSource):
+    '''
+    Raw int16 PCM from a file, a FIFO or stdin ("-"), e.g. `arecord -f S16_LE -r 16000 | ...`.
+    Pipes are live by default: realtime, at the producer's pace, and a FIFO is opened again
+    for the next producer when one ends. The end of stdin or a file is the end of the input.
+    '''
+    def __init__(self, logger, path, rate, channels, realtime=None) -> None:
+        pipe = path == "-" or _is_fifo(path)
+        if realtime is None:
+            # Regular files are read faster than real time
+            realtime = pipe
+        super().__init__(logger, rate, channels, realtime, paced=False if pipe else None)
+        self.__path = path
+        self.__reopen = pipe and realtime and path != "-"
+        self.finite = not self.__reopen
+        self.name = "pcm stdin" if path == "-" else f"pcm '{path}'"
+
+    def _connect(self):
+        if self.__path == "-":
+            return sys.stdin.buffer
+        # Blocks until a producer opens a FIFO
+        return open(self.__path, 'rb')
+
+    def _reconnect(self) -> bool:
+        if self.__reopen:
+            self._file.close()
+        return self.__reopen
+
+
+def _is_fifo(path) -> bool:
+    try:
+        return stat.S_ISFIFO(os.stat(path).st_mode)
+    except OSError:
+        return False
+
+
+class UnixSocketSource(StreamSource):
+    '''
+    Raw int16 PCM from a UNIX stream socket served by an audio gateway. The connection is
+    retried when the gateway is not up yet or goes away. The stream is live: a reader that
+    falls behind loses the oldest audio instead of holding the gateway back.
+    '''
+    def __init__(self, logger, path, rate, channels) -> None:
+        super().__init__(logger, rate, channels, realtime=True, paced=False)
+        self.__path = path
+        self.__socket = None
+        self.name = f"unix '{path}'"
+
+    def _connect(self):
+        while self.is_active():
+            try:
+                self.__socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                self.__socket.connect(self.__path)
+                self._logger.info("Connected to audio gateway %s", self.__path)
+                return self.__socket.makefile('rb')
+            except OSError as err:
+                self.__socket.close()
+                self._logger.warning("Cannot connect to %s: %s, retrying", self.__path, err)
+                time.sleep(RECONNECT_SECONDS)
+        return None
+
+    def _reconnect(self) -> bool:
+        self._file.close()
+        self.__socket.close()
+        return True
+
+    def close(self) -> None:
+        super().close()
+        if self.__socket is not None:
+            self.__socket.close()
+            self.__socket = None
+
+
+def create_audio_source(logger, spec):
+    '''
+    Builds an audio source from a specification string:
+        mic (the default input device), mic:<device name or index>
+        wav:<path>
+        pcm:<path or ->,<rate>,<channels>
+        unix:<socket path>,<rate>,<channels>
+    '''
+    kind, _, argument = spec.partition(":")
+    if kind == "mic":
+        return PyAudioSource(logger, argument or None)
+    if kind == "wav":
+        return WavFileSource(logger, argument)
+    if kind in ("pcm", "unix"):
+        fields = argument.split(",")
+        path = fields[0]
+        rate, channels = (fields[1:] + ["16000", "1"][len(fields) - 1:])[:2]
+        if kind == "pcm":
+            return RawPcmSource(logger, path, int(rate), int(channels))
+        return UnixSocketSource(logger, path, int(rate), int(channels))
+    raise ValueError(f"Unknown audio source '{spec}'")
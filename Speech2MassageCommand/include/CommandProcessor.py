@@ -0,0 +1,150 @@
+import collections
+import threading
+import time
+from include.Commands import SpeechState
+from include.Metrics import METRICS
+
+# A repeat of the running mode after this many seconds is sent again, the sequence may have ended on its own
+REPEAT_SECONDS = 30.0
+# Latest stop latencies kept as raw samples for load reports
+STOP_SAMPLES = 10000
+
+class CommandProcessor:
+    '''
+    Takes the recognized SpeechState commands off the command queue and dispatches them to
+    the REST server through the controller's start_mode_long, start_mode_short and stop_mode.
+    An error state ends the loop. With a ServiceDiscovery the REST server address is looked
+    up for every command, so a server that moved is followed.
+
+    With coalesce (needs a CommandQueue) only the latest queued intent is dispatched, and
+    commands that would not change the chair's state are skipped: a start of the mode that
+    is already running and a stop while nothing runs. The controller methods return False
+    when a request failed, the state of the chair is then unknown and nothing is skipped.
+
+    If the CommandQueue has a stop lane, stops are dispatched by a thread of their own as
+    soon as they are queued, also while a start is still in flight. The controller's
+    stop_mode cancels that start. These stops are never skipped, the start they overtake
+    may not have been recorded yet. A start taken from the queue before a stop came in is
+    not sent if it has not been yet, and stopped again if it still succeeded. The time from
+    queueing a stop to the server's answer, for stops that were sent, is reported as the
+    "stop" stage and kept in stop_latencies.
+    '''
+    def __init__(self, logger, command_queue, controller, ip_addr, port, discovery=None, coalesce=True,
+                 repeat_after=REPEAT_SECONDS) -> None:
+        self.__logger = logger
+        self.__queue = command_queue
+        self.__controller = controller
+        self.__address = (ip_addr, port)
+        self.__discovery = discovery
+        self.__coalesce = coalesce
+        self.__repeat_after = repeat_after
+        # Mode the chair was last put in, None until known
+        self.__active = None
+        self.__active_since = 0.0
+        # Guards the state above and the counters, both dispatch threads update them
+        self.__lock = threading.Lock()
+        self.dispatched = 0
+        self.suppressed = 0
+        self.stop_latencies = collections.deque(maxlen=STOP_SAMPLES)
+
+    def run(self) -> None:
+        self.__logger.info('Starting process command thread')
+        stop_lane = self.__coalesce and self.__queue.stop_lane
+        if stop_lane:
+            threading.Thread(target=self.__run_stops, name="dispatch-stop", daemon=True).start()
+        while True:
+            stops = None
+            if stop_lane:
+                speechstate, stops = self.__queue.get_latest(stops=True)
+            elif self.__coalesce:
+                speechstate = self.__queue.get_latest()
+            else:
+                speechstate = self.__queue.get()
+            if not self.dispatch(speechstate, stops):
+                break
+
+    def __run_stops(self) -> None:
+        while True:
+            speechstate, queued_at = self.__queue.get_stop()
+            if speechstate == SpeechState.error:
+                break
+            if self.__discovery is not None:
+                self.__address = self.__discovery.address
+            ok = self.__send(speechstate)
+            with self.__lock:
+                self.__record(speechstate, ok)
+                self.dispatched += 1
+            if ok is not None:
+                # None: nothing was started, no request was sent
+                latency = time.perf_counter() - queued_at
+                METRICS.observe_stage("stop", latency)
+                self.stop_latencies.append(latency)
+
+    def dispatch(self, speechstate, stops=None) -> bool:
+        '''
+        Executes one command, returns False when processing should stop. stops is the stop
+        lane's count when the command was taken from the queue, a start is overtaken when a
+        stop was queued after that.
+        '''
+        if speechstate == SpeechState.error:
+            self.__logger.error("Error %s", speechstate)
+            return False
+        starting = speechstate == SpeechState.mode_long or speechstate == SpeechState.mode_short
+        with self.__lock:
+            if starting and self.__overtaken(stops):
+                self.__logger.info("Skipping %s, a stop came in after it", speechstate.name)
+                METRICS.counter("mcms_commands_coalesced_total").inc()
+                return True
+            if self.__coalesce and self.__redundant(speechstate):
+                self.__logger.info("Skipping %s, the chair is already in that state", speechstate.name)
+                METRICS.counter("mcms_commands_suppressed_total", command=speechstate.name).inc()
+                self.suppressed += 1
+                return True
+            if starting:
+                # Unknown until the server answered
+                self.__active = None
+
+        if self.__discovery is not None:
+            self.__address = self.__discovery.address
+        ok = self.__send(speechstate)
+
+        with self.__lock:
+            overtaken = starting and self.__overtaken(stops)
+            # Otherwise the stop lane records the state
+            if not overtaken:
+                self.__record(speechstate, ok)
+            self.dispatched += 1
+        if overtaken and ok:
+            # The stop may have reached the server before this start did
+            self.__logger.warning("%s was overtaken by a stop, stopping it again", speechstate.name)
+            ok = self.__send(SpeechState.stop)
+            with self.__lock:
+                self.__record(SpeechState.stop, ok)
+        return True
+
+    def __send(self, speechstate):
+        if speechstate == SpeechState.mode_long:
+            return self.__controller.start_mode_long(*self.__address)
+        if speechstate == SpeechState.mode_short:
+            return self.__controller.start_mode_short(*self.__address)
+        if speechstate == SpeechState.stop:
+            return self.__controller.stop_mode(*self.__address)
+        return None
+
+    def __overtaken(self, stops) -> bool:
+        return stops is not None and stops != self.__queue.stops
+
+    def __record(self, speechstate, ok) -> None:
+        if ok is False:
+            self.__active = None
+        elif speechstate == SpeechState.mode_long or speechstate == SpeechState.mode_short:
+            self.__active = speechstate
+            self.__active_since = time.perf_counter()
+        elif speechstate == SpeechState.stop:
+            self.__active = SpeechState.idle
+
+    def __redundant(self, speechstate) -> bool:
+        if speechstate == SpeechState.stop:
+            return self.__active == SpeechState.idle
+        return (speechstate == self.__active
+                and time.perf_counter() - self.__active_since < self.__repeat_after)
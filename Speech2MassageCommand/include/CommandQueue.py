@@ -0,0 +1,109 @@
+import collections
+import queue
+import threading
+import time
+from include.Commands import SpeechState
+from include.Metrics import METRICS
+
+class CommandQueue(queue.Queue):
+    '''
+    Queue of recognized SpeechState commands between the recognition and the dispatch thread.
+    Every command is stamped when it is queued, so the time it waited for the dispatcher and
+    the queue depth are reported to the metrics.
+
+    get_latest() lets the dispatcher catch up when recognition got ahead of it: everything
+    queued is taken at once and only the latest intent is returned. Commands that waited
+    longer than max_age seconds are dropped, a stop is always kept.
+
+    With stop_lane a stop does not queue behind other commands: it discards the commands
+    queued before it and is handed to get_stop(), which a separate dispatch thread waits on.
+    An error is put in both lanes, so both threads end. stops counts the stops put in the
+    stop lane, get_latest(stops=True) tells how many there were when the command was taken.
+    '''
+    def __init__(self, maxsize=0, max_age=None, stop_lane=False) -> None:
+        super().__init__(maxsize)
+        self.max_age = max_age
+        self.stop_lane = stop_lane
+        self.__stops = collections.deque()
+        self.stops = 0
+        self.stop_ready = threading.Condition(self.mutex)
+
+    def _init(self, maxsize) -> None:
+        super()._init(maxsize)
+        self.__depth = METRICS.gauge("mcms_command_queue_depth")
+
+    def _put(self, item) -> None:
+        queued_at = time.perf_counter()
+        if self.stop_lane and (item == SpeechState.stop or item == SpeechState.error):
+            self.__stops.append((queued_at, item))
+            self.stop_ready.notify()
+            if item == SpeechState.stop:
+                self.stops += 1
+                # Nothing queued before a stop is dispatched after it
+                superseded = sum(1 for _, queued in self.queue if queued != SpeechState.error)
+                if superseded:
+                    METRICS.counter("mcms_commands_coalesced_total").inc(superseded)
+                    kept = [entry for entry in self.queue if entry[1] == SpeechState.error]
+                    self.queue.clear()
+                    self.queue.extend(kept)
+                    self.__depth.set(len(self.queue))
+                return
+        super()._put((queued_at, item))
+        self.__depth.set(len(self.queue))
+
+    def _get(self):
+        queued_at, item = super()._get()
+        self.__depth.set(len(self.queue))
+        METRICS.observe_stage("queue_wait", time.perf_counter() - queued_at)
+        return item
+
+    def get_latest(self, stops=False):
+        '''
+        Blocks until a command is queued, then takes all queued commands and returns the most
+        recent one that is not stale. An error is kept queued behind it, so it still ends the
+        dispatch loop on the next call. With stops, returns (command, stops) where stops is
+        the count of the stop lane when the command was taken, a stop put after that overtook it.
+        '''
+        while True:
+            with self.not_empty:
+                while not self._qsize():
+                    self.not_empty.wait()
+                taken_stops = self.stops
+                entries = list(self.queue)
+                self.queue.clear()
+                for index, (_, item) in enumerate(entries):
+                    if item == SpeechState.error:
+                        # Commands behind an error are never dispatched
+                        self.queue.append(entries[index])
+                        entries = entries[:index]
+                        break
+                self.__depth.set(len(self.queue))
+                self.not_full.notify_all()
+
+            now = time.perf_counter()
+            commands = []
+            for queued_at, item in entries:
+                METRICS.observe_stage("queue_wait", now - queued_at)
+                if self.max_age is None or now - queued_at <= self.max_age or item == SpeechState.stop:
+                    commands.append(item)
+            if len(commands) < len(entries):
+                METRICS.counter("mcms_commands_dropped_total").inc(len(entries) - len(commands))
+            if len(commands) > 1:
+                METRICS.counter("mcms_commands_coalesced_total").inc(len(commands) - 1)
+            if commands:
+                return (commands[-1], taken_stops) if stops else commands[-1]
+            if self._qsize():
+                # Only the error is left
+                return (self.get(), taken_stops) if stops else self.get()
+
+    def get_stop(self):
+        '''
+        Blocks until a stop or an error is put in the stop lane, returns it and the
+        perf_counter() time it was queued at.
+        '''
+        with self.stop_ready:
+            while not self.__stops:
+                self.stop_ready.wait()
+            queued_at, item = self.__stops.popleft()
+        METRICS.observe_stage("queue_wait", time.perf_counter() - queued_at)
+        return item, queued_at
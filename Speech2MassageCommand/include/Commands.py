@@ -0,0 +1,61 @@
+from enum import Enum
+import json
+import re
+
+class SpeechState(Enum):
+    idle = 0
+    mode_long = 1
+    mode_short = 2
+    stop = 3
+    error = 4
+
+# Spoken phrase -> state it triggers
+COMMAND_TABLE = {
+    "long": SpeechState.mode_long,
+    "short": SpeechState.mode_short,
+    "stop": SpeechState.stop,
+}
+
+COMMAND_TABLE_EN_DE = {
+    **COMMAND_TABLE,
+    "lange": SpeechState.mode_long,
+    "kurze": SpeechState.mode_short,
+    "stoppen": SpeechState.stop,
+}
+
+
+def split_words(text):
+    '''
+    Returns the lower-case words of a transcription, without punctuation.
+    '''
+    return re.findall(r"[\w']+", text.lower())
+
+
+def find_command(words, command_table=COMMAND_TABLE, start=0):
+    '''
+    Returns (end, state) of the last command phrase in the word list that begins at or after
+    start, where end is the index after its last word, or (None, None) if there is none.
+    '''
+    best_begin, best = -1, (None, None)
+    for phrase, state in command_table.items():
+        tokens = phrase.split()
+        for begin in range(len(words) - len(tokens), start - 1, -1):
+            if words[begin:begin + len(tokens)] == tokens:
+                if begin > best_begin:
+                    best_begin, best = begin, (begin + len(tokens), state)
+                break
+    return best
+
+
+def match_command(text, command_table=COMMAND_TABLE):
+    '''
+    Returns the state of the last command phrase in text, or None.
+    '''
+    return find_command(split_words(text), command_table)[1]
+
+
+def build_grammar(command_table=COMMAND_TABLE) -> str:
+    '''
+    Returns a Vosk grammar restricted to the command phrases, with [unk] absorbing everything else.
+    '''
+    return json.dumps(sorted(command_table) + ["[unk]"])
@@ -0,0 +1,68 @@
+from include.Commands import COMMAND_TABLE
+
+# Tokens decoded per window at most, a command utterance needs far fewer
+SAMPLE_LEN = 32
+
+class DecodeProfile:
+    '''
+    Whisper decode options for short command windows on CPU: the language is pinned or only
+    chosen among the expected languages, no timestamps, greedy decoding at temperature 0
+    without fallback, a bounded number of tokens and a prompt listing the command words.
+    The stock transcribe() detects the language on every window, tries fp16 on CPU, predicts
+    timestamps and retries at higher temperatures, none of which helps a one-word command.
+    '''
+    def __init__(self, languages=("en",), command_table=COMMAND_TABLE, sample_len=SAMPLE_LEN, prompt=None) -> None:
+        # None or empty detects the language among all languages of the model
+        self.languages = tuple(languages or ())
+        self.sample_len = sample_len
+        self.prompt = prompt if prompt is not None else "Commands: " + ", ".join(sorted(command_table)) + "."
+
+    def options(self, language=None) -> dict:
+        '''
+        Returns the keyword arguments of whisper's transcribe() for this profile.
+        '''
+        if language is None and len(self.languages) == 1:
+            language = self.languages[0]
+        return {
+            "language": language,
+            "fp16": False,
+            "temperature": 0.0,
+            "without_timestamps": True,
+            "condition_on_previous_text": False,
+            "sample_len": self.sample_len,
+            "initial_prompt": self.prompt,
+        }
+
+    def decoding_options(self, language=None) -> dict:
+        '''
+        Returns the same profile as whisper.DecodingOptions fields, for batched decoding.
+        With several languages pass them to the WhisperBatcher as well, which picks each
+        window's language among them.
+        '''
+        options = self.options(language)
+        options["prompt"] = options.pop("initial_prompt")
+        del options["condition_on_previous_text"]
+        return options
+
+    def language_for(self, model, audio):
+        '''
+        Returns the most likely of the profile's languages for the window, or the pinned one.
+        Only PyTorch whisper models expose language probabilities, other engines detect freely.
+        '''
+        if len(self.languages) <= 1 or not hasattr(model, "detect_language") or not hasattr(model, "dims"):
+            return self.languages[0] if self.languages else None
+        import whisper
+        mel = whisper.log_mel_spectrogram(whisper.pad_or_trim(audio), model.dims.n_mels).to(model.device)
+        return self.language_for_mel(model, mel)
+
+    def language_for_mel(self, model, mel):
+        '''
+        Like language_for(), from the (n_mels, 3000) log-mel features of the window.
+        '''
+        if len(self.languages) <= 1:
+            return self.languages[0] if self.languages else None
+        _, probs = model.detect_language(mel)
+        return max(self.languages, key=lambda language: probs.get(language, 0.0))
+
+    def transcribe(self, model, audio) -> dict:
+        return model.transcribe(audio, **self.options(self.language_for(model, audio)))
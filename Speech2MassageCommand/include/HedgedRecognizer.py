@@ -0,0 +1,242 @@
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from include.Commands import COMMAND_TABLE, match_command, build_grammar
+from include.Metrics import METRICS, Histogram
+
+FRAME_RATE = 16000
+BACKENDS = ("cloud", "local")
+# A command heard with less confidence is only taken if no backend is more confident
+MIN_CONFIDENCE = 0.6
+# Longest wait for the answers of one utterance, a backend still busy then is abandoned
+TIMEOUT_SECONDS = 5.0
+# Cloud answers slower than this count as failures for the circuit breaker
+SLOW_SECONDS = 1.5
+# Consecutive cloud failures that open the breaker, and the seconds until the cloud is tried again
+FAILURE_THRESHOLD = 3
+RETRY_SECONDS = 30.0
+# Requests running at once per backend
+MAX_IN_FLIGHT = 3
+
+
+def cloud_backend(recognizer, language="en-US"):
+    '''
+    Google Web Speech API through a speech_recognition Recognizer, audio is an sr.AudioData.
+    The backend returns (text, confidence of the best alternative or None).
+    '''
+    def recognize(audio):
+        result = recognizer.recognize_google(audio, language=language, show_all=True)
+        if not result or not result.get("alternative"):
+            return "", None
+        best = result["alternative"][0]
+        return best.get("transcript", ""), best.get("confidence")
+    return recognize
+
+
+def vosk_backend(model, command_table=COMMAND_TABLE, grammar=True):
+    '''
+    Vosk on the same sr.AudioData, restricted to the command phrases with grammar. The backend
+    returns (text, mean confidence of the recognized words or None).
+    '''
+    from vosk import KaldiRecognizer
+    grammar = build_grammar(command_table) if grammar else None
+
+    def recognize(audio):
+        # A recognizer per utterance, so utterances can be decoded concurrently
+        if grammar:
+            rec = KaldiRecognizer(model, FRAME_RATE, grammar)
+        else:
+            rec = KaldiRecognizer(model, FRAME_RATE)
+        rec.SetWords(True)
+        rec.AcceptWaveform(audio.get_raw_data(convert_rate=FRAME_RATE, convert_width=2))
+        result = json.loads(rec.FinalResult())
+        words = [word for word in result.get("result", []) if word.get("word") != "[unk]"]
+        confidence = sum(word["conf"] for word in words) / len(words) if words else None
+        return result.get("text", ""), confidence
+    return recognize
+
+
+class CircuitBreaker:
+    '''
+    Counts consecutive failures of a backend. After failure_threshold of them it opens and
+    allow() refuses requests for retry_seconds, then lets one trial request through: its
+    success closes the breaker again, its failure opens it for another retry_seconds. A
+    trial request that never ran is given up with abandon(), the next allow() tries again.
+    '''
+    def __init__(self, failure_threshold=FAILURE_THRESHOLD, retry_seconds=RETRY_SECONDS) -> None:
+        self.__threshold = failure_threshold
+        self.__retry = retry_seconds
+        self.__failures = 0
+        self.__open_until = None
+        self.__trial = False
+        self.__lock = threading.Lock()
+
+    @property
+    def open(self) -> bool:
+        return self.__open_until is not None
+
+    def allow(self) -> bool:
+        with self.__lock:
+            if self.__open_until is None:
+                return True
+            if self.__trial or time.monotonic() < self.__open_until:
+                return False
+            self.__trial = True
+            return True
+
+    def abandon(self) -> None:
+        with self.__lock:
+            self.__trial = False
+
+    def record(self, ok) -> None:
+        with self.__lock:
+            if ok:
+                self.__failures = 0
+                self.__open_until = None
+            else:
+                self.__failures += 1
+                if self.__trial or self.__failures >= self.__threshold:
+                    self.__open_until = time.monotonic() + self.__retry
+            self.__trial = False
+
+
+class HedgedRecognizer:
+    '''
+    Sends every utterance to the cloud recognizer and to a local backend at the same time
+    and takes the first answer that contains a command with at least min_confidence (or no
+    confidence reported). The other request is cancelled if it has not started yet, a
+    running one cannot be interrupted and its answer is discarded. Without a confident
+    command the most confident one heard is taken once all answers are in.
+
+    Cloud answers that fail or take longer than slow_seconds, also the discarded ones,
+    count towards the circuit breaker. While it is open only the local backend is asked.
+    Requests, wins (the backend whose answer was taken), failures and latencies are kept
+    per backend, see statistics(), and exported to the metrics.
+
+    Backends are callables mapping the utterance to (text, confidence or None).
+    '''
+    def __init__(self, logger, cloud, local, command_table=COMMAND_TABLE, min_confidence=MIN_CONFIDENCE,
+                 timeout=TIMEOUT_SECONDS, slow_seconds=SLOW_SECONDS, breaker=None) -> None:
+        self.__logger = logger
+        self.__backends = {"cloud": cloud, "local": local}
+        self.__command_table = command_table
+        self.__min_confidence = min_confidence
+        self.__timeout = timeout
+        self.__slow_seconds = slow_seconds
+        self.breaker = breaker or CircuitBreaker()
+        self.__pools = {name: ThreadPoolExecutor(max_workers=MAX_IN_FLIGHT, thread_name_prefix=f"hedge-{name}")
+                        for name in BACKENDS}
+        self.__counts = {name: {"requests": 0, "wins": 0, "failures": 0} for name in BACKENDS}
+        self.__latency = {name: Histogram() for name in BACKENDS}
+        self.__utterances = 0
+        self.__lock = threading.Lock()
+
+    def close(self) -> None:
+        for pool in self.__pools.values():
+            pool.shutdown(wait=False, cancel_futures=True)
+
+    def recognize(self, audio):
+        '''
+        Returns (state, name of the backend it came from, text), state is None if no backend
+        heard a command. Raises the error of the last backend if all backends asked failed.
+        '''
+        start = time.perf_counter()
+        names = ["local"]
+        trial = self.breaker.open
+        if self.breaker.allow():
+            names.append("cloud")
+        else:
+            METRICS.counter("mcms_hedge_local_only_total").inc()
+        with self.__lock:
+            self.__utterances += 1
+        futures = {self.__pools[name].submit(self.__run, name, audio, start): name for name in names}
+        if trial and "cloud" in names:
+            # A cancelled trial is never recorded, the breaker would stay open for good
+            cloud = next(future for future, name in futures.items() if name == "cloud")
+            cloud.add_done_callback(lambda future: future.cancelled() and self.breaker.abandon())
+
+        pending, fallback, error, answered = set(futures), None, None, False
+        while pending:
+            done, pending = wait(pending, timeout=max(0.0, start + self.__timeout - time.perf_counter()),
+                                 return_when=FIRST_COMPLETED)
+            if not done:
+                self.__logger.warning("No answer from %s within %.1f s",
+                                      ", ".join(futures[future] for future in pending), self.__timeout)
+                break
+            for future in done:
+                name = futures[future]
+                try:
+                    text, confidence = future.result()
+                except Exception as e:
+                    error = e
+                    continue
+                answered = True
+                state = match_command(text, self.__command_table)
+                if state is None:
+                    continue
+                if confidence is None or confidence >= self.__min_confidence:
+                    for other in pending:
+                        other.cancel()
+                    return self.__win(state, name, text)
+                if fallback is None or confidence > fallback[3]:
+                    fallback = (state, name, text, confidence)
+
+        for future in pending:
+            future.cancel()
+        if fallback is not None:
+            return self.__win(*fallback[:3])
+        if error is not None and not answered:
+            raise error
+        return None, None, ""
+
+    def statistics(self) -> dict:
+        '''
+        Returns per backend the requests, wins, win rate over all utterances, failures and
+        latency (mean and bucket percentiles in seconds) of the answers.
+        '''
+        statistics = {}
+        for name in BACKENDS:
+            counts, latency = dict(self.__counts[name]), self.__latency[name]
+            counts["win_rate"] = counts["wins"] / self.__utterances if self.__utterances else None
+            counts["latency_mean"] = latency.sum / latency.count if latency.count else None
+            counts["latency_p50"] = latency.percentile(50)
+            counts["latency_p95"] = latency.percentile(95)
+            statistics[name] = counts
+        return statistics
+
+    def __run(self, name, audio, start):
+        with self.__lock:
+            self.__counts[name]["requests"] += 1
+        try:
+            result = self.__backends[name](audio)
+        except Exception as e:
+            self.__finish(name, start, False)
+            self.__logger.warning("Recognition with the %s backend failed: %s", name, e)
+            raise
+        self.__finish(name, start, True)
+        return result
+
+    def __finish(self, name, start, ok) -> None:
+        elapsed = time.perf_counter() - start
+        if ok:
+            self.__latency[name].observe(elapsed)
+            METRICS.histogram("mcms_hedge_seconds", backend=name).observe(elapsed)
+        else:
+            with self.__lock:
+                self.__counts[name]["failures"] += 1
+            METRICS.counter("mcms_hedge_failures_total", backend=name).inc()
+        if name == "cloud":
+            was_open = self.breaker.open
+            self.breaker.record(ok and elapsed <= self.__slow_seconds)
+            if self.breaker.open and not was_open:
+                self.__logger.warning("Cloud recognition failing or slower than %.1f s, using the local backend only",
+                                      self.__slow_seconds)
+            elif was_open and not self.breaker.open:
+                self.__logger.info("Cloud recognition is back")
+
+    def __win(self, state, name, text):
+        with self.__lock:
+            self.__counts[name]["wins"] += 1
+        METRICS.counter("mcms_hedge_wins_total", backend=name).inc()
+        return state, name, text
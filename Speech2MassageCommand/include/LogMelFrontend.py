@@ -0,0 +1,121 @@
+import threading
+import time
+import numpy as np
+from include.AudioFrontend import PCM16_SCALE, WHISPER_RATE
+from include.Metrics import METRICS
+
+N_FFT = 400
+HOP_LENGTH = 160
+# Mel frames of a 30 second Whisper input
+N_FRAMES = 3000
+# log10 of the clamped power of silence, the value of Whisper's zero padding
+SILENCE = -10.0
+# Features kept, longer than the capture buffer since file sources run ahead of the reader
+BUFFER_SECONDS = 60
+
+class LogMelFrontend:
+    '''
+    Whisper's log-mel features computed while the audio is captured instead of after the
+    window is complete. Registered as an AudioCapture listener, it turns every chunk into the
+    STFT frames that became complete with it, in one vectorized NumPy pass, and keeps their
+    log10 mel energies in a ring buffer indexed by capture position.
+
+    window() then only cuts the frames of a window, pads them to 30 seconds and applies
+    Whisper's normalization, so decoding starts with the encoder. Frames whose STFT reaches
+    past the captured audio are computed on demand with zero padding and not stored.
+    '''
+    def __init__(self, filters, buffer_seconds=BUFFER_SECONDS) -> None:
+        # (n_mels, N_FFT // 2 + 1) mel filter bank of the model
+        self.__filters = np.asarray(filters, dtype=np.float32)
+        self.n_mels = len(self.__filters)
+        # Periodic Hann window like torch.hann_window
+        self.__window = np.hanning(N_FFT + 1)[:-1].astype(np.float32)
+        self.__capacity = int(WHISPER_RATE * buffer_seconds) // HOP_LENGTH
+        self.__mel = np.full((self.n_mels, self.__capacity), SILENCE, dtype=np.float32)
+        # Samples not consumed yet, starting N_FFT // 2 before the centre of frame __next
+        self.__pending = None
+        self.__next = 0
+        self.__first = 0
+        self.__lock = threading.Lock()
+        self.seconds = 0.0
+
+    @classmethod
+    def for_model(cls, model, buffer_seconds=BUFFER_SECONDS):
+        import whisper
+        return cls(whisper.audio.mel_filters("cpu", model.dims.n_mels).numpy(), buffer_seconds)
+
+    def accept(self, samples, position) -> None:
+        '''
+        AudioCapture listener: samples are the int16 mono frames captured at position.
+        '''
+        start_time = time.perf_counter()
+        audio = np.multiply(samples.reshape(-1), PCM16_SCALE, dtype=np.float32)
+        with self.__lock:
+            if self.__pending is None:
+                # The first frame centred in the audio, nothing before it is known
+                self.__next = self.__first = -(-position // HOP_LENGTH)
+                lead = position - (self.__next * HOP_LENGTH - N_FFT // 2)
+                self.__pending = np.zeros(lead, dtype=np.float32)
+            pending = np.concatenate((self.__pending, audio))
+            count = (len(pending) - N_FFT) // HOP_LENGTH + 1
+            if count > 0:
+                self.__store(self.__next, self.__log_mel(pending, count))
+                self.__next += count
+                self.__pending = pending[count * HOP_LENGTH:]
+            else:
+                self.__pending = pending
+        elapsed = time.perf_counter() - start_time
+        self.seconds += elapsed
+        METRICS.observe_stage("features", elapsed)
+
+    def window(self, start, end):
+        '''
+        Returns the normalized (n_mels, N_FRAMES) features of the capture frames [start, end)
+        as Whisper computes them for that audio, or None if they are not available.
+        '''
+        return self.segments([(start, end)])
+
+    def segments(self, ranges):
+        '''
+        Returns the normalized (n_mels, N_FRAMES) features of the capture ranges (start, end)
+        joined one after the other, the features of audio cut to those ranges, or None if they
+        are not available. Ranges should start on a HOP_LENGTH boundary, as VAD frames do.
+        '''
+        mel = np.full((self.n_mels, N_FRAMES), SILENCE, dtype=np.float32)
+        filled = 0
+        with self.__lock:
+            if self.__pending is None:
+                return None
+            for start, end in ranges:
+                first = start // HOP_LENGTH
+                count = min((end - start) // HOP_LENGTH, N_FRAMES - filled)
+                if count <= 0:
+                    break
+                if first < max(self.__first, self.__next - self.__capacity):
+                    return None
+                mel[:, filled:filled + count] = self.__frames(first, count)
+                filled += count
+        mel = np.maximum(mel, mel.max() - 8.0)
+        return (mel + 4.0) / 4.0
+
+    def __frames(self, first, count):
+        ready = min(max(self.__next - first, 0), count)
+        index = (first + np.arange(ready)) % self.__capacity
+        if ready == count:
+            return self.__mel[:, index]
+        # The last frames need audio after the range, zero padded like Whisper does
+        missing = count - ready
+        offset = (first + ready - self.__next) * HOP_LENGTH
+        pending = np.concatenate((self.__pending[offset:],
+                                  np.zeros(N_FFT + missing * HOP_LENGTH, dtype=np.float32)))
+        return np.concatenate((self.__mel[:, index], self.__log_mel(pending, missing)), axis=1)
+
+    def __log_mel(self, samples, count):
+        frames = np.lib.stride_tricks.sliding_window_view(samples, N_FFT)[:count * HOP_LENGTH:HOP_LENGTH]
+        spectrum = np.fft.rfft(frames * self.__window, axis=-1)
+        power = spectrum.real ** 2 + spectrum.imag ** 2
+        return np.log10(np.maximum(self.__filters @ power.T.astype(np.float32), 1e-10))
+
+    def __store(self, first, mel) -> None:
+        index = (first + np.arange(mel.shape[1])) % self.__capacity
+        self.__mel[:, index] = mel
@@ -0,0 +1,296 @@
+import json
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Upper bounds in seconds of the latency histogram buckets, 1 ms to 60 s
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+STAGE_SECONDS = "mcms_stage_seconds"
+DUMP_INTERVAL = 60.0
+# Seconds over which mcms_recognitions_per_second is averaged
+RATE_WINDOW = 60.0
+
+class Histogram:
+    '''
+    Fixed-bucket histogram, memory does not grow with the number of observations.
+    '''
+    def __init__(self, buckets=LATENCY_BUCKETS) -> None:
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.__lock = threading.Lock()
+
+    def observe(self, value) -> None:
+        index = 0
+        while index < len(self.buckets) and value > self.buckets[index]:
+            index += 1
+        with self.__lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.sum += value
+
+    def percentile(self, q):
+        '''
+        Returns the upper bound of the bucket holding the q-th percentile (0..100), None if empty.
+        '''
+        with self.__lock:
+            counts, count = list(self.counts), self.count
+        if count == 0:
+            return None
+        rank, seen = q / 100 * count, 0
+        for index, bucket_count in enumerate(counts):
+            seen += bucket_count
+            if seen >= rank and bucket_count:
+                return self.buckets[index] if index < len(self.buckets) else float("inf")
+        return float("inf")
+
+    def snapshot(self) -> dict:
+        with self.__lock:
+            counts, count, total = list(self.counts), self.count, self.sum
+        return {"count": count, "sum": total,
+                "buckets": dict(zip([str(b) for b in self.buckets] + ["+Inf"], counts))}
+
+
+class Counter:
+    def __init__(self) -> None:
+        self.value = 0
+        self.__lock = threading.Lock()
+
+    def inc(self, amount=1) -> None:
+        with self.__lock:
+            self.value += amount
+
+
+class Gauge:
+    def __init__(self) -> None:
+        self.value = 0
+
+    def set(self, value) -> None:
+        self.value = value
+
+
+class MetricsRegistry:
+    '''
+    Named histograms, counters and gauges, each optionally split by labels. The metrics are
+    created on first use, so the stages only need to name what they measure.
+    '''
+    def __init__(self) -> None:
+        self.__metrics = {}
+        self.__help = {}
+        self.__lock = threading.Lock()
+        self.started = time.time()
+        # (time, mcms_recognitions_total) samples of the last RATE_WINDOW seconds
+        self.__recognitions = deque([(self.started, 0)])
+
+    def __get(self, kind, name, labels):
+        key = (name, tuple(sorted(labels.items())))
+        metric = self.__metrics.get(key)
+        if metric is None:
+            with self.__lock:
+                metric = self.__metrics.setdefault(key, kind())
+        return metric
+
+    def describe(self, name, help) -> None:
+        self.__help[name] = help
+
+    def histogram(self, name, **labels) -> Histogram:
+        return self.__get(Histogram, name, labels)
+
+    def counter(self, name, **labels) -> Counter:
+        return self.__get(Counter, name, labels)
+
+    def gauge(self, name, **labels) -> Gauge:
+        return self.__get(Gauge, name, labels)
+
+    def observe_stage(self, stage, seconds) -> None:
+        self.histogram(STAGE_SECONDS, stage=stage).observe(seconds)
+
+    @contextmanager
+    def timer(self, stage):
+        '''
+        Measures the enclosed block with perf_counter into the stage latency histogram.
+        '''
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe_stage(stage, time.perf_counter() - start)
+
+    def recognition_rate(self) -> float:
+        '''
+        Sets and returns mcms_recognitions_per_second, the recognized commands per second over
+        the last RATE_WINDOW seconds (since the start before that), derived from the counter.
+        '''
+        now = time.time()
+        with self.__lock:
+            count = sum(metric.value for (name, _), metric in self.__metrics.items()
+                        if name == "mcms_recognitions_total")
+            self.__recognitions.append((now, count))
+            while len(self.__recognitions) > 1 and self.__recognitions[1][0] <= now - RATE_WINDOW:
+                self.__recognitions.popleft()
+            first_time, first_count = self.__recognitions[0]
+        rate = (count - first_count) / (now - first_time) if now > first_time else 0.0
+        self.gauge("mcms_recognitions_per_second").set(rate)
+        return rate
+
+    def prometheus(self) -> str:
+        '''
+        Returns all metrics in the Prometheus text exposition format.
+        '''
+        self.recognition_rate()
+        lines, typed = [], set()
+        with self.__lock:
+            metrics = sorted(self.__metrics.items(), key=lambda item: item[0])
+        for (name, labels), metric in metrics:
+            if name not in typed:
+                typed.add(name)
+                if name in self.__help:
+                    lines.append(f"# HELP {name} {self.__help[name]}")
+                kind = {Histogram: "histogram", Counter: "counter", Gauge: "gauge"}[type(metric)]
+                lines.append(f"# TYPE {name} {kind}")
+            if isinstance(metric, Histogram):
+                snapshot, cumulative = metric.snapshot(), 0
+                for bound, count in snapshot["buckets"].items():
+                    cumulative += count
+                    lines.append(f"{name}_bucket{_labels(labels + (('le', bound),))} {cumulative}")
+                lines.append(f"{name}_sum{_labels(labels)} {snapshot['sum']}")
+                lines.append(f"{name}_count{_labels(labels)} {snapshot['count']}")
+            else:
+                lines.append(f"{name}{_labels(labels)} {metric.value}")
+        return "\n".join(lines) + "\n"
+
+    def to_dict(self) -> dict:
+        self.recognition_rate()
+        result = {"timestamp": time.time(), "uptime": time.time() - self.started, "metrics": []}
+        with self.__lock:
+            metrics = sorted(self.__metrics.items(), key=lambda item: item[0])
+        for (name, labels), metric in metrics:
+            entry = {"name": name, "labels": dict(labels)}
+            if isinstance(metric, Histogram):
+                entry.update(metric.snapshot())
+                entry.update({"p50": metric.percentile(50), "p95": metric.percentile(95), "p99": metric.percentile(99)})
+            else:
+                entry["value"] = metric.value
+            result["metrics"].append(entry)
+        return result
+
+
+def _labels(labels) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+
+# Process-wide registry the stages report to
+METRICS = MetricsRegistry()
+METRICS.describe(STAGE_SECONDS, "Latency of the processing stages in seconds")
+METRICS.describe("mcms_recognitions_total", "Recognized commands by command")
+METRICS.describe("mcms_recognitions_per_second", "Recognized commands per second over the last minute")
+METRICS.describe("mcms_command_queue_depth", "Commands waiting to be dispatched")
+METRICS.describe("mcms_dropped_frames_total", "Captured frames overwritten before they were read")
+METRICS.describe("mcms_capture_overflows_total", "Input overflows reported by the audio source")
+METRICS.describe("mcms_dispatch_errors_total", "REST requests that failed without a response")
+METRICS.describe("mcms_starts_cancelled_total", "Sequence starts given up because a stop came in")
+METRICS.describe("mcms_commands_coalesced_total", "Queued commands replaced by a later one before dispatch")
+METRICS.describe("mcms_commands_dropped_total", "Queued commands dropped for waiting longer than the maximum age")
+METRICS.describe("mcms_commands_suppressed_total", "Commands not dispatched because the chair already was in that state")
+METRICS.describe("mcms_whisper_batches_total", "Batched Whisper forward passes")
+METRICS.describe("mcms_whisper_batched_windows_total", "Windows decoded in batched Whisper forward passes")
+METRICS.describe("mcms_cloud_requests_in_flight", "Cloud recognition requests sent and not answered yet")
+METRICS.describe("mcms_hedge_seconds", "Latency of the answers of the hedged recognition backends in seconds")
+METRICS.describe("mcms_hedge_wins_total", "Utterances whose command was taken from the backend")
+METRICS.describe("mcms_hedge_failures_total", "Failed requests of the hedged recognition backends")
+METRICS.describe("mcms_hedge_local_only_total", "Utterances decoded locally only while the cloud circuit breaker was open")
+
+
+class MetricsServer:
+    '''
+    Serves the registry on http://<host>:<port>/metrics in Prometheus text format and on
+    /metrics.json as JSON from a background thread.
+    '''
+    def __init__(self, logger, port, host="127.0.0.1", registry=METRICS) -> None:
+        self.__logger = logger
+        self.__server = ThreadingHTTPServer((host, port), _MetricsHandler)
+        self.__server.daemon_threads = True
+        self.__server.registry = registry
+        self.__thread = threading.Thread(target=self.__server.serve_forever, name="metrics", daemon=True)
+
+    def start(self) -> None:
+        self.__thread.start()
+        self.__logger.info("Serving metrics on http://%s:%d/metrics", *self.__server.server_address[:2])
+
+    def stop(self) -> None:
+        self.__server.shutdown()
+        self.__server.server_close()
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == "/metrics":
+            body, content_type = self.server.registry.prometheus().encode(), "text/plain; version=0.0.4"
+        elif self.path == "/metrics.json":
+            body, content_type = json.dumps(self.server.registry.to_dict()).encode(), "application/json"
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MetricsDumper:
+    '''
+    Writes the registry as JSON to path every interval seconds, replacing the file atomically,
+    and logs the recognitions per second.
+    '''
+    def __init__(self, logger, path, interval=DUMP_INTERVAL, registry=METRICS) -> None:
+        self.__logger = logger
+        self.__path = path
+        self.__interval = interval
+        self.__registry = registry
+        self.__stop = threading.Event()
+        self.__thread = threading.Thread(target=self.__run, name="metrics-dump", daemon=True)
+
+    def start(self) -> None:
+        self.__thread.start()
+
+    def stop(self) -> None:
+        self.__stop.set()
+        self.__thread.join()
+        self.dump()
+
+    def __run(self) -> None:
+        while not self.__stop.wait(self.__interval):
+            self.__logger.info("Recognitions per second: %.3f", self.__registry.recognition_rate())
+            self.dump()
+
+    def dump(self) -> None:
+        temp_path = self.__path + ".tmp"
+        try:
+            with open(temp_path, "w") as file:
+                json.dump(self.__registry.to_dict(), file, indent=2)
+            os.replace(temp_path, self.__path)
+        except OSError as err:
+            self.__logger.warning("Cannot write metrics to %s: %s", self.__path, err)
+
+def start_metrics(logger, port, dump_path, interval=DUMP_INTERVAL):
+    '''
+    Starts the metrics endpoint on port (0 disables it) and the periodic JSON dump to
+    dump_path (empty disables it). A port that is in use is logged, not fatal.
+    '''
+    if port:
+        try:
+            MetricsServer(logger, port).start()
+        except OSError as err:
+            logger.warning("Cannot serve metrics on port %d: %s", port, err)
+    if dump_path:
+        MetricsDumper(logger, dump_path, interval).start()
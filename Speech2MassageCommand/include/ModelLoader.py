@@ -0,0 +1,99 @@
+import importlib
+import os
+import sys
+import time
+import numpy as np
+
+# Directory holding the downloaded models, defaults to the caches the libraries download into
+MODEL_DIR = os.environ.get("MCMS_MODEL_DIR")
+WHISPER_CACHE = os.path.join(os.path.expanduser("~"), ".cache", "whisper")
+VOSK_CACHE = os.path.join(os.path.expanduser("~"), ".cache", "vosk")
+WARMUP_SECONDS = 2
+FRAME_RATE = 16000
+
+
+def load_whisper_model(logger, name, model_dir=None, warmup=True):
+    '''
+    Loads a Whisper model from the local cache only, never from the network, and runs one
+    transcription of synthetic audio so the first real window is decoded at steady-state speed.
+    Returns (model, timings) with the import (if this call imported the package), load and
+    warm-up durations in seconds. name is an official model name or the path of a checkpoint.
+    '''
+    timings = {}
+    whisper = _import("whisper", timings)
+
+    model_dir = model_dir or MODEL_DIR or WHISPER_CACHE
+    if name in whisper.available_models():
+        # Where whisper.load_model(name, download_root=model_dir) saves it
+        checkpoint = os.path.join(model_dir, f"{name}.pt")
+    else:
+        checkpoint = name
+    if not os.path.isfile(checkpoint):
+        raise FileNotFoundError(f"Whisper model '{name}' not found at {checkpoint}. "
+                                f"Download it once with whisper.load_model('{name}', download_root='{model_dir}'), "
+                                f"aliases such as 'large' are saved under their full name, e.g. 'large-v3'")
+
+    start = time.perf_counter()
+    model = whisper.load_model(checkpoint)
+    timings["load"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    if warmup:
+        model.transcribe(_warmup_audio(), fp16=False, temperature=0.0, condition_on_previous_text=False)
+    timings["warmup"] = time.perf_counter() - start
+
+    logger.info("Whisper model %s: %s", name, _format(timings))
+    return model, timings
+
+
+def load_vosk_model(logger, name, model_dir=None, warmup=True):
+    '''
+    Loads a Vosk model from a local directory instead of resolving or downloading it by name,
+    and runs one decode of synthetic audio. Returns (model, timings) like load_whisper_model().
+    '''
+    timings = {}
+    vosk = _import("vosk", timings)
+
+    path = os.path.join(model_dir or MODEL_DIR or VOSK_CACHE, name)
+    if not os.path.isdir(path):
+        raise FileNotFoundError(f"Vosk model '{name}' not found at {path}. "
+                                f"Unpack it from https://alphacephei.com/vosk/models into that directory")
+
+    start = time.perf_counter()
+    model = vosk.Model(model_path=path)
+    timings["load"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    if warmup:
+        rec = vosk.KaldiRecognizer(model, FRAME_RATE)
+        rec.AcceptWaveform((_warmup_audio() * 32767).astype(np.int16).tobytes())
+        rec.FinalResult()
+    timings["warmup"] = time.perf_counter() - start
+
+    logger.info("Vosk model %s: %s", name, _format(timings))
+    return model, timings
+
+
+def _import(name, timings):
+    '''
+    Imports the module and records the time in timings["import"], only if it was not imported
+    before: the import cost of a module loaded at startup belongs to the startup.
+    '''
+    if name in sys.modules:
+        return sys.modules[name]
+    start = time.perf_counter()
+    module = importlib.import_module(name)
+    timings["import"] = time.perf_counter() - start
+    return module
+
+
+def _format(timings) -> str:
+    return ", ".join(f"{step} {seconds:.2f} s" for step, seconds in timings.items())
+
+
+def _warmup_audio() -> np.ndarray:
+    '''
+    Low-level noise rather than digital silence, so the decoder actually runs.
+    '''
+    rng = np.random.default_rng(0)
+    return (rng.standard_normal(FRAME_RATE * WARMUP_SECONDS) * 0.01).astype(np.float32)
@@ -0,0 +1,288 @@
+from concurrent.futures import ThreadPoolExecutor
+import json
+import threading
+import time
+import numpy as np
+from include.DecodeProfile import DecodeProfile
+from include.Commands import SpeechState, COMMAND_TABLE, COMMAND_TABLE_EN_DE, find_command, match_command, build_grammar
+from include.AudioCapture import AudioCapture
+from include.AudioFrontend import pcm16_to_float32
+from include.AudioSource import create_audio_source
+from include.CommandProcessor import CommandProcessor
+from include.CommandQueue import CommandQueue
+from include.Metrics import METRICS
+from include.ModelLoader import load_vosk_model
+from include.WhisperEngine import load_whisper_engine, DEFAULT_ENGINE
+from include.SequenceControl import SequenceControl, SEQUENCES
+from include.SlidingWindow import DuplicateFilter
+from include.VoiceActivity import VoiceActivityDetector
+from include.WhisperBatcher import WhisperBatcher, MAX_WAIT_SECONDS
+
+CHUNK = 1024
+FRAME_RATE = 16000
+# Audio handed to a Vosk recognizer per decode task
+VOSK_CHUNK_SECONDS = 0.25
+STABLE_PARTIALS = 2
+# (window seconds, hop seconds) of the Whisper windows
+WHISPER_WINDOW = (3, 1)
+POLL_SECONDS = 0.02
+# Commands that waited longer for dispatch are dropped, except stop
+COMMAND_MAX_AGE = 3.0
+# Seconds stop() waits for a station command thread to send its queued commands
+PROCESSOR_JOIN_SECONDS = 5.0
+
+class VoskStream:
+    '''
+    Per-station Kaldi recognizer on a shared vosk.Model. Only the recognizer state is per
+    stream, so a station costs a few MB instead of a model copy. Commands are reported as
+    soon as they are stable in consecutive partial results.
+    '''
+    def __init__(self, model, command_table=COMMAND_TABLE, grammar=True) -> None:
+        from vosk import KaldiRecognizer
+        if grammar:
+            self.__rec = KaldiRecognizer(model, FRAME_RATE, build_grammar(command_table))
+        else:
+            self.__rec = KaldiRecognizer(model, FRAME_RATE)
+        self.__command_table = command_table
+        self.frames = int(FRAME_RATE * VOSK_CHUNK_SECONDS)
+        self.hop = self.frames
+        self.__emitted_words = 0
+        self.__candidate = None
+        self.__candidate_count = 0
+
+    def accept(self, pcm, start, end):
+        '''
+        Feeds the next chunk, returns the state of a newly recognized command or None.
+        '''
+        with METRICS.timer("transcribe"):
+            final = self.__rec.AcceptWaveform(pcm.tobytes())
+            result = json.loads(self.__rec.Result() if final else self.__rec.PartialResult())
+        if final:
+            with METRICS.timer("intent"):
+                position, state = find_command(result["text"].split(), self.__command_table, self.__emitted_words)
+            self.__emitted_words = 0
+            self.__candidate = None
+            self.__candidate_count = 0
+            return state
+
+        with METRICS.timer("intent"):
+            position, state = find_command(result["partial"].split(), self.__command_table, self.__emitted_words)
+        if state is None:
+            self.__candidate = None
+            self.__candidate_count = 0
+            return None
+        if (position, state) == self.__candidate:
+            self.__candidate_count += 1
+        else:
+            self.__candidate = (position, state)
+            self.__candidate_count = 1
+        if self.__candidate_count < STABLE_PARTIALS:
+            return None
+        self.__emitted_words = position
+        self.__candidate = None
+        self.__candidate_count = 0
+        return state
+
+
+class WhisperStream:
+    '''
+    Per-station overlapping windows transcribed by a shared Whisper model. The voice activity
+    detector and the duplicate filter are per station, the model is not. With a batcher the
+    windows of all stations that are ready at the same time are decoded in one batch.
+
+    Without a batcher the streams must share decode_lock: Whisper installs its KV cache as
+    hooks on the shared decoder modules, so concurrent decodes would corrupt each other.
+    '''
+    def __init__(self, model, window=WHISPER_WINDOW, command_table=COMMAND_TABLE_EN_DE, vad=True, batcher=None,
+                 decode_profile=None, decode_lock=None) -> None:
+        self.__model = model
+        self.__decode_lock = decode_lock or threading.Lock()
+        self.__profile = decode_profile
+        self.__batcher = batcher
+        self.__command_table = command_table
+        self.frames = int(FRAME_RATE * window[0])
+        self.hop = int(FRAME_RATE * window[1])
+        self.__vad = VoiceActivityDetector(FRAME_RATE) if vad else None
+        self.__duplicates = DuplicateFilter()
+
+    def accept(self, pcm, start, end):
+        with METRICS.timer("encode"):
+            audio = pcm16_to_float32(pcm, 1, FRAME_RATE)
+        if self.__vad is not None:
+            with METRICS.timer("vad"):
+                audio = self.__vad.trim(audio)
+            if audio is None:
+                return None
+        if self.__batcher is not None:
+            text = self.__batcher.transcribe(audio)
+        else:
+            with self.__decode_lock, METRICS.timer("transcribe"):
+                if self.__profile is not None:
+                    text = self.__profile.transcribe(self.__model, audio)["text"]
+                else:
+                    text = self.__model.transcribe(audio, fp16=False)["text"]
+        with METRICS.timer("intent"):
+            state = match_command(text, self.__command_table)
+        if state is not None and self.__duplicates.accept(state, start, end):
+            return state
+        return None
+
+
+class Station(SequenceControl):
+    '''
+    One chair: its audio source, REST endpoint, recognizer stream and command state.
+    Decoding is done by the server's worker pool, at most one task per station at a time,
+    dispatching by the station's own command thread.
+    '''
+    def __init__(self, logger, name, audio_source, ip_addr, port, stream, sequences=SEQUENCES,
+                 command_max_age=COMMAND_MAX_AGE, priority_stop=True) -> None:
+        self.__logger = logger
+        SequenceControl.__init__(self, logger, sequences, name)
+        self.name = name
+        self.capture = AudioCapture(logger, audio_source, CHUNK, rate=FRAME_RATE)
+        self.command_queue = CommandQueue(max_age=command_max_age, stop_lane=priority_stop)
+        self.address = (ip_addr, port)
+        self.__stream = stream
+        self.__pcm = np.empty((stream.frames, 1), dtype=np.int16)
+        self.__cursor = None
+        self.__currentstate = SpeechState.idle
+        self.busy = False
+        self.skipped_hops = 0
+
+    def get_current_state(self) -> SpeechState:
+        return self.__currentstate
+
+    def start(self) -> None:
+        self.restart_capture()
+        self.connect(*self.address)
+
+    def restart_capture(self) -> None:
+        self.capture.stop()
+        # A file source may be captured entirely before start() returns
+        self.__cursor = self.capture.position
+        self.capture.start()
+
+    def close(self) -> None:
+        self.capture.stop()
+        self.disconnect()
+
+    @property
+    def finished(self) -> bool:
+        '''
+        True when a finite source has ended and its last full window was decoded.
+        '''
+        return self.capture.finite and not self.capture.is_active() and not self.ready()
+
+    def ready(self) -> bool:
+        '''
+        Returns True when the next window is fully captured.
+        '''
+        return self.__cursor is not None and self.capture.position >= self.__cursor + self.__stream.frames
+
+    def decode(self) -> None:
+        if self.capture.realtime:
+            # Skip to the latest window instead of accumulating latency
+            behind = (self.capture.position - self.__cursor - self.__stream.frames) // self.__stream.hop
+            if behind > 0:
+                self.__cursor += behind * self.__stream.hop
+                self.skipped_hops += behind
+        start = self.__cursor
+        self.capture.read(start, self.__stream.frames, self.__pcm)
+        self.__cursor += self.__stream.hop
+        state = self.__stream.accept(self.__pcm, start, start + self.__stream.frames)
+        if state is None:
+            return
+        self.__logger.info("[%s] Command recognized: %s", self.name, state.name)
+        METRICS.counter("mcms_recognitions_total", command=state.name, station=self.name).inc()
+        self.command_queue.put(state)
+        self.__currentstate = state
+
+
+class StationServer:
+    '''
+    Serves many stations from one process: the model is loaded once, each station gets a
+    lightweight recognizer stream, and decoding is scheduled over a bounded worker pool.
+    '''
+    def __init__(self, logger, config) -> None:
+        self.__logger = logger
+        backend = config.get("backend", "vosk")
+        if backend == "vosk":
+            model, _ = load_vosk_model(logger, config.get("model", "vosk-model-small-en-us-0.15"))
+            create_stream = lambda: VoskStream(model, grammar=config.get("grammar", True))
+        elif backend == "whisper":
+            model, _ = load_whisper_engine(logger, config.get("model", "tiny"), config.get("engine", DEFAULT_ENGINE))
+            profile = None
+            if config.get("fast_decode", True):
+                profile = DecodeProfile(config.get("languages", ("en", "de")), COMMAND_TABLE_EN_DE)
+            batcher = None
+            if config.get("batch_size", 1) > 1 and config.get("engine") != "ctranslate2":
+                options = profile.decoding_options() if profile else {}
+                batcher = WhisperBatcher(logger, model, config["batch_size"], config.get("batch_wait", MAX_WAIT_SECONDS),
+                                         languages=profile.languages if profile else (), **options)
+            # One decode at a time on the shared model, the workers still overlap encoding and VAD
+            decode_lock = threading.Lock()
+            create_stream = lambda: WhisperStream(model, tuple(config.get("window", WHISPER_WINDOW)),
+                                                  vad=config.get("vad", True), batcher=batcher, decode_profile=profile,
+                                                  decode_lock=decode_lock)
+        else:
+            raise ValueError(f"Unknown backend '{backend}'")
+
+        self.stations = []
+        for entry in config["stations"]:
+            ip_addr, _, port = entry["rest"].rpartition(":")
+            self.stations.append(Station(logger, entry["name"], create_audio_source(logger, entry["audio"]),
+                                         ip_addr, int(port), create_stream(), entry.get("sequences", SEQUENCES),
+                                         config.get("command_max_age", COMMAND_MAX_AGE), config.get("priority_stop", True)))
+        workers = config.get("workers") or min(len(self.stations), 4)
+        self.__pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="decode")
+        self.__running = False
+        self.__processors = []
+        self.__logger.info("Serving %d stations with a shared %s model and %d decode workers",
+                           len(self.stations), backend, workers)
+
+    def run(self) -> None:
+        self.__running = True
+        for station in self.stations:
+            station.start()
+            processor = CommandProcessor(self.__logger, station.command_queue, station, *station.address)
+            thread = threading.Thread(target=processor.run, name=f"dispatch-{station.name}", daemon=True)
+            thread.start()
+            self.__processors.append(thread)
+
+        while self.__running:
+            if all(station.finished and not station.busy for station in self.stations):
+                self.__logger.info("All station sources have ended")
+                break
+            for station in self.stations:
+                if station.busy:
+                    continue
+                if not station.capture.is_active() and not station.capture.finite:
+                    station.restart_capture()
+                if station.ready():
+                    station.busy = True
+                    self.__pool.submit(self.__decode, station)
+            time.sleep(POLL_SECONDS)
+
+    def __decode(self, station) -> None:
+        try:
+            station.decode()
+        except Exception as err:
+            self.__logger.error("[%s] Could not request results; %s", station.name, err)
+        finally:
+            station.busy = False
+
+    def stop(self) -> None:
+        self.__running = False
+        self.__pool.shutdown(wait=True)
+        for station in self.stations:
+            station.command_queue.put(SpeechState.error)
+        # Let the command threads dispatch what was recognized before the stations close
+        for thread in self.__processors:
+            thread.join(timeout=PROCESSOR_JOIN_SECONDS)
+        for station in self.stations:
+            station.close()
+
+
+def load_config(path) -> dict:
+    with open(path) as file:
+        return json.load(file)
@@ -0,0 +1,171 @@
+import hashlib
+import http.client
+import os
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from include.Metrics import METRICS
+
+SEQUENCE_LONG = 1
+SEQUENCE_SHORT = 2
+CONNECT_TIMEOUT = 1.0
+READ_TIMEOUT = 5.0
+POOL_SIZE = 4
+STOP_TIMEOUT = 2.0
+
+class StartCancelled(Exception):
+    '''
+    Raised by start_sequence when a stop was requested while the start was in flight.
+    '''
+
+
+class _Reply:
+    '''
+    The parts of a requests.Response the callers use, for requests sent over http.client.
+    '''
+    def __init__(self, status_code, text) -> None:
+        self.status_code = status_code
+        self.text = text
+        self.ok = status_code < 400
+
+
+class RestDispatcher:
+    '''
+    Client for the massage REST server. Requests go through one keep-alive connection pool
+    with explicit timeouts. Sequence assets are uploaded once and only uploaded again when
+    the content of the asset file changes, so starting a sequence is a single PUT.
+    on_failure is called when a request gets no response, e.g. to locate the server again.
+
+    Stops do not share the pool with starts: they go over a connection of their own that is
+    opened ahead of time, so a stop never waits for a slow start or a TCP handshake.
+    cancel_starts() makes starts in flight give up before their next request, and a start
+    whose PUT was already sent is stopped again once it returns.
+    '''
+    def __init__(self, logger, ip_addr, port, sequences, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT), on_failure=None) -> None:
+        self.__logger = logger
+        self.__on_failure = on_failure
+        self.address = (ip_addr, port)
+        self.__base_url = f"http://{ip_addr}:{port}"
+        # sequence number -> asset file path
+        self.__sequences = dict(sequences)
+        self.__timeout = timeout
+        self.__session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE, max_retries=0)
+        self.__session.mount("http://", adapter)
+        # sequence number -> ((mtime, size), sha256) of the last uploaded asset
+        self.__uploaded = {}
+        # Incremented by every stop, a start that sees it change was overtaken
+        self.__generation = 0
+        self.__stop_connection = None
+        self.__stop_lock = threading.Lock()
+
+    def close(self) -> None:
+        self.__session.close()
+        with self.__stop_lock:
+            if self.__stop_connection is not None:
+                self.__stop_connection.close()
+
+    def upload_sequences(self) -> None:
+        for sequence in self.__sequences:
+            self.__ensure_uploaded(sequence)
+        self.warm_stop()
+
+    def warm_stop(self) -> None:
+        '''
+        Opens the connection stops are sent on, if it is not open already.
+        '''
+        with self.__stop_lock:
+            try:
+                self.__stop_connect()
+            except OSError as err:
+                self.__logger.warning("Cannot open the stop connection, opening it on the next stop: %s", err)
+
+    def cancel_starts(self) -> None:
+        self.__generation += 1
+
+    def start_sequence(self, sequence) -> requests.Response:
+        generation = self.__generation
+        self.__ensure_uploaded(sequence)
+        self.__check_generation(generation, sequence)
+        response = self.__put(f"/sequence/{sequence}/start")
+        if not response.ok:
+            # The server may have restarted and lost the sequence, upload it again once
+            self.__uploaded.pop(sequence, None)
+            self.__ensure_uploaded(sequence)
+            self.__check_generation(generation, sequence)
+            response = self.__put(f"/sequence/{sequence}/start")
+        if generation != self.__generation:
+            # The stop may have reached the server before this start did
+            self.stop_sequence(sequence)
+            METRICS.counter("mcms_starts_cancelled_total").inc()
+            raise StartCancelled(f"Start of sequence {sequence} overtaken by a stop")
+        return response
+
+    def stop_sequence(self, sequence) -> _Reply:
+        path = f"/sequence/{sequence}/stop"
+        start_time = time.perf_counter()
+        with self.__stop_lock:
+            # A kept-alive connection may have been closed by the server meanwhile, then retry once
+            reused = self.__stop_connection is not None and self.__stop_connection.sock is not None
+            for attempt in range(2):
+                try:
+                    self.__stop_connect()
+                    self.__stop_connection.request("PUT", path)
+                    response = self.__stop_connection.getresponse()
+                    reply = _Reply(response.status, response.read().decode("utf-8", "replace"))
+                    break
+                except (http.client.HTTPException, OSError):
+                    self.__stop_connection.close()
+                    if attempt or not reused:
+                        METRICS.counter("mcms_dispatch_errors_total").inc()
+                        if self.__on_failure:
+                            self.__on_failure()
+                        raise
+        elapsed = time.perf_counter() - start_time
+        METRICS.observe_stage("dispatch", elapsed)
+        self.__logger.info("PUT %s -> %d in %.1f ms", path, reply.status_code, elapsed * 1000)
+        return reply
+
+    def __stop_connect(self) -> None:
+        if self.__stop_connection is None:
+            self.__stop_connection = http.client.HTTPConnection(*self.address, timeout=STOP_TIMEOUT)
+        if self.__stop_connection.sock is None:
+            self.__stop_connection.connect()
+
+    def __check_generation(self, generation, sequence) -> None:
+        if generation != self.__generation:
+            METRICS.counter("mcms_starts_cancelled_total").inc()
+            raise StartCancelled(f"Start of sequence {sequence} cancelled by a stop")
+
+    def __ensure_uploaded(self, sequence) -> None:
+        path = self.__sequences[sequence]
+        stat = os.stat(path)
+        signature = (stat.st_mtime_ns, stat.st_size)
+        known = self.__uploaded.get(sequence)
+        if known and known[0] == signature:
+            return
+
+        with open(path, "rb") as file:
+            json_data = file.read()
+        digest = hashlib.sha256(json_data).hexdigest()
+        if not known or known[1] != digest:
+            response = self.__put(f"/sequence/{sequence}", data=json_data,
+                                  headers={'Content-Type': 'application/json'})
+            response.raise_for_status()
+            self.__logger.info("Uploaded sequence %d from %s (sha256 %s)", sequence, path, digest[:12])
+        self.__uploaded[sequence] = (signature, digest)
+
+    def __put(self, path, **kwargs) -> requests.Response:
+        start_time = time.perf_counter()
+        try:
+            response = self.__session.put(self.__base_url + path, timeout=self.__timeout, **kwargs)
+        except requests.RequestException:
+            METRICS.counter("mcms_dispatch_errors_total").inc()
+            if self.__on_failure:
+                self.__on_failure()
+            raise
+        elapsed = time.perf_counter() - start_time
+        METRICS.observe_stage("dispatch", elapsed)
+        self.__logger.info("PUT %s -> %d in %.1f ms", path, response.status_code, elapsed * 1000)
+        return response
@@ -0,0 +1,124 @@
+import threading
+import time
+from include.RestDispatcher import RestDispatcher, SEQUENCE_LONG, SEQUENCE_SHORT
+
+SEQUENCES = {
+    SEQUENCE_LONG: "assets/sample_long.json",
+    SEQUENCE_SHORT: "assets/sample_short.json",
+}
+SHOP_SEQUENCES = {
+    SEQUENCE_LONG: "assets/shop_massage_long.json",
+    SEQUENCE_SHORT: "assets/shop_massage_short.json",
+}
+
+class SequenceControl:
+    '''
+    REST side shared by the speech controllers: connect() and the start_mode_long,
+    start_mode_short and stop_mode methods called by the entry scripts and the
+    CommandProcessor. They return True when the server accepted the request and False when
+    it failed. stop_mode stops the sequence last started, after making starts still in flight
+    give up, since a later recognized mode may never have been dispatched. It returns None
+    when nothing was started, no request is sent then. Stops may come from another thread
+    than the starts: stop_mode uses the dispatcher the starts went through and never waits
+    for an upload.
+
+    Controllers call SequenceControl.__init__() in their constructor and provide
+    get_current_state() for the log messages.
+    '''
+    def __init__(self, logger, sequences=SEQUENCES, name=None) -> None:
+        self.__logger = logger
+        self.__sequences = sequences
+        self.__prefix = f"[{name}] " if name else ""
+        self.__dispatcher = None
+        self.__discovery = None
+        # Sequence last started through the REST server, the one stop_mode stops
+        self.__sequence = None
+        # Guards replacing the dispatcher, the stop lane and the start thread both use it
+        self.__connect_lock = threading.Lock()
+
+    def connect(self, ip_addr, port, discovery=None) -> RestDispatcher:
+        '''
+        Returns the dispatcher for the REST server, creating it and uploading the sequences on first use.
+        Requests that get no response make the ServiceDiscovery, if given, locate the server again.
+        '''
+        with self.__connect_lock:
+            if discovery is not None:
+                self.__discovery = discovery
+            dispatcher = self.__dispatcher
+            created = dispatcher is None or dispatcher.address != (ip_addr, port)
+            if created:
+                if dispatcher:
+                    # Starts in flight on the old server give up
+                    dispatcher.cancel_starts()
+                    dispatcher.close()
+                on_failure = self.__discovery.invalidate if self.__discovery else None
+                dispatcher = RestDispatcher(self.__logger, ip_addr, port, self.__sequences, on_failure=on_failure)
+                self.__dispatcher = dispatcher
+        if created:
+            # Outside the lock, a stop must not wait for it
+            try:
+                dispatcher.upload_sequences()
+            except Exception as err:
+                self.__logger.warning('%sError: %s----Cannot upload sequences, retrying on the next command',
+                                      self.__prefix, err)
+        return dispatcher
+
+    def disconnect(self) -> None:
+        with self.__connect_lock:
+            if self.__dispatcher:
+                self.__dispatcher.close()
+                self.__dispatcher = None
+
+    def start_mode_long(self, ip_addr, port) -> bool:
+        return self.__start(ip_addr, port, SEQUENCE_LONG, "long")
+
+    def start_mode_short(self, ip_addr, port) -> bool:
+        return self.__start(ip_addr, port, SEQUENCE_SHORT, "short")
+
+    def stop_mode(self, ip_addr, port):
+        start_time = time.time()
+        with self.__connect_lock:
+            dispatcher = self.__dispatcher
+        if dispatcher is None:
+            # No start went out
+            return None
+        # Starts still in flight give up
+        dispatcher.cancel_starts()
+        sequence = self.__sequence
+        if sequence is None:
+            return None
+        ok = False
+        try:
+            self.__logger.info("%sStop mode. %s", self.__prefix, self.get_current_state())
+            response = dispatcher.stop_sequence(sequence)
+            self.__logger.info("%sSequence status %d %s", self.__prefix, response.status_code, response.text)
+            ok = response.ok
+            if ok:
+                self.__sequence = None
+        except Exception as err:
+            self.__logger.warning('%sError: %s----Cannot stop mode, current state is %s', self.__prefix, err,
+                                  self.get_current_state().name)
+
+        self.__logger.info(f"{self.__prefix}Execution time of stop mode: {time.time() - start_time:.2f} seconds")
+        return ok
+
+    def __start(self, ip_addr, port, sequence, mode) -> bool:
+        start_time = time.time()
+        self.__logger.info("%sCommand recognized: Activated %s Massage mode, %s", self.__prefix, mode.capitalize(),
+                           self.get_current_state())
+        ok = False
+        try:
+            self.__sequence = sequence
+            response = self.connect(ip_addr, port).start_sequence(sequence)
+            self.__logger.info("%sSequence status %d %s", self.__prefix, response.status_code, response.text)
+            ok = response.ok
+            if ok:
+                # A stop sent while the request was in flight may have cleared it, stop_mode
+                # must still know what is running
+                self.__sequence = sequence
+        except Exception as err:
+            self.__logger.warning('%sError: %s----Cannot start mode %s, current state is %s', self.__prefix, err, mode,
+                                  self.get_current_state().name)
+
+        self.__logger.info(f"{self.__prefix}Execution time of {mode} mode: {time.time() - start_time:.2f} seconds")
+        return ok
@@ -0,0 +1,148 @@
+import json
+import os
+import socket
+import threading
+import time
+
+PROBE_TIMEOUT = 0.2
+RETRY_SECONDS = 2.0
+CACHE_PATH = os.path.join(os.path.expanduser("~"), ".cache", "mcms", "rest_service.json")
+
+class ServiceDiscovery:
+    '''
+    Locates the REST server on a known port without walking all sockets of the host.
+    Candidates are tried in order: the explicit override (MCMS_REST_ADDRESS, "ip" or
+    "ip:port"), the last address that answered, the loopback address and the addresses of
+    the local interfaces, each with a short TCP connect probe.
+
+    When dispatching fails, invalidate() re-resolves in a background thread until the server
+    answers again, so a restarted or moved REST server is picked up without a restart.
+    '''
+    def __init__(self, logger, port, override=None, cache_path=CACHE_PATH) -> None:
+        self.__logger = logger
+        self.__port = port
+        self.__override = override if override is not None else os.environ.get("MCMS_REST_ADDRESS")
+        self.__cache_path = cache_path
+        self.__address = None
+        # False while the address is only a guess no server answered on
+        self.__verified = False
+        self.__lock = threading.Lock()
+        self.__resolving = False
+        self.resolutions = 0
+
+    @property
+    def address(self):
+        '''
+        Returns the current (ip, port), resolving it first if needed.
+        '''
+        if self.__address is None:
+            self.resolve()
+        return self.__address
+
+    def resolve(self):
+        '''
+        Returns the IP of the first candidate that accepts a connection. If none does, the
+        best guess is returned and the search continues in the background.
+        '''
+        start = time.perf_counter()
+        found = self.__discover()
+        if found is None:
+            fallback = self.__candidates()[0]
+            self.__logger.warning("No REST server answering on port %d, using %s:%d and retrying in the background",
+                                  self.__port, *fallback)
+            self.__address = fallback
+            self.invalidate()
+            return fallback[0]
+        self.__logger.info("REST server found at %s:%d in %.1f ms", *found, (time.perf_counter() - start) * 1000)
+        return found[0]
+
+    def invalidate(self) -> None:
+        '''
+        Called when a request failed: re-resolves in the background until the server answers.
+        '''
+        self.__verified = False
+        with self.__lock:
+            if self.__resolving:
+                return
+            self.__resolving = True
+        threading.Thread(target=self.__resolve_loop, name="service-discovery", daemon=True).start()
+
+    def __resolve_loop(self) -> None:
+        try:
+            while self.__discover() is None:
+                time.sleep(RETRY_SECONDS)
+        finally:
+            with self.__lock:
+                self.__resolving = False
+
+    def __discover(self):
+        for address in self.__candidates():
+            if probe(*address):
+                if address != self.__address or not self.__verified:
+                    if self.__address is not None and address != self.__address:
+                        self.__logger.info("REST server moved to %s:%d", *address)
+                    self.__address = address
+                    self.__verified = True
+                    self.resolutions += 1
+                    self.__save(address)
+                return address
+        return None
+
+    def __candidates(self):
+        candidates = []
+        if self.__override:
+            ip_addr, _, port = self.__override.partition(":")
+            candidates.append((ip_addr, int(port or self.__port)))
+        cached = self.__load()
+        if cached:
+            candidates.append(cached)
+        candidates.append(("127.0.0.1", self.__port))
+        candidates.extend((ip_addr, self.__port) for ip_addr in local_addresses())
+        # Keep the order, drop duplicates
+        return list(dict.fromkeys(candidates))
+
+    def __load(self):
+        try:
+            with open(self.__cache_path) as file:
+                cached = json.load(file)
+            return (cached["ip"], int(cached["port"]))
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def __save(self, address) -> None:
+        try:
+            os.makedirs(os.path.dirname(self.__cache_path), exist_ok=True)
+            with open(self.__cache_path, "w") as file:
+                json.dump({"ip": address[0], "port": address[1]}, file)
+        except OSError as err:
+            self.__logger.warning("Cannot cache the REST server address in %s: %s", self.__cache_path, err)
+
+
+def probe(ip_addr, port, timeout=PROBE_TIMEOUT) -> bool:
+    '''
+    Returns True if something accepts TCP connections on ip_addr:port.
+    '''
+    try:
+        with socket.create_connection((ip_addr, port), timeout=timeout):
+            return True
+    except OSError:
+        return False
+
+
+def local_addresses():
+    '''
+    Returns the IPv4 addresses of this host without sending any traffic.
+    '''
+    addresses = []
+    try:
+        addresses.extend(socket.gethostbyname_ex(socket.gethostname())[2])
+    except OSError:
+        pass
+    try:
+        # Connecting a UDP socket only selects the outgoing interface
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+            s.connect(("8.8.8.8", 80))
+            addresses.append(s.getsockname()[0])
+    except OSError:
+        pass
+    return [address for address in dict.fromkeys(addresses) if not address.startswith("127.")]
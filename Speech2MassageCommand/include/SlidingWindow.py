@@ -0,0 +1,91 @@
+import numpy as np
+
+class SlidingWindow:
+    '''
+    Cuts overlapping windows of window_seconds, advancing by hop_seconds, out of an AudioCapture.
+    Capture keeps running in its callback while a window is decoded. If decoding is slower than
+    the hop, the scheduler jumps ahead to the most recent window and counts the skipped hops,
+    so latency does not pile up. Sources that are not real time are never skipped.
+    '''
+    def __init__(self, logger, capture, window_seconds, hop_seconds) -> None:
+        self.__logger = logger
+        self.__capture = capture
+        self.window_frames = int(capture.rate * window_seconds)
+        self.hop_frames = int(capture.rate * hop_seconds)
+        self.__window = np.empty((self.window_frames, capture.channels), dtype=np.int16)
+        self.__end = None
+        self.__start = None
+        self.skipped_hops = 0
+
+    def reset(self, start=None) -> None:
+        '''
+        Starts over from the capture position start, by default the current one, e.g. after
+        the capture was restarted.
+        '''
+        self.__end = None
+        self.__start = start
+
+    def next(self):
+        '''
+        Blocks until the next window is captured and returns (window, start, end) where start and
+        end are capture positions in frames. The returned array is reused by the next call.
+        '''
+        if self.__end is None:
+            start = self.__capture.position if self.__start is None else self.__start
+            end = start + self.window_frames
+        else:
+            hops = 1
+            if self.__capture.realtime:
+                hops = max(1, (self.__capture.position - self.__end) // self.hop_frames)
+            if hops > 1:
+                self.skipped_hops += hops - 1
+                self.__logger.warning("Decoder fell behind, skipped %d hop(s) (total %d)", hops - 1, self.skipped_hops)
+            end = self.__end + hops * self.hop_frames
+
+        self.__capture.read(end - self.window_frames, self.window_frames, self.__window)
+        self.__end = end
+        return self.__window, end - self.window_frames, end
+
+    def next_batch(self, max_windows):
+        '''
+        Like next(), but when the decoder fell behind returns up to max_windows consecutive
+        windows that are already captured, oldest first, so they can be decoded as one batch.
+        Only hops beyond max_windows are skipped. Returns a list of (window copy, start, end).
+        '''
+        if self.__end is None:
+            window, start, end = self.next()
+            return [(window.copy(), start, end)]
+
+        ready = max(1, (self.__capture.position - self.__end) // self.hop_frames)
+        count = min(ready, max_windows)
+        skipped = ready - count if self.__capture.realtime else 0
+        if skipped:
+            self.skipped_hops += skipped
+            self.__logger.warning("Decoder fell behind, skipped %d hop(s) (total %d)", skipped, self.skipped_hops)
+
+        batch = []
+        for index in range(count):
+            end = self.__end + (skipped + index + 1) * self.hop_frames
+            window = np.empty_like(self.__window)
+            self.__capture.read(end - self.window_frames, self.window_frames, window)
+            batch.append((window, end - self.window_frames, end))
+        self.__end = batch[-1][2]
+        return batch
+
+
+class DuplicateFilter:
+    '''
+    Suppresses a command that is detected again in a window overlapping the window it was
+    last detected in, since overlapping windows hear the same utterance several times.
+    '''
+    def __init__(self) -> None:
+        self.__last_end = {}
+        self.suppressed = 0
+
+    def accept(self, state, start, end) -> bool:
+        last_end = self.__last_end.get(state)
+        self.__last_end[state] = end
+        if last_end is not None and start < last_end:
+            self.suppressed += 1
+            return False
+        return True
@@ -1,122 +1,157 @@
 import speech_recognition as sr
-from enum import Enum
-import requests
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import queue
+import threading
 import time
+from include.Commands import SpeechState
+from include.Metrics import METRICS
+from include.HedgedRecognizer import HedgedRecognizer, cloud_backend
+from include.SequenceControl import SequenceControl
+from include.AudioCapture import AudioCapture
+from include.AudioSource import PyAudioSource
 
-class SpeechState(Enum):
-    idle = 0
-    mode_long = 1
-    mode_short = 2
-    stop = 3
-    error = 4
+CHUNK = 1024
+FRAME_RATE = 16000
+# Ambient noise measured once before the first utterance
+CALIBRATION_SECONDS = 1.0
+# In background mode the threshold is measured again from the captured audio this often,
+# taking the quietest chunks of the last NOISE_WINDOW_SECONDS as the noise
+RECALIBRATE_SECONDS = 60.0
+NOISE_WINDOW_SECONDS = 5.0
+NOISE_PERCENTILE = 20
+# Longest utterance sent for recognition
+PHRASE_TIME_LIMIT = 5.0
+# Recognition requests in flight at once and their timeout
+MAX_IN_FLIGHT = 3
+REQUEST_TIMEOUT = 5.0
 
-class SpeechController:
-    def __init__(self, logger) -> None:
+class CaptureSource(sr.AudioSource):
+    '''
+    speech_recognition view of an AudioCapture, used in place of sr.Microphone so the cloud
+    controller can listen to any AudioSource. Entering it continues where the last utterance ended,
+    the capture is only started again after stop(): a file source that ended still has its
+    captured audio to be read.
+    '''
+    def __init__(self, capture) -> None:
+        self.capture = capture
+        self.SAMPLE_RATE = capture.rate
+        self.SAMPLE_WIDTH = 2
+        self.CHUNK = capture.chunk
+        self.stream = None
+        self.__started = False
+        self.__cursor = 0
+        self.__buffer = np.empty((capture.chunk, capture.channels), dtype=np.int16)
+
+    def __enter__(self):
+        if not self.__started:
+            self.capture.stop()
+            # A file source may be captured entirely before start() returns
+            self.__cursor = self.capture.position
+            self.capture.start()
+            self.__started = True
+        self.stream = self
+        return self
+
+    def stop(self) -> None:
+        self.__started = False
+        self.capture.stop()
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.stream = None
+
+    def read(self, frames) -> bytes:
+        if frames > len(self.__buffer):
+            self.__buffer = np.empty((frames, self.capture.channels), dtype=np.int16)
+        self.__cursor = self.capture.read(self.__cursor, frames, self.__buffer)
+        return self.__buffer[:frames].tobytes()
+
+
+class SpeechController(SequenceControl):
+    '''
+    Recognition with the Google Web Speech API. The noise threshold is calibrated once and
+    then follows the background (dynamic energy threshold).
+
+    With background the audio is listened to continuously in a background thread and every
+    utterance is sent for recognition right away, with at most MAX_IN_FLIGHT requests at a
+    time, so no audio is missed while a request is in flight. recognize_speech() returns the
+    commands in the order they were spoken, whichever request finished first. A capture error
+    is returned as SpeechState.error in that order too; a live capture is restarted, the end
+    of a file or stdin sets finished.
+
+    With a local_backend (see include/HedgedRecognizer.py) every utterance is also decoded
+    locally and the first confident command of the two is taken. While the cloud is slow or
+    unreachable only the local backend is used.
+    '''
+    def __init__(self, logger, audio_source=None, background=False, local_backend=None) -> None:
         self.__logger = logger
+        SequenceControl.__init__(self, logger)
         self.__currentstate = SpeechState.idle
         self.__previousstate = SpeechState.idle
         self.__recognizer = sr.Recognizer()
+        self.__recognizer.dynamic_energy_threshold = True
+        self.__recognizer.operation_timeout = REQUEST_TIMEOUT
+        self.__calibrated = False
+        self.__hedged = None
+        if local_backend is not None:
+            self.__hedged = HedgedRecognizer(logger, cloud_backend(self.__recognizer), local_backend)
+        if audio_source is None:
+            audio_source = PyAudioSource(logger)
+        self.__source = CaptureSource(AudioCapture(logger, audio_source, CHUNK, rate=FRAME_RATE))
+        self.__background = background
+        self.__listener = None
+        self.__listening = False
+        self.__executor = None
+        self.__slots = threading.BoundedSemaphore(MAX_IN_FLIGHT)
+        self.__in_flight = METRICS.gauge("mcms_cloud_requests_in_flight")
+        # Recognized states in utterance order, and finished utterances waiting for earlier ones
+        self.__results = queue.Queue()
+        self.__finished = {}
+        self.__heard = 0
+        self.__answered = 0
+        self.__delivered = 0
+        self.__lock = threading.Lock()
+        # Set when a finite source (file, stdin) ended
+        self.finished = False
+
+    def close(self) -> None:
+        self.__listening = False
+        if self.__listener:
+            self.__listener.join()
+            self.__listener = None
+        if self.__executor:
+            self.__executor.shutdown(wait=False)
+        if self.__hedged:
+            self.__hedged.close()
+            self.__logger.info("Hedged recognition: %s", self.__hedged.statistics())
+        self.__source.stop()
 
     def get_current_state(self) -> SpeechState:
         '''
         Returns the current state of the SpeechController.
         '''
         return self.__currentstate
-    
-    
-    def start_mode_long(self, ip_addr, port):
-        start_time = time.time()
-        self.__logger.info("Command recognized: Activated Long Massage mode, %s", self.__currentstate)
-
-        file_path = "assets/sample_long.json"
-        url = f"http://{ip_addr}:{port}/sequence/1"
-        headers = {'Content-Type': 'application/json'}
-
-        try: 
-            with open(file_path, "r") as file:
-                json_data = file.read()
-            response = requests.put(url, headers=headers, data=json_data)
-            url = f"{url}/start"
-            response = requests.put(url)
-            self.__logger.info("Sequence status %d -- %s", response.status_code, response.text)
-        except RuntimeError as err:
-            self.__logger.warning('Error: %s----Cannot start mode long, current state is %s', err, self.__currentstate.name)
-
-        end_time = time.time()
-        execution_time = end_time - start_time
-        self.__logger.info(f"Execution time of long mode: {execution_time:.2f} seconds")
-    
-    def start_mode_short(self, ip_addr, port):
-        start_time = time.time()
-        self.__logger.info("Command recognized: Activated Short Massage mode, %s", self.__currentstate)
-
-        file_path = "assets/sample_short.json"
-        url = f"http://{ip_addr}:{port}/sequence/2"
-        headers = {'Content-Type': 'application/json'}
-
-        try: 
-            with open(file_path, "r") as file:
-                json_data = file.read()            
-            response = requests.put(url, headers=headers, data=json_data)
-            url = f"{url}/start"
-            response = requests.put(url)
-            self.__logger.info("Sequence status %d %s", response.status_code, response.text)
-        except RuntimeError as err:
-            self.__logger.warning('Error: %s----Cannot start mode short, current state is %s', err, self.__currentstate.name)
-
-        end_time = time.time()
-        execution_time = end_time - start_time
-        self.__logger.info(f"Execution time of short mode: {execution_time:.2f} seconds")
-
-    def stop_mode(self, ip_addr, port):
-        start_time = time.time()
-        if self.__previousstate == SpeechState.mode_long:
-            url = f"http://{ip_addr}:{port}/sequence/1"
-        elif self.__previousstate == SpeechState.mode_short:
-            url = f"http://{ip_addr}:{port}/sequence/2"
-        else: 
-            return
-
-        try: 
-            self.__logger.info("Stop mode. %s", self.__currentstate)
-            url = f"{url}/stop"
-            response = requests.put(url)
-            self.__logger.info("Sequence status %d %s", response.status_code, response.text)
-        except RuntimeError as err:
-            self.__logger.warning('Error: %s----Cannot stop mode, current state is %s', err, self.__currentstate.name)
-
-        end_time = time.time()
-        execution_time = end_time - start_time
-        self.__logger.info(f"Execution time of stop mode: {execution_time:.2f} seconds")
 
     def recognize_speech(self) -> SpeechState:
+        if self.__background:
+            return self.recognize_speech_background()
+
         self.__logger.info("Running MCMS Speech Recognition using Google Cloud") 
-        with sr.Microphone() as source:
-            self.__logger.info("Listening on mic ....")
-            self.__recognizer.adjust_for_ambient_noise(source)
-            audio = self.__recognizer.listen(source)
+        with self.__source as source:
+            try:
+                if not self.__calibrated:
+                    self.__calibrate(source)
+                self.__logger.info("Listening on mic ....")
+                audio = self.__recognizer.listen(source, phrase_time_limit=PHRASE_TIME_LIMIT)
+            except Exception as e:
+                self.__fail(e)
+                self.__currentstate = SpeechState.error
+                return self.__currentstate
 
             try:
                 start_time = time.time()
                 # Recognize speech using Google Speech Recognition
-                command = self.__recognizer.recognize_google(audio)
-
-                # Check if the recognized command identifies "long"  
-                if "long" in command.lower():
-                    self.__currentstate = SpeechState.mode_long
-
-                # Check if the recognized command identifies "short"
-                elif "short" in command.lower():
-                    self.__currentstate = SpeechState.mode_short
-
-                # Check if the recognized command identifies "stop"
-                elif "stop" in command.lower():
-                    self.__currentstate = SpeechState.stop
-
-                else:
-                    self.__logger.warning("Command not recognized, previous state was %s. Setting current staate to idle", 
-                                          self.__previousstate)
-                    self.__currentstate = SpeechState.idle
+                self.__currentstate = self.__recognize_audio(audio)
 
             except sr.UnknownValueError:
                 print("Mic is listening, but could not understand")
@@ -132,4 +167,176 @@ class SpeechController:
             if self.__currentstate == SpeechState.mode_long or self.__currentstate == SpeechState.mode_short:
                 self.__previousstate = self.__currentstate;
             
-            return self.__currentstate
\ No newline at end of file
+            return self.__currentstate
+
+    def recognize_speech_background(self) -> SpeechState:
+        '''
+        Returns the state of the next recognized utterance, in the order they were spoken.
+        Starts the background listener on the first call.
+        '''
+        if self.__listener is None:
+            self.__start_listening()
+        self.__currentstate = self.__results.get()
+        if self.__currentstate == SpeechState.mode_long or self.__currentstate == SpeechState.mode_short:
+            self.__previousstate = self.__currentstate
+        return self.__currentstate
+
+    def __start_listening(self) -> None:
+        self.__executor = ThreadPoolExecutor(max_workers=MAX_IN_FLIGHT, thread_name_prefix="cloud-recognize")
+        self.__listening = True
+        self.__listener = threading.Thread(target=self.__listen_loop, name="cloud-listen", daemon=True)
+        self.__listener.start()
+        threading.Thread(target=self.__recalibrate_loop, name="cloud-calibrate", daemon=True).start()
+        self.__logger.info("Listening in the background, up to %d recognition requests in flight", MAX_IN_FLIGHT)
+
+    def __listen_loop(self) -> None:
+        '''
+        Listens for utterances like sr.Recognizer.listen_in_background, which would end its
+        thread silently on a capture error and leave recognize_speech() waiting forever.
+        '''
+        while self.__listening:
+            try:
+                with self.__source as source:
+                    if not self.__calibrated:
+                        self.__calibrate(source)
+                    # Wake up every second to notice close()
+                    audio = self.__recognizer.listen(source, timeout=1, phrase_time_limit=PHRASE_TIME_LIMIT)
+            except sr.WaitTimeoutError:
+                continue
+            except Exception as e:
+                self.__fail(e)
+                with self.__lock:
+                    number = self.__heard
+                    self.__heard += 1
+                    self.__answered += 1
+                    self.__finish(number, SpeechState.error)
+                if self.finished:
+                    return
+                continue
+            self.__on_utterance(audio)
+
+    def __on_utterance(self, audio) -> None:
+        # Listening pauses while all slots are busy, the capture keeps recording meanwhile
+        self.__slots.acquire()
+        with self.__lock:
+            number = self.__heard
+            self.__heard += 1
+            self.__in_flight.set(self.__heard - self.__answered)
+        self.__executor.submit(self.__recognize, number, audio)
+
+    def __recognize(self, number, audio) -> None:
+        state = None
+        start_time = time.time()
+        try:
+            state = self.__recognize_audio(audio)
+        except sr.UnknownValueError:
+            self.__logger.info("Utterance %d: could not understand", number)
+        except Exception as e:
+            # Request errors and timeouts
+            self.__logger.error(f"Could not request results; {e}")
+            state = SpeechState.error
+        finally:
+            self.__slots.release()
+        self.__logger.info(f"Execution time of transcription {number}: {time.time() - start_time:.2f} seconds")
+
+        with self.__lock:
+            self.__answered += 1
+            self.__in_flight.set(self.__heard - self.__answered)
+            self.__finish(number, state)
+
+    def __finish(self, number, state) -> None:
+        '''
+        Queues the states of the finished utterances in the order they were spoken, called
+        with the lock held.
+        '''
+        self.__finished[number] = state
+        while self.__delivered in self.__finished:
+            state = self.__finished.pop(self.__delivered)
+            self.__delivered += 1
+            if state is not None and state != SpeechState.idle:
+                self.__results.put(state)
+
+    def __fail(self, err) -> None:
+        '''
+        Handles a capture error. The end of a file or stdin is the end of recognition, the
+        loop stops on finished instead of replaying the input; a live source is restarted
+        when it is listened to again.
+        '''
+        if isinstance(err, EOFError) and self.__source.capture.finite:
+            self.__logger.info("End of audio input, recognition finished")
+            self.finished = True
+        else:
+            self.__logger.error(f"Could not capture audio; {err}")
+        self.__source.stop()
+
+    def __recognize_audio(self, audio) -> SpeechState:
+        if self.__hedged is None:
+            with METRICS.timer("transcribe"):
+                command = self.__recognizer.recognize_google(audio)
+            return self.__intent(command)
+
+        with METRICS.timer("transcribe"):
+            state, backend, command = self.__hedged.recognize(audio)
+        if state is None:
+            self.__logger.warning("Command not recognized in %r, previous state was %s", command,
+                                  self.__previousstate)
+            return SpeechState.idle
+        self.__logger.info("%s from the %s backend: %r", state.name, backend, command)
+        METRICS.counter("mcms_recognitions_total", command=state.name).inc()
+        return state
+
+    def __intent(self, command) -> SpeechState:
+        intent_start = time.perf_counter()
+        # Check if the recognized command identifies "long"  
+        if "long" in command.lower():
+            state = SpeechState.mode_long
+
+        # Check if the recognized command identifies "short"
+        elif "short" in command.lower():
+            state = SpeechState.mode_short
+
+        # Check if the recognized command identifies "stop"
+        elif "stop" in command.lower():
+            state = SpeechState.stop
+
+        else:
+            self.__logger.warning("Command not recognized, previous state was %s. Setting current staate to idle", 
+                                  self.__previousstate)
+            state = SpeechState.idle
+        METRICS.observe_stage("intent", time.perf_counter() - intent_start)
+        if state != SpeechState.idle:
+            METRICS.counter("mcms_recognitions_total", command=state.name).inc()
+        return state
+
+    def __calibrate(self, source) -> None:
+        self.__recognizer.adjust_for_ambient_noise(source, duration=CALIBRATION_SECONDS)
+        self.__calibrated = True
+        self.__logger.info("Energy threshold %.0f after %.1f s of ambient noise",
+                           self.__recognizer.energy_threshold, CALIBRATION_SECONDS)
+
+    def __recalibrate_loop(self) -> None:
+        while self.__listening:
+            time.sleep(RECALIBRATE_SECONDS)
+            try:
+                self.__recalibrate()
+            except Exception as e:
+                self.__logger.warning("Cannot recalibrate the energy threshold: %s", e)
+
+    def __recalibrate(self) -> None:
+        '''
+        Sets the energy threshold from the quietest chunks of the audio captured last, read
+        from the capture buffer without taking it away from the listener.
+        '''
+        capture = self.__source.capture
+        frames = int(capture.rate * NOISE_WINDOW_SECONDS) // CHUNK * CHUNK
+        end = capture.position
+        if not capture.is_active() or end < frames:
+            return
+        pcm = np.empty((frames, capture.channels), dtype=np.int16)
+        capture.read(end - frames, frames, pcm)
+        chunks = pcm.reshape(-1, CHUNK).astype(np.float32)
+        # RMS per chunk as speech_recognition measures the energy
+        energy = np.sqrt(np.mean(chunks * chunks, axis=1))
+        noise = float(np.percentile(energy, NOISE_PERCENTILE))
+        self.__recognizer.energy_threshold = max(noise * self.__recognizer.dynamic_energy_ratio, 1.0)
+        self.__logger.info("Energy threshold recalibrated to %.0f", self.__recognizer.energy_threshold)
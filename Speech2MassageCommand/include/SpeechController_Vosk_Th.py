@@ -1,153 +1,150 @@
-from enum import Enum
-from vosk import Model, KaldiRecognizer
+from vosk import KaldiRecognizer
+from include.Commands import SpeechState, COMMAND_TABLE, find_command, match_command, build_grammar
+from include.AudioCapture import AudioCapture
+from include.AudioSource import PyAudioSource
+from include.ModelLoader import load_vosk_model
+from include.SlidingWindow import SlidingWindow, DuplicateFilter
+from include.SequenceControl import SequenceControl
+from include.Metrics import METRICS
 import pyaudio
+import numpy as np
 import json
-import wave
-import requests
+import threading
 import time
 
+# Format handed to the recognizer, the capture converts from the device's native format
 CHANNELS = 1
 CHUNK = 1024
 FRAME_RATE = 16000
 RECORD_SECONDS = 10
 AUDIO_FORMAT = pyaudio.paInt16
 SAMPLE_SIZE = 2
-WAVE_OUTPUT_FILENAME = "file.wav"
+STABLE_PARTIALS = 2
+WINDOW_FRAMES = int(FRAME_RATE / CHUNK * RECORD_SECONDS) * CHUNK
 
-class SpeechState(Enum):
-    idle = 0
-    mode_long = 1
-    mode_short = 2
-    stop = 3
-    error = 4
-
-class SpeechController:
-    def __init__(self, logger, command_queue) -> None:
+class SpeechController(SequenceControl):
+    def __init__(self, logger, command_queue, streaming=False, grammar=False, command_table=COMMAND_TABLE,
+                 sliding_window=None, audio_source=None) -> None:
         self.__logger = logger
+        SequenceControl.__init__(self, logger)
         self.__currentstate = SpeechState.idle
         self.__previousstate = SpeechState.idle
-        self.__model = Model(model_name="vosk-model-small-en-us-0.15")
-        self.__rec = KaldiRecognizer(self.__model, FRAME_RATE)
-        self.__frames = []
+        self.__model, self.model_timings = load_vosk_model(logger, "vosk-model-small-en-us-0.15")
+        self.__rec_lock = threading.Lock()
+        self.set_command_table(command_table, grammar)
+        self.__streaming = streaming
+        if audio_source is None:
+            audio_source = PyAudioSource(logger)
+        self.__capture = AudioCapture(logger, audio_source, CHUNK, rate=FRAME_RATE)
+        self.__cursor = 0
+        self.__window = np.empty((WINDOW_FRAMES, CHANNELS), dtype=np.int16)
+        self.__chunk = np.empty((CHUNK, CHANNELS), dtype=np.int16)
+        self.__utterance_start = None
+        # (window seconds, hop seconds) for overlapping windows, None for back-to-back windows
+        self.__sliding = None
+        if sliding_window:
+            self.__sliding = SlidingWindow(logger, self.__capture, *sliding_window)
+            self.__duplicates = DuplicateFilter()
         self.command_queue = command_queue
+        # Set when a finite source (file, stdin) ended
+        self.finished = False
 
     def get_current_state(self) -> SpeechState:
         return self.__currentstate
 
-    def start_mode_long(self, ip_addr, port):
-        start_time = time.time()
-        self.__logger.info("Command recognized: Activated Long Massage mode, %s", self.__currentstate)
-        file_path = "assets/sample_long.json"
-        url = f"http://{ip_addr}:{port}/sequence/1"
-        headers = {'Content-Type': 'application/json'}
-        try:
-            with open(file_path, "r") as file:
-                json_data = file.read()
-            response = requests.put(url, headers=headers, data=json_data)
-            url = f"{url}/start"
-            response = requests.put(url)
-            self.__logger.info("Sequence status %d -- %s", response.status_code, response.text)
-        except Exception as err:
-            self.__logger.warning('Error: %s----Cannot start mode long, current state is %s', err, self.__currentstate.name)
-  
-        end_time = time.time()
-        execution_time = end_time - start_time
-        self.__logger.info(f"Execution time of long mode: {execution_time:.2f} seconds")
-
-    def start_mode_short(self, ip_addr, port):
-        start_time = time.time()
-        self.__logger.info("Command recognized: Activated Short Massage mode, %s", self.__currentstate)
-        file_path = "assets/sample_short.json"
-        url = f"http://{ip_addr}:{port}/sequence/2"
-        headers = {'Content-Type': 'application/json'}
-        try:
-            with open(file_path, "r") as file:
-                json_data = file.read()            
-            response = requests.put(url, headers=headers, data=json_data)
-            url = f"{url}/start"
-            response = requests.put(url)
-            self.__logger.info("Sequence status %d %s", response.status_code, response.text)
-        except Exception as err:
-            self.__logger.warning('Error: %s----Cannot start mode short, current state is %s', err, self.__currentstate.name)
-    
-        end_time = time.time()
-        execution_time = end_time - start_time
-        self.__logger.info(f"Execution time of short mode: {execution_time:.2f} seconds")
+    def close(self) -> None:
+        self.__capture.stop()
 
-    def stop_mode(self, ip_addr, port):
-        start_time = time.time()
-        if self.__previousstate == SpeechState.mode_long:
-            url = f"http://{ip_addr}:{port}/sequence/1"
-        elif self.__previousstate == SpeechState.mode_short:
-            url = f"http://{ip_addr}:{port}/sequence/2"
+    def __fail(self, err) -> None:
+        '''
+        Ends the dispatch thread with an error state. The end of a file or stdin is the end of
+        recognition, the loop stops on finished instead of replaying the input; a live source
+        is restarted on the next call.
+        '''
+        if isinstance(err, EOFError) and self.__capture.finite:
+            self.__logger.info("End of audio input, recognition finished")
+            self.finished = True
         else:
-            return
-        try:
-            self.__logger.info("Stop mode. %s", self.__currentstate)
-            url = f"{url}/stop"
-            response = requests.put(url)
-            self.__logger.info("Sequence status %d %s", response.status_code, response.text)
-        except Exception as err:
-            self.__logger.warning('Error: %s----Cannot stop mode, current state is %s', err, self.__currentstate.name)
+            self.__logger.error(f"Could not request results; {err}")
+        self.command_queue.put(SpeechState.error)
+        self.__capture.stop()
 
-        end_time = time.time()
-        execution_time = end_time - start_time
-        self.__logger.info(f"Execution time of stop mode: {execution_time:.2f} seconds")
+    def __start_capture(self) -> bool:
+        '''
+        Opens the microphone on first use, or again after an error. Returns True if it was (re)started.
+        '''
+        if self.__capture.is_active():
+            return False
+        self.__capture.stop()
+        # A file source may be captured entirely before start() returns
+        self.__cursor = self.__capture.position
+        self.__capture.start()
+        if self.__sliding:
+            self.__sliding.reset(self.__cursor)
+        return True
 
+    def set_command_table(self, command_table, grammar=None) -> None:
+        '''
+        Replaces the command table and rebuilds the Kaldi recognizer on the already loaded model.
+        With grammar enabled, the recognizer only decodes the command phrases and [unk].
+        Safe to call while recognition is running.
+        '''
+        if grammar is None:
+            grammar = self.__grammar
+        if grammar:
+            rec = KaldiRecognizer(self.__model, FRAME_RATE, build_grammar(command_table))
+        else:
+            rec = KaldiRecognizer(self.__model, FRAME_RATE)
+        with self.__rec_lock:
+            self.__rec = rec
+            self.__command_table = dict(command_table)
+            self.__grammar = grammar
+        self.__logger.info("Recognizer rebuilt for commands %s (grammar %s)", sorted(command_table), grammar)
 
     def recognize_speech(self) -> None:
+        if self.__streaming:
+            self.recognize_speech_streaming()
+            return
+        if self.__sliding:
+            self.recognize_speech_sliding()
+            return
+
         self.__logger.info("Running MCMS Speech Recognition using Vosk LLM multi-threading") 
-        self.__frames = []   
-        self.__rec.SetWords(True)
+        start_time = time.time()
         try:
-            self.__audio = pyaudio.PyAudio()
-            self.__stream = self.__audio.open(format=AUDIO_FORMAT,
-                                          channels=CHANNELS,
-                                          rate=FRAME_RATE,
-                                          input=True,
-                                          input_device_index=0,
-                                          frames_per_buffer=CHUNK)
+            self.__start_capture()
             self.__logger.info("Recording on mic .....using Vosk") 
 
-            # Record speech frames from microphone for RECORD_SECONDS
-            for i in range(0, int(FRAME_RATE / CHUNK * RECORD_SECONDS)):
-                data = self.__stream.read(CHUNK)
-                self.__frames.append(data)
+            # Take the next RECORD_SECONDS from the capture buffer, which kept recording
+            # while the previous window was transcribed
+            self.__cursor = self.__capture.read(self.__cursor, WINDOW_FRAMES, self.__window)
             self.__logger.info("Finished recording")
 
             start_time = time.time()
             # Transcribe using Kaldi recognizer
-            self.__rec.AcceptWaveform(b''.join(self.__frames))
-            result = self.__rec.Result()
+            with METRICS.timer("encode"):
+                data = self.__window.tobytes()
+            with self.__rec_lock, METRICS.timer("transcribe"):
+                self.__rec.SetWords(True)
+                self.__rec.AcceptWaveform(data)
+                result = self.__rec.Result()
+                command_table = self.__command_table
             text = json.loads(result)["text"]
             print(text)
         
-            # Check if the recognized command identifies "long"     
-            if "long" in text:
-                self.command_queue.put(SpeechState.mode_long)
-                self.__currentstate = SpeechState.mode_long
-            # Check if the recognized command identifies "short"
-            elif "short" in text:
-                self.command_queue.put(SpeechState.mode_short)
-                self.__currentstate = SpeechState.mode_short
-            # Check if the recognized command identifies "stop"
-            elif "stop" in text:
-                self.command_queue.put(SpeechState.stop)
-                self.__currentstate = SpeechState.stop
+            # Check if the recognized text contains one of the command phrases
+            with METRICS.timer("intent"):
+                state = match_command(text, command_table)
+            if state is not None:
+                METRICS.counter("mcms_recognitions_total", command=state.name).inc()
+                self.command_queue.put(state)
+                self.__currentstate = state
             else:
                 self.__logger.warning("Command not recognized, Current state is %s, previous state was %s", 
                                       self.__currentstate, self.__previousstate)
                 self.__currentstate = SpeechState.idle
         except Exception as e:
-            self.__logger.error(f"Could not request results; {e}")
-            self.command_queue.put(SpeechState.error)
-        
-        finally:
-            if self.__stream:
-                self.__stream.stop_stream()
-                self.__stream.close()
-            if self.__audio:
-                self.__audio.terminate()
+            self.__fail(e)
 
         end_time = time.time()
         execution_time = end_time - start_time
@@ -155,3 +152,100 @@ class SpeechController:
 
         if self.__currentstate == SpeechState.mode_long or self.__currentstate == SpeechState.mode_short:
             self.__previousstate = self.__currentstate;
+
+
+    def recognize_speech_sliding(self) -> None:
+        '''
+        Decodes the next overlapping window. A command heard in several overlapping windows
+        is only queued once.
+        '''
+        try:
+            self.__start_capture()
+            window, start, end = self.__sliding.next()
+            start_time = time.time()
+            with METRICS.timer("encode"):
+                data = window.tobytes()
+            with self.__rec_lock, METRICS.timer("transcribe"):
+                self.__rec.AcceptWaveform(data)
+                text = json.loads(self.__rec.FinalResult())["text"]
+                command_table = self.__command_table
+
+            with METRICS.timer("intent"):
+                state = match_command(text, command_table)
+            if state is not None and self.__duplicates.accept(state, start, end):
+                self.__emit_command(state)
+            end_time = time.time()
+            self.__logger.info(f"Execution time of window transcription: {end_time - start_time:.2f} seconds, '{text}'")
+        except Exception as e:
+            self.__fail(e)
+
+    def recognize_speech_streaming(self) -> None:
+        '''
+        Feeds the microphone to the Kaldi recognizer chunk by chunk and queues a command
+        as soon as it is stable, instead of waiting for the end of the RECORD_SECONDS window.
+        The capture and the recognizer state are kept across calls, so an utterance that
+        spans two windows is not cut.
+        '''
+        self.__logger.info("Running MCMS Speech Recognition using Vosk streaming") 
+        try:
+            if self.__start_capture():
+                self.__emitted_words = 0
+                self.__candidate = None
+                self.__candidate_count = 0
+                self.__utterance_start = None
+                self.__logger.info("Streaming from mic .....using Vosk") 
+
+            for i in range(0, int(FRAME_RATE / CHUNK * RECORD_SECONDS)):
+                self.__cursor = self.__capture.read(self.__cursor, CHUNK, self.__chunk)
+                with self.__rec_lock, METRICS.timer("transcribe"):
+                    final = self.__rec.AcceptWaveform(self.__chunk.tobytes())
+                    result = self.__rec.Result() if final else self.__rec.PartialResult()
+                    command_table = self.__command_table
+                if final:
+                    # End of utterance: commit any command the partials did not confirm
+                    words = json.loads(result)["text"].split()
+                    with METRICS.timer("intent"):
+                        end, state = find_command(words, command_table, self.__emitted_words)
+                    if state is not None:
+                        self.__emit_command(state)
+                    self.__emitted_words = 0
+                    self.__candidate = None
+                    self.__candidate_count = 0
+                    self.__utterance_start = None
+                    continue
+
+                words = json.loads(result)["partial"].split()
+                if words and self.__utterance_start is None:
+                    self.__utterance_start = time.time()
+                with METRICS.timer("intent"):
+                    end, state = find_command(words, command_table, self.__emitted_words)
+                if state is None:
+                    self.__candidate = None
+                    self.__candidate_count = 0
+                    continue
+
+                # A command is stable once it holds the same position in consecutive partials
+                candidate = (end, state)
+                if candidate == self.__candidate:
+                    self.__candidate_count += 1
+                else:
+                    self.__candidate = candidate
+                    self.__candidate_count = 1
+                if self.__candidate_count >= STABLE_PARTIALS:
+                    self.__emit_command(state)
+                    self.__emitted_words = end
+                    self.__candidate = None
+                    self.__candidate_count = 0
+
+        except Exception as e:
+            self.__fail(e)
+
+    def __emit_command(self, state) -> None:
+        METRICS.counter("mcms_recognitions_total", command=state.name).inc()
+        self.command_queue.put(state)
+        self.__currentstate = state
+        if self.__utterance_start is not None:
+            latency = time.time() - self.__utterance_start
+            self.__logger.info(f"Command {state.name} queued {latency:.2f} seconds after speech onset")
+        if self.__currentstate == SpeechState.mode_long or self.__currentstate == SpeechState.mode_short:
+            self.__previousstate = self.__currentstate
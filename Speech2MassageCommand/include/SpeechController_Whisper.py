@@ -1,138 +1,76 @@
-from enum import Enum
-import whisper
 import pyaudio
-import wave
-import requests
+import numpy as np
 import time
-
-CHANNELS = 2
+from include.Commands import SpeechState
+from include.AudioFrontend import pcm16_to_float32
+from include.AudioCapture import AudioCapture
+from include.AudioSource import PyAudioSource
+from include.WhisperEngine import load_whisper_engine, DEFAULT_ENGINE
+from include.Metrics import METRICS
+from include.SequenceControl import SequenceControl, SHOP_SEQUENCES
+
+# Format handed to the recognizer, the capture converts from the device's native format
+CHANNELS = 1
 CHUNK = 1024
-FRAME_RATE = 44100
+FRAME_RATE = 16000
 RECORD_SECONDS = 10
 AUDIO_FORMAT = pyaudio.paInt16
 SAMPLE_SIZE = 2
-WAVE_OUTPUT_FILENAME = "file.wav"
-
-class SpeechState(Enum):
-    idle = 0
-    mode_long = 1
-    mode_short = 2
-    stop = 3
-    error = 4
+WINDOW_FRAMES = int(FRAME_RATE / CHUNK * RECORD_SECONDS) * CHUNK
 
-class SpeechController:
-    def __init__(self, logger) -> None:
+class SpeechController(SequenceControl):
+    def __init__(self, logger, audio_source=None, engine=DEFAULT_ENGINE, decode_profile=None) -> None:
         self.__logger = logger
+        SequenceControl.__init__(self, logger, SHOP_SEQUENCES)
         self.__currentstate = SpeechState.idle
         self.__previousstate = SpeechState.idle
-        self.__model = whisper.load_model("base")
-        self.__audio = None
-        self.__frames = []
-        self.__stream = None 
+        self.__model, self.model_timings = load_whisper_engine(logger, "base", engine)
+        # Whisper options tuned for short command windows, None for the transcribe() defaults
+        self.__profile = decode_profile
+        if audio_source is None:
+            audio_source = PyAudioSource(logger)
+        self.__capture = AudioCapture(logger, audio_source, CHUNK, rate=FRAME_RATE)
+        self.__cursor = 0
+        # Captured int16 PCM of one window, filled in place on every recording
+        self.__pcm = np.empty((WINDOW_FRAMES, CHANNELS), dtype=np.int16)
+        # Set when a finite source (file, stdin) ended
+        self.finished = False
+
+    def close(self) -> None:
+        self.__capture.stop()
 
     def get_current_state(self) -> SpeechState:
         '''
         Returns the current state of the SpeechController.
         '''
         return self.__currentstate
-    
-    
-    def start_mode_long(self, ip_addr, port):
-        start_time = time.time()
-        self.__logger.info("Command recognized: Activated Long Massage mode, %s", self.__currentstate)
-
-        file_path = "assets/shop_massage_long.json"
-        url = f"http://{ip_addr}:{port}/sequence/1"
-        headers = {'Content-Type': 'application/json'}
-
-        try: 
-            with open(file_path, "r") as file:
-                json_data = file.read()
-            response = requests.put(url, headers=headers, data=json_data)
-            url = f"{url}/start"
-            response = requests.put(url)
-            self.__logger.info("Sequence status %d -- %s", response.status_code, response.text)
-        except RuntimeError as err:
-            self.__logger.warning('Error: %s----Cannot start mode long, current state is %s', err, self.__currentstate.name)
-    
-        end_time = time.time()
-        execution_time = end_time - start_time
-        self.__logger.info(f"Execution time: {execution_time:.2f} seconds")
-    
-    def start_mode_short(self, ip_addr, port):
-        start_time = time.time()
-        self.__logger.info("Command recognized: Activated Short Massage mode, %s", self.__currentstate)
-
-        file_path = "assets/shop_massage_short.json"
-        url = f"http://{ip_addr}:{port}/sequence/2"
-        headers = {'Content-Type': 'application/json'}
-
-        try: 
-            with open(file_path, "r") as file:
-                json_data = file.read()            
-            response = requests.put(url, headers=headers, data=json_data)
-            url = f"{url}/start"
-            response = requests.put(url)
-            self.__logger.info("Sequence status %d %s", response.status_code, response.text)
-        except RuntimeError as err:
-            self.__logger.warning('Error: %s----Cannot start mode short, current state is %s', err, self.__currentstate.name)
-    
-        end_time = time.time()
-        execution_time = end_time - start_time
-        self.__logger.info(f"Execution time: {execution_time:.2f} seconds")
-
-    def stop_mode(self, ip_addr, port):
-        start_time = time.time()
-        if self.__previousstate == SpeechState.mode_long:
-            url = f"http://{ip_addr}:{port}/sequence/1"
-        elif self.__previousstate == SpeechState.mode_short:
-            url = f"http://{ip_addr}:{port}/sequence/2"
-        else: 
-            return
-
-        try: 
-            self.__logger.info("Stop mode. %s", self.__currentstate)
-            url = f"{url}/stop"
-            response = requests.put(url)
-            self.__logger.info("Sequence status %d %s", response.status_code, response.text)
-        except RuntimeError as err:
-            self.__logger.warning('Error: %s----Cannot stop mode, current state is %s', err, self.__currentstate.name)
-
-        end_time = time.time()
-        execution_time = end_time - start_time
-        self.__logger.info(f"Execution time: {execution_time:.2f} seconds")
-
 
     def recognize_speech(self) -> SpeechState:
         start_time = time.time()
         self.__logger.info("Running MCMS Speech Recognition using Whisper LLM single-threaded") 
-        self.__frames = []  
+
         try: 
-            self.__audio = pyaudio.PyAudio()
-            self.__stream = self.__audio.open(format=AUDIO_FORMAT,
-                        channels=CHANNELS,
-                        rate=FRAME_RATE,
-                        input=True,
-                        input_device_index=1,
-                        frames_per_buffer=CHUNK) 
+            if not self.__capture.is_active():
+                self.__capture.stop()
+                # A file source may be captured entirely before start() returns
+                self.__cursor = self.__capture.position
+                self.__capture.start()
             self.__logger.info("Recording on mic .....")            
-            # Start recording
-            for i in range(0, int(FRAME_RATE/CHUNK * RECORD_SECONDS)):
-                data = self.__stream.read(CHUNK)
-                self.__frames.append(data)
+            # Take the next window from the capture buffer, which kept recording during the last transcription
+            self.__cursor = self.__capture.read(self.__cursor, WINDOW_FRAMES, self.__pcm)
             self.__logger.info("Finished recording")
 
-            # Write to new .wav file
-            with wave.open(WAVE_OUTPUT_FILENAME, 'wb') as wavFile:
-                wavFile.setnchannels(CHANNELS)
-                wavFile.setsampwidth(self.__audio.get_sample_size(AUDIO_FORMAT))
-                wavFile.setframerate(FRAME_RATE)
-                wavFile.writeframes(b''.join(self.__frames))
-                wavFile.close()
-
-            result = self.__model.transcribe(WAVE_OUTPUT_FILENAME)
+            # Hand the samples to Whisper in memory, no .wav file and no ffmpeg decode
+            with METRICS.timer("encode"):
+                audio = pcm16_to_float32(self.__pcm, CHANNELS, FRAME_RATE)
+            with METRICS.timer("transcribe"):
+                if self.__profile:
+                    result = self.__profile.transcribe(self.__model, audio)
+                else:
+                    result = self.__model.transcribe(audio)
             print(result)
 
+            intent_start = time.perf_counter()
             # Check if the recognized command matches "activate mode long"
             if "long" in result['text'].lower():
                 self.__currentstate = SpeechState.mode_long
@@ -149,18 +87,19 @@ class SpeechController:
                 self.__logger.warning("Command not recognized, previous state was %s. \
                                       Setting current state to idle", self.__currentstate)
                 self.__currentstate = SpeechState.idle
+            METRICS.observe_stage("intent", time.perf_counter() - intent_start)
+            if self.__currentstate != SpeechState.idle:
+                METRICS.counter("mcms_recognitions_total", command=self.__currentstate.name).inc()
         
         except Exception as e:
-            print(f"Could not request results; {e}")
+            if isinstance(e, EOFError) and self.__capture.finite:
+                # A file or stdin ended, the entry script stops on finished
+                self.__logger.info("End of audio input, recognition finished")
+                self.finished = True
+            else:
+                print(f"Could not request results; {e}")
             self.__currentstate = SpeechState.error
-
-        finally:    
-            if self.__stream:
-                # Stop recording
-                self.__stream.stop_stream()
-                self.__stream.close()
-            if self.__audio:
-                self.__audio.terminate()
+            self.__capture.stop()
 
         end_time = time.time()
         execution_time = end_time - start_time
@@ -1,155 +1,235 @@
-from enum import Enum
-import whisper
 import pyaudio
-import wave
-import requests
+import numpy as np
+import threading
 import time
+from include.Commands import SpeechState, COMMAND_TABLE_EN_DE, match_command
+from include.AudioFrontend import pcm16_to_float32
+from include.AudioCapture import AudioCapture
+from include.AudioSource import PyAudioSource
+from include.WhisperEngine import load_whisper_engine, DEFAULT_ENGINE
+from include.SlidingWindow import SlidingWindow, DuplicateFilter
+from include.VoiceActivity import VoiceActivityDetector
+from include.WhisperBatcher import WhisperBatcher
+from include.TranscriptionPool import TranscriptionPool
+from include.WhisperStreaming import StreamingTranscriber, STEP_SECONDS
+from include.LogMelFrontend import LogMelFrontend
+from include.SequenceControl import SequenceControl, SHOP_SEQUENCES
+from include.Metrics import METRICS
 
-CHANNELS = 2
+# Format handed to the recognizer, the capture converts from the device's native format
+CHANNELS = 1
 CHUNK = 1024
 FRAME_RATE = 16000
 RECORD_SECONDS = 10
 AUDIO_FORMAT = pyaudio.paInt16
 SAMPLE_SIZE = 2
-WAVE_OUTPUT_FILENAME = "file.wav"
+WINDOW_FRAMES = int(FRAME_RATE / CHUNK * RECORD_SECONDS) * CHUNK
+# Longest wait for the transcription workers when a finite source ended
+DRAIN_SECONDS = 30.0
 
-class SpeechState(Enum):
-    idle = 0
-    mode_long = 1
-    mode_short = 2
-    stop = 3
-    error = 4
-
-class SpeechController:
-    def __init__(self, logger, command_queue) -> None:
+class SpeechController(SequenceControl):
+    def __init__(self, logger, command_queue, sliding_window=None, vad=False, audio_source=None, batch_size=1,
+                 processes=0, engine=DEFAULT_ENGINE, decode_profile=None, streaming=False, features=False) -> None:
         self.__logger = logger
+        SequenceControl.__init__(self, logger, SHOP_SEQUENCES)
         self.__currentstate = SpeechState.idle
         self.__previousstate = SpeechState.idle
-        self.__model = whisper.load_model("tiny")
-        self.__frames = []
+        # With worker processes the model is resident in the workers only
+        self.__pool = None
+        # Whisper options tuned for short command windows, None for the transcribe() defaults
+        self.__profile = decode_profile
+        if processes:
+            self.__model, self.model_timings = None, {}
+            # A slot holds one window, sliding windows may be longer than RECORD_SECONDS
+            slot_frames = int(FRAME_RATE * sliding_window[0]) if sliding_window else WINDOW_FRAMES
+            self.__pool = TranscriptionPool(logger, "tiny", processes, slot_frames=slot_frames, engine=engine,
+                                            decode_profile=decode_profile)
+            # Results of the workers in window order: windows submitted, texts of windows finished
+            # ahead of an earlier one, and the next window whose command may be queued
+            self.__submitted = 0
+            self.__finished = {}
+            self.__delivered = 0
+            self.__results_lock = threading.Lock()
+        else:
+            self.__model, self.model_timings = load_whisper_engine(logger, "tiny", engine)
+        if audio_source is None:
+            audio_source = PyAudioSource(logger)
+        self.__capture = AudioCapture(logger, audio_source, CHUNK, rate=FRAME_RATE)
+        self.__cursor = 0
+        # Log-mel features computed while capturing, so decoding a window starts with the encoder
+        self.__features = None
+        if features and not processes and not streaming and engine != "ctranslate2":
+            self.__features = LogMelFrontend.for_model(self.__model)
+            self.__capture.add_listener(self.__features.accept)
+            self.__features_seconds = 0.0
+        # Captured int16 PCM of one window, filled in place on every recording
+        self.__pcm = np.empty((WINDOW_FRAMES, CHANNELS), dtype=np.int16)
+        # (window seconds, hop seconds) for overlapping windows, None for back-to-back windows
+        self.__sliding = None
+        if sliding_window:
+            self.__sliding = SlidingWindow(logger, self.__capture, *sliding_window)
+            self.__duplicates = DuplicateFilter()
+        # Only windows that contain speech reach the model, trimmed to the speech segments,
+        # also the features decoded instead of the audio
+        self.__vad = VoiceActivityDetector() if vad else None
+        # Overlapping windows that piled up while decoding are transcribed together in one batch,
+        # the batcher drives the PyTorch model directly
+        self.__batcher = None
+        if batch_size > 1 and self.__sliding and engine != "ctranslate2" and not self.__pool:
+            options = decode_profile.decoding_options() if decode_profile else {}
+            languages = decode_profile.languages if decode_profile else ()
+            self.__batcher = WhisperBatcher(logger, self.__model, max_batch=batch_size, languages=languages, **options)
+        # Growing chunks decoded every STEP_SECONDS, words committed once two passes agree
+        self.__stream = None
+        if streaming and not self.__pool:
+            vad = VoiceActivityDetector() if vad else None
+            self.__stream = StreamingTranscriber(self.__model, COMMAND_TABLE_EN_DE, decode_profile, vad)
         self.command_queue = command_queue
+        # Set when a finite source (file, stdin) ended
+        self.finished = False
+
+    def close(self) -> None:
+        self.__capture.stop()
+        if self.__pool:
+            self.__pool.close()
 
     def get_current_state(self) -> SpeechState:
         return self.__currentstate
 
-    def start_mode_long(self, ip_addr, port):
-        start_time = time.time()
-        self.__logger.info("Command recognized: Activated Long Massage mode, %s", self.__currentstate)
-        file_path = "assets/shop_massage_long.json"
-        url = f"http://{ip_addr}:{port}/sequence/1"
-        headers = {'Content-Type': 'application/json'}
-        try:
-            with open(file_path, "r") as file:
-                json_data = file.read()
-            response = requests.put(url, headers=headers, data=json_data)
-            url = f"{url}/start"
-            response = requests.put(url)
-            self.__logger.info("Sequence status %d -- %s", response.status_code, response.text)
-        except Exception as err:
-            self.__logger.warning('Error: %s----Cannot start mode long, current state is %s', err, self.__currentstate.name)
-  
-        end_time = time.time()
-        execution_time = end_time - start_time
-        self.__logger.info(f"Execution time: {execution_time:.2f} seconds")
+    def __fail(self, err) -> None:
+        '''
+        Ends the dispatch thread with an error state. The end of a file or stdin is the end of
+        recognition, the loop stops on finished instead of replaying the input; a live source
+        is restarted on the next call.
+        '''
+        if isinstance(err, EOFError) and self.__capture.finite:
+            self.__logger.info("End of audio input, recognition finished")
+            self.finished = True
+            if self.__pool:
+                # Commands of the windows still in the workers go before the end
+                deadline = time.monotonic() + DRAIN_SECONDS
+                while self.__delivered < self.__submitted and time.monotonic() < deadline:
+                    time.sleep(0.05)
+        else:
+            self.__logger.error(f"Could not request results; {err}")
+        self.command_queue.put(SpeechState.error)
+        self.__capture.stop()
 
-    def start_mode_short(self, ip_addr, port):
-        start_time = time.time()
-        self.__logger.info("Command recognized: Activated Short Massage mode, %s", self.__currentstate)
-        file_path = "assets/shop_massage_short.json"
-        url = f"http://{ip_addr}:{port}/sequence/2"
-        headers = {'Content-Type': 'application/json'}
-        try:
-            with open(file_path, "r") as file:
-                json_data = file.read()            
-            response = requests.put(url, headers=headers, data=json_data)
-            url = f"{url}/start"
-            response = requests.put(url)
-            self.__logger.info("Sequence status %d %s", response.status_code, response.text)
-        except Exception as err:
-            self.__logger.warning('Error: %s----Cannot start mode short, current state is %s', err, self.__currentstate.name)
-    
-        end_time = time.time()
-        execution_time = end_time - start_time
-        self.__logger.info(f"Execution time: {execution_time:.2f} seconds")
+    def __start_capture(self) -> None:
+        if not self.__capture.is_active():
+            self.__capture.stop()
+            # A file source may be captured entirely before start() returns
+            self.__cursor = self.__capture.position
+            self.__capture.start()
+            if self.__sliding:
+                self.__sliding.reset(self.__cursor)
+            if self.__stream:
+                self.__stream.reset()
 
-    def stop_mode(self, ip_addr, port):
-        start_time = time.time()
-        if self.__previousstate == SpeechState.mode_long:
-            url = f"http://{ip_addr}:{port}/sequence/1"
-        elif self.__previousstate == SpeechState.mode_short:
-            url = f"http://{ip_addr}:{port}/sequence/2"
-        else:
-            return
-        try:
-            self.__logger.info("Stop mode. %s", self.__currentstate)
-            url = f"{url}/stop"
-            response = requests.put(url)
-            self.__logger.info("Sequence status %d %s", response.status_code, response.text)
-        except Exception as err:
-            self.__logger.warning('Error: %s----Cannot stop mode, current state is %s', err, self.__currentstate.name)
+    def __transcribe(self, audio) -> dict:
+        if self.__profile:
+            return self.__profile.transcribe(self.__model, audio)
+        return self.__model.transcribe(audio)
 
-        end_time = time.time()
-        execution_time = end_time - start_time
-        self.__logger.info(f"Execution time: {execution_time:.2f} seconds")
+    def __transcribe_window(self, audio, ranges) -> dict:
+        '''
+        Transcribes the audio, the capture ranges (start, end) of its speech, from the features
+        of those ranges computed during capture if there are any.
+        '''
+        mel = self.__window_features([ranges])
+        if mel is None:
+            return self.__transcribe(audio)
+
+        import torch
+        import whisper
+        mel = torch.from_numpy(mel[0]).to(self.__model.device)
+        with torch.no_grad():
+            if self.__profile:
+                options = self.__profile.decoding_options(self.__profile.language_for_mel(self.__model, mel))
+            else:
+                options = {"fp16": False}
+            result = whisper.decode(self.__model, mel, whisper.DecodingOptions(**options))
+        return {"text": result.text}
+
+    def __window_features(self, windows):
+        '''
+        Returns the (windows, n_mels, 3000) features computed during capture of the windows,
+        each a list of capture ranges (start, end) joined like the speech segments of the
+        trimmed audio, or None without features or if one of them is no longer available.
+        '''
+        if self.__features is None:
+            return None
+        start_time = time.perf_counter()
+        mels = [self.__features.segments(ranges) for ranges in windows]
+        during = self.__features.seconds - self.__features_seconds
+        self.__features_seconds = self.__features.seconds
+        self.__logger.info("Feature extraction: %.1f ms during capture, %.1f ms after the window(s)",
+                           during * 1000, (time.perf_counter() - start_time) * 1000)
+        if any(mel is None for mel in mels):
+            return None
+        return np.stack(mels)
 
+    def __speech_only(self, audio, start):
+        '''
+        Returns the audio of the window captured from start trimmed to its speech segments and
+        the capture ranges (start, end) of those, or (None, []) if the window is silent.
+        '''
+        if self.__vad is None:
+            return audio, [(start, start + len(audio))]
+        with METRICS.timer("vad"):
+            segments = self.__vad.speech(audio)
+        if not segments:
+            self.__logger.info("No speech in window, skipped transcription (%d of %d windows skipped)",
+                               self.__vad.windows_skipped, self.__vad.windows_total)
+            return None, []
+        speech = np.concatenate([audio[first:last] for first, last in segments])
+        return speech, [(start + first, start + last) for first, last in segments]
 
     def recognize_speech(self) -> None:
+        if self.__stream:
+            self.recognize_speech_streaming()
+            return
+        if self.__pool:
+            self.recognize_speech_pool()
+            return
+        if self.__sliding:
+            self.recognize_speech_sliding()
+            return
+
         start_time = time.time()
         self.__logger.info("Running MCMS Speech Recognition using Whisper LLM multi-threading") 
-        self.__frames = []   
         try:
-            self.__audio = pyaudio.PyAudio()
-            self.__stream = self.__audio.open(format=AUDIO_FORMAT,
-                                          channels=CHANNELS,
-                                          rate=FRAME_RATE,
-                                          input=True,
-                                          input_device_index=1,
-                                          frames_per_buffer=CHUNK)
+            self.__start_capture()
             self.__logger.info("Recording on mic .....using Whisper") 
-            # Record speech frames from microphone for RECORD_SECONDS
-            for i in range(0, int(FRAME_RATE / CHUNK * RECORD_SECONDS)):
-                data = self.__stream.read(CHUNK)
-                self.__frames.append(data)
+            # Take the next RECORD_SECONDS from the capture buffer, which kept recording
+            # while the previous window was transcribed
+            start = self.__cursor
+            self.__cursor = self.__capture.read(self.__cursor, WINDOW_FRAMES, self.__pcm)
             self.__logger.info("Finished recording")
 
-            # Write the frames to .wav file
-            with wave.open(WAVE_OUTPUT_FILENAME, 'wb') as wavFile:
-                wavFile.setnchannels(CHANNELS)
-                wavFile.setsampwidth(self.__audio.get_sample_size(AUDIO_FORMAT))
-                wavFile.setframerate(FRAME_RATE)
-                wavFile.writeframes(b''.join(self.__frames))
-                wavFile.close()
-
-            # Transcribe the text in the file
-            result = self.__model.transcribe(WAVE_OUTPUT_FILENAME)
+            # Transcribe the samples in memory, no .wav file and no ffmpeg decode
+            with METRICS.timer("encode"):
+                audio = pcm16_to_float32(self.__pcm, CHANNELS, FRAME_RATE)
+            audio, ranges = self.__speech_only(audio, start)
+            result = {'text': ''}
+            if audio is not None:
+                with METRICS.timer("transcribe"):
+                    result = self.__transcribe_window(audio, ranges)
             print(result)
         
-            # Check if the recognized command identifies "long" in English or German            
-            if "long" in result['text'].lower() or "lange" in result['text'].lower():
-                self.command_queue.put(SpeechState.mode_long)
-                self.__currentstate = SpeechState.mode_long
-            # Check if the recognized command identifies "short" in English or German   
-            elif "short" in result['text'].lower() or "kurze" in result['text'].lower():
-                self.command_queue.put(SpeechState.mode_short)
-                self.__currentstate = SpeechState.mode_short
-            # Check if the recognized command identifies "stop" in English or German   
-            elif "stop" in result['text'].lower() or "stoppen" in result['text'].lower():
-                self.command_queue.put(SpeechState.stop)
-                self.__currentstate = SpeechState.stop
+            # Check if the recognized text contains a command in English or German
+            with METRICS.timer("intent"):
+                state = match_command(result['text'], COMMAND_TABLE_EN_DE)
+            if state is not None:
+                METRICS.counter("mcms_recognitions_total", command=state.name).inc()
+                self.command_queue.put(state)
+                self.__currentstate = state
             else:
                 self.__currentstate = SpeechState.idle
                 self.__logger.warning("Command not recognized, Current state is %s, previous state was %s", 
                                       self.__currentstate, self.__previousstate)
         except Exception as e:
-            self.__logger.error(f"Could not request results; {e}")
-            self.command_queue.put(SpeechState.error)
-        
-        finally:
-            if self.__stream:
-                self.__stream.stop_stream()
-                self.__stream.close()
-            if self.__audio:
-                self.__audio.terminate()
+            self.__fail(e)
 
         end_time = time.time()
         execution_time = end_time - start_time
@@ -157,3 +237,157 @@ class SpeechController:
 
         if self.__currentstate == SpeechState.mode_long or self.__currentstate == SpeechState.mode_short:
             self.__previousstate = self.__currentstate;
+
+
+    def recognize_speech_sliding(self) -> None:
+        '''
+        Transcribes the next overlapping window. A command heard in several overlapping windows
+        is only queued once.
+        '''
+        if self.__batcher:
+            self.recognize_speech_batch()
+            return
+        try:
+            self.__start_capture()
+            window, start, end = self.__sliding.next()
+            start_time = time.time()
+            with METRICS.timer("encode"):
+                audio = pcm16_to_float32(window, CHANNELS, FRAME_RATE)
+            audio, ranges = self.__speech_only(audio, start)
+            if audio is None:
+                return
+            with METRICS.timer("transcribe"):
+                result = self.__transcribe_window(audio, ranges)
+
+            with METRICS.timer("intent"):
+                state = match_command(result['text'], COMMAND_TABLE_EN_DE)
+            if state is not None and self.__duplicates.accept(state, start, end):
+                METRICS.counter("mcms_recognitions_total", command=state.name).inc()
+                self.command_queue.put(state)
+                self.__currentstate = state
+                if state == SpeechState.mode_long or state == SpeechState.mode_short:
+                    self.__previousstate = state
+            end_time = time.time()
+            self.__logger.info(f"Execution time of window transcription: {end_time - start_time:.2f} seconds, '{result['text']}'")
+        except Exception as e:
+            self.__fail(e)
+
+    def recognize_speech_streaming(self) -> None:
+        '''
+        Hands everything captured since the last call, at least STEP_SECONDS, to the streaming
+        transcriber and queues a command as soon as its words are committed, instead of
+        waiting for the end of a window. A catch-up after a slow pass is cut to what still fits
+        in the transcriber's buffer, the rest is read by the next call.
+        '''
+        try:
+            self.__start_capture()
+            step = int(FRAME_RATE * STEP_SECONDS)
+            backlog = self.__capture.position - self.__cursor
+            frames = min(max(step, backlog), max(step, self.__stream.room), WINDOW_FRAMES)
+            self.__cursor = self.__capture.read(self.__cursor, frames, self.__pcm[:frames])
+            start_time = time.time()
+            with METRICS.timer("encode"):
+                audio = pcm16_to_float32(self.__pcm[:frames], CHANNELS, FRAME_RATE)
+            state = self.__stream.accept(audio)
+            end_time = time.time()
+            self.__logger.info(f"Execution time of streaming pass: {end_time - start_time:.2f} seconds, "
+                               f"{frames / FRAME_RATE:.1f} s new audio, committed '{self.__stream.text}'")
+            if state is not None:
+                self.__logger.info("Command committed: %s", state.name)
+                METRICS.counter("mcms_recognitions_total", command=state.name).inc()
+                self.command_queue.put(state)
+                self.__currentstate = state
+                if state == SpeechState.mode_long or state == SpeechState.mode_short:
+                    self.__previousstate = state
+        except Exception as e:
+            self.__fail(e)
+
+    def recognize_speech_batch(self) -> None:
+        '''
+        Transcribes all overlapping windows that are already captured, up to the batch size,
+        in one forward pass instead of skipping them when decoding fell behind.
+        '''
+        try:
+            self.__start_capture()
+            batch = self.__sliding.next_batch(self.__batcher.max_batch)
+            start_time = time.time()
+            speech = []
+            for window, start, end in batch:
+                with METRICS.timer("encode"):
+                    audio = pcm16_to_float32(window, CHANNELS, FRAME_RATE)
+                audio, ranges = self.__speech_only(audio, start)
+                if audio is not None:
+                    speech.append((audio, ranges, start, end))
+            mel = self.__window_features([ranges for _, ranges, _, _ in speech]) if speech else None
+            texts = self.__batcher.transcribe_batch([audio for audio, _, _, _ in speech], mel)
+
+            for (audio, _, start, end), text in zip(speech, texts):
+                with METRICS.timer("intent"):
+                    state = match_command(text, COMMAND_TABLE_EN_DE)
+                if state is not None and self.__duplicates.accept(state, start, end):
+                    METRICS.counter("mcms_recognitions_total", command=state.name).inc()
+                    self.command_queue.put(state)
+                    self.__currentstate = state
+                    if state == SpeechState.mode_long or state == SpeechState.mode_short:
+                        self.__previousstate = state
+            end_time = time.time()
+            self.__logger.info(f"Execution time of batch transcription: {end_time - start_time:.2f} seconds, "
+                               f"{len(speech)} of {len(batch)} windows, {texts}")
+        except Exception as e:
+            self.__fail(e)
+
+    def recognize_speech_pool(self) -> None:
+        '''
+        Hands the next window to the transcription worker processes without waiting for its
+        text, the command is queued from the result callback. Blocks only while every worker
+        is busy.
+        '''
+        try:
+            self.__start_capture()
+            if self.__sliding:
+                window, start, end = self.__sliding.next()
+            else:
+                start = self.__cursor
+                self.__cursor = self.__capture.read(self.__cursor, WINDOW_FRAMES, self.__pcm)
+                window, end = self.__pcm, self.__cursor
+            with METRICS.timer("encode"):
+                audio = pcm16_to_float32(window, CHANNELS, FRAME_RATE)
+            audio, _ = self.__speech_only(audio, start)
+            if audio is None:
+                return
+            future = self.__pool.submit(audio)
+            number = self.__submitted
+            self.__submitted += 1
+            future.add_done_callback(lambda future: self.__on_transcribed(future, number, start, end))
+        except Exception as e:
+            self.__fail(e)
+
+    def __on_transcribed(self, future, number, start, end) -> None:
+        '''
+        Workers finish in any order, commands are queued in window order so a stop is never
+        followed by the start of an earlier window.
+        '''
+        try:
+            text = future.result()
+        except Exception as e:
+            self.__logger.error(f"Could not request results; {e}")
+            text = None
+        with self.__results_lock:
+            self.__finished[number] = (text, start, end)
+            while self.__delivered in self.__finished:
+                text, start, end = self.__finished.pop(self.__delivered)
+                self.__delivered += 1
+                if text is not None:
+                    self.__queue_command(text, start, end)
+
+    def __queue_command(self, text, start, end) -> None:
+        with METRICS.timer("intent"):
+            state = match_command(text, COMMAND_TABLE_EN_DE)
+        self.__logger.info(f"Window {start / FRAME_RATE:.1f}-{end / FRAME_RATE:.1f} s: '{text}'")
+        if state is None or (self.__sliding and not self.__duplicates.accept(state, start, end)):
+            return
+        METRICS.counter("mcms_recognitions_total", command=state.name).inc()
+        self.command_queue.put(state)
+        self.__currentstate = state
+        if state == SpeechState.mode_long or state == SpeechState.mode_short:
+            self.__previousstate = state
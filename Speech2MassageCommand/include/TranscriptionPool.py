@@ -0,0 +1,221 @@
+from concurrent.futures import Future
+from multiprocessing import shared_memory
+import logging
+import multiprocessing
+import os
+import queue
+import threading
+import time
+import numpy as np
+from include.Metrics import METRICS
+from include.WhisperEngine import load_whisper_engine, DEFAULT_ENGINE
+
+# Windows that can be in flight per worker process before submit() blocks
+SLOTS_PER_PROCESS = 2
+START_TIMEOUT = 300.0
+# Seconds between checks that the worker processes are still alive
+LIVENESS_SECONDS = 1.0
+
+def default_pool_size() -> int:
+    '''
+    Returns half the CPUs, at least one, since every worker runs a multi-threaded model of its own.
+    '''
+    return max(1, (os.cpu_count() or 2) // 2)
+
+
+class TranscriptionPool:
+    '''
+    Runs transcription in worker processes that each keep a resident Whisper model, loaded
+    with the given engine (see WhisperEngine.py), so decoding does not contend with capture
+    and dispatch for the GIL and several windows are decoded at once.
+
+    Windows are handed over through a shared memory block of float32 slots instead of being
+    pickled: submit() copies the window into a free slot and only the slot index and length
+    go through the task queue. The slot is released when its result comes back.
+
+    Workers mark the slot they decode in a shared array, so when a worker process dies its
+    window fails instead of holding the slot forever. So do windows no live worker marked,
+    since the dead one may have taken them off the task queue before marking them. Once no
+    worker is left, everything pending fails and submit() raises.
+    '''
+    def __init__(self, logger, model_name, processes=None, slot_frames=16000 * 30, engine=DEFAULT_ENGINE,
+                 decode_profile=None) -> None:
+        self.__logger = logger
+        self.processes = processes or default_pool_size()
+        self.__slot_frames = slot_frames
+        slots = self.processes * SLOTS_PER_PROCESS
+        self.__shm = shared_memory.SharedMemory(create=True, size=slots * slot_frames * 4)
+        self.__slots = np.ndarray((slots, slot_frames), dtype=np.float32, buffer=self.__shm.buf)
+        self.__free = queue.Queue()
+        for slot in range(slots):
+            self.__free.put(slot)
+        self.__pending = {}
+        self.__tickets = 0
+        self.__dead = set()
+        self.__closing = False
+        self.__collector = None
+
+        context = multiprocessing.get_context("spawn")
+        # Pid of the worker decoding each slot, 0 if none
+        self.__owners = context.Array("i", slots, lock=False)
+        self.__tasks = context.Queue()
+        self.__results = context.Queue()
+        self.__workers = [context.Process(target=_worker, name=f"transcribe-{index}",
+                                          args=(model_name, engine, decode_profile, self.__shm.name, slots,
+                                                slot_frames, self.__owners, self.__tasks, self.__results), daemon=True)
+                          for index in range(self.processes)]
+        for worker in self.__workers:
+            worker.start()
+        try:
+            self.__wait_ready()
+        except Exception:
+            self.close()
+            raise
+        self.__collector = threading.Thread(target=self.__collect, name="transcribe-results", daemon=True)
+        self.__collector.start()
+        logger.info("Transcription pool of %d processes with model %s, %d shared slots of %.1f s",
+                    self.processes, model_name, slots, slot_frames / 16000)
+
+    def __wait_ready(self) -> None:
+        # Every worker reports once its model is loaded and warmed up
+        deadline = time.monotonic() + START_TIMEOUT
+        ready = 0
+        while ready < len(self.__workers):
+            try:
+                message = self.__results.get(timeout=LIVENESS_SECONDS)
+            except queue.Empty:
+                dead = [worker for worker in self.__workers if not worker.is_alive()]
+                if dead:
+                    raise RuntimeError(f"Transcription worker {dead[0].name} exited with code {dead[0].exitcode} "
+                                       f"while starting")
+                if time.monotonic() > deadline:
+                    raise RuntimeError(f"Transcription workers not ready within {START_TIMEOUT:.0f} s")
+                continue
+            if message[0] == "error":
+                raise RuntimeError(f"Transcription worker failed to start: {message[1]}")
+            ready += 1
+
+    def submit(self, audio) -> Future:
+        '''
+        Queues a float32 16 kHz window for transcription and returns a Future of its text.
+        Blocks while all slots are in flight, raises RuntimeError when no worker is left and
+        ValueError when the window is longer than a slot.
+        '''
+        frames = len(audio)
+        if frames > self.__slot_frames:
+            raise ValueError(f"Window of {frames} frames does not fit in the {self.__slot_frames} frames of a slot")
+        while True:
+            if len(self.__dead) == len(self.__workers):
+                raise RuntimeError("No transcription worker left")
+            try:
+                slot = self.__free.get(timeout=LIVENESS_SECONDS)
+                break
+            except queue.Empty:
+                pass
+        self.__slots[slot, :frames] = audio[:frames]
+        future = Future()
+        # A result of an earlier use of the slot, from a worker that died, is told apart by the ticket
+        self.__tickets += 1
+        self.__pending[slot] = (future, time.perf_counter(), self.__tickets)
+        self.__tasks.put((slot, frames, self.__tickets))
+        return future
+
+    def __collect(self) -> None:
+        while True:
+            try:
+                message = self.__results.get(timeout=LIVENESS_SECONDS)
+            except queue.Empty:
+                self.__check_workers()
+                continue
+            if message is None:
+                return
+            kind, slot, ticket, payload, elapsed = message
+            entry = self.__pending.get(slot)
+            if entry is None or entry[2] != ticket:
+                # Already failed when its worker died
+                continue
+            future, submitted, _ = self.__pending.pop(slot)
+            self.__owners[slot] = 0
+            self.__free.put(slot)
+            METRICS.observe_stage("transcribe", elapsed)
+            METRICS.observe_stage("pool_wait", time.perf_counter() - submitted - elapsed)
+            if kind == "ok":
+                future.set_result(payload)
+            else:
+                future.set_exception(RuntimeError(payload))
+            self.__check_workers()
+
+    def __check_workers(self) -> None:
+        if self.__closing:
+            return
+        died = [worker for worker in self.__workers if not worker.is_alive() and worker.pid not in self.__dead]
+        for worker in died:
+            self.__dead.add(worker.pid)
+            self.__logger.error("Transcription worker %s exited with code %s", worker.name, worker.exitcode)
+        if died:
+            # Windows of the dead workers, and the ones they may have taken before marking them
+            live = {worker.pid for worker in self.__workers if worker.pid not in self.__dead}
+            for slot in list(self.__pending):
+                if self.__owners[slot] not in live:
+                    self.__fail(slot, f"Transcription worker {died[0].name} died")
+        if len(self.__dead) == len(self.__workers):
+            # Nobody takes the queued windows any more
+            for slot in list(self.__pending):
+                self.__fail(slot, "No transcription worker left")
+
+    def __fail(self, slot, reason) -> None:
+        self.__owners[slot] = 0
+        entry = self.__pending.pop(slot, None)
+        if entry is None:
+            return
+        self.__free.put(slot)
+        entry[0].set_exception(RuntimeError(reason))
+
+    def close(self) -> None:
+        self.__closing = True
+        for _ in self.__workers:
+            self.__tasks.put(None)
+        for worker in self.__workers:
+            worker.join(timeout=5.0)
+            if worker.is_alive():
+                worker.terminate()
+        if self.__collector is not None:
+            self.__results.put(None)
+            self.__collector.join(timeout=5.0)
+            self.__collector = None
+        self.__slots = None
+        self.__shm.close()
+        self.__shm.unlink()
+
+
+def _worker(model_name, engine, decode_profile, shm_name, slots, slot_frames, owners, tasks, results) -> None:
+    logging.basicConfig(format='%(asctime)s  [%(processName)-14s] [%(levelname)-7s]  %(message)s', level=logging.INFO)
+    logger = logging.getLogger("transcribe")
+    try:
+        model, _ = load_whisper_engine(logger, model_name, engine)
+        shm = shared_memory.SharedMemory(name=shm_name)
+    except Exception as err:
+        results.put(("error", str(err)))
+        return
+    audio_slots = np.ndarray((slots, slot_frames), dtype=np.float32, buffer=shm.buf)
+    results.put(("ready", os.getpid()))
+
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        slot, frames, ticket = task
+        owners[slot] = os.getpid()
+        start = time.perf_counter()
+        try:
+            # The slot stays reserved until the result is back, the model can read it in place
+            audio = audio_slots[slot, :frames]
+            if decode_profile is not None:
+                text = decode_profile.transcribe(model, audio)["text"]
+            else:
+                text = model.transcribe(audio, fp16=False)["text"]
+            results.put(("ok", slot, ticket, text, time.perf_counter() - start))
+        except Exception as err:
+            results.put(("error", slot, ticket, str(err), time.perf_counter() - start))
+    del audio_slots
+    shm.close()
@@ -0,0 +1,85 @@
+import numpy as np
+
+FRAME_MS = 30
+THRESHOLD_DB = 9.0
+ZCR_MAX = 0.35
+MIN_SPEECH_MS = 120
+PADDING_MS = 240
+NOISE_ADAPTATION = 0.1
+
+class VoiceActivityDetector:
+    '''
+    Frame-level energy and zero-crossing voice activity detection on float32 mono audio,
+    vectorized over the whole window. A frame is speech when its energy is THRESHOLD_DB above
+    the adaptive noise floor and it is not hiss (high zero-crossing rate at low energy).
+    The noise floor follows the energy of the non-speech frames of every window.
+    '''
+    def __init__(self, rate=16000, frame_ms=FRAME_MS, threshold_db=THRESHOLD_DB, zcr_max=ZCR_MAX,
+                 min_speech_ms=MIN_SPEECH_MS, padding_ms=PADDING_MS, noise_adaptation=NOISE_ADAPTATION) -> None:
+        self.__frame = int(rate * frame_ms / 1000)
+        self.__threshold_db = threshold_db
+        self.__zcr_max = zcr_max
+        self.__min_speech = max(1, min_speech_ms // frame_ms)
+        self.__padding = padding_ms // frame_ms
+        self.__adaptation = noise_adaptation
+        self.noise_floor_db = None
+        self.windows_total = 0
+        self.windows_skipped = 0
+
+    def segments(self, audio):
+        '''
+        Returns the speech segments of the window as a list of (start, end) sample indices.
+        '''
+        count = len(audio) // self.__frame
+        if count == 0:
+            return []
+        frames = audio[:count * self.__frame].reshape(count, self.__frame)
+        energy_db = 10.0 * np.log10(np.mean(frames * frames, axis=1) + 1e-10)
+        zcr = np.mean(np.signbit(frames[:, 1:]) != np.signbit(frames[:, :-1]), axis=1)
+
+        if self.noise_floor_db is None:
+            self.noise_floor_db = float(np.percentile(energy_db, 10))
+        above = energy_db - self.noise_floor_db
+        speech = (above > self.__threshold_db) & ((zcr < self.__zcr_max) | (above > 2 * self.__threshold_db))
+
+        # Let the floor follow the background, and drop at once if the room got quieter
+        if not speech.all():
+            noise = float(np.mean(energy_db[~speech]))
+            self.noise_floor_db += self.__adaptation * (noise - self.noise_floor_db)
+        self.noise_floor_db = min(self.noise_floor_db, float(energy_db.min()) + self.__threshold_db / 2)
+
+        # Drop short bursts, then pad the remaining segments so word edges are not cut
+        edges = np.flatnonzero(np.diff(np.concatenate(([0], speech.astype(np.int8), [0]))))
+        result = []
+        for start, end in zip(edges[::2], edges[1::2]):
+            if end - start < self.__min_speech:
+                continue
+            start = max(0, start - self.__padding)
+            end = min(count, end + self.__padding)
+            if result and start <= result[-1][1]:
+                result[-1] = (result[-1][0], end)
+            else:
+                result.append((start, end))
+        return [(int(start) * self.__frame, int(end) * self.__frame) for start, end in result]
+
+    def speech(self, audio):
+        '''
+        Counts the window and returns its speech segments, an empty list if it is skipped.
+        '''
+        self.windows_total += 1
+        segments = self.segments(audio)
+        if not segments:
+            self.windows_skipped += 1
+        return segments
+
+    def trim(self, audio):
+        '''
+        Returns the window reduced to its speech segments, or None if it contains no speech.
+        '''
+        segments = self.speech(audio)
+        if not segments:
+            return None
+        if len(segments) == 1:
+            start, end = segments[0]
+            return audio[start:end]
+        return np.concatenate([audio[start:end] for start, end in segments])
@@ -0,0 +1,142 @@
+from concurrent.futures import Future
+import dataclasses
+import queue
+import threading
+import time
+import numpy as np
+from include.Metrics import METRICS
+
+MAX_BATCH = 8
+MAX_WAIT_SECONDS = 0.05
+
+class WhisperBatcher:
+    '''
+    Transcribes several windows in one forward pass of a Whisper model. The log-mel
+    spectrograms of the whole batch are computed in one vectorized STFT and the encoder and
+    the greedy decoder run over the batch together, so throughput grows with the batch size.
+
+    transcribe_batch() decodes a list of windows directly. transcribe() can be called from
+    many threads: requests are collected until max_batch are pending or the oldest waited
+    max_wait seconds, and every caller gets its own text back.
+
+    With several languages the language of every window is detected among those only, from
+    the encoder output of the batch, and the windows are decoded in one pass per language.
+    '''
+    def __init__(self, logger, model, max_batch=MAX_BATCH, max_wait=MAX_WAIT_SECONDS, languages=(),
+                 **decode_options) -> None:
+        import torch
+        import whisper
+        self.__logger = logger
+        self.__model = model
+        self.__torch = torch
+        self.__whisper = whisper
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.__options = whisper.DecodingOptions(**{"fp16": False, **decode_options})
+        self.__languages = tuple(languages or ()) if len(languages or ()) > 1 else ()
+        self.__window = torch.hann_window(whisper.audio.N_FFT).to(model.device)
+        self.__filters = whisper.audio.mel_filters(model.device, model.dims.n_mels)
+        self.__requests = queue.Queue()
+        self.__thread = None
+        self.__lock = threading.Lock()
+        self.batches = 0
+        self.windows = 0
+
+    def log_mel_batch(self, audios):
+        '''
+        Returns the log-mel spectrograms of the windows as one (batch, n_mels, 3000) tensor,
+        each window padded to 30 seconds and normalized by its own maximum like
+        whisper.log_mel_spectrogram() does for a single window.
+        '''
+        torch, audio = self.__torch, self.__whisper.audio
+        batch = np.zeros((len(audios), audio.N_SAMPLES), dtype=np.float32)
+        for row, samples in enumerate(audios):
+            samples = samples[:audio.N_SAMPLES]
+            batch[row, :len(samples)] = samples
+        stft = torch.stft(torch.from_numpy(batch).to(self.__model.device), audio.N_FFT, audio.HOP_LENGTH,
+                          window=self.__window, return_complex=True)
+        magnitudes = stft[..., :-1].abs() ** 2
+        log_spec = torch.clamp(self.__filters @ magnitudes, min=1e-10).log10()
+        log_spec = torch.maximum(log_spec, log_spec.amax(dim=(-2, -1), keepdim=True) - 8.0)
+        return (log_spec + 4.0) / 4.0
+
+    def transcribe_batch(self, audios, mel=None):
+        '''
+        Returns the texts of a list of float32 16 kHz windows of at most 30 seconds. mel are
+        their (batch, n_mels, 3000) features if already computed, e.g. by LogMelFrontend.
+        '''
+        if not audios:
+            return []
+        if mel is None:
+            with METRICS.timer("encode"):
+                mel = self.log_mel_batch(audios)
+        else:
+            mel = self.__torch.as_tensor(mel).to(self.__model.device)
+        start = time.perf_counter()
+        with self.__torch.no_grad():
+            if self.__languages:
+                results = self.__decode_by_language(mel)
+            else:
+                results = self.__whisper.decode(self.__model, mel, self.__options)
+        elapsed = time.perf_counter() - start
+        # The batch shares one forward pass, every window waited for all of it
+        for _ in audios:
+            METRICS.observe_stage("transcribe", elapsed)
+        METRICS.counter("mcms_whisper_batches_total").inc()
+        METRICS.counter("mcms_whisper_batched_windows_total").inc(len(audios))
+        self.batches += 1
+        self.windows += len(audios)
+        return [result.text for result in results]
+
+    def __decode_by_language(self, mel):
+        # Encoded once, detect_language() and decode() both skip the encoder on its output
+        features = self.__model.embed_audio(mel)
+        _, probs = self.__model.detect_language(features)
+        rows = {}
+        for row, row_probs in enumerate(probs):
+            language = max(self.__languages, key=lambda language: row_probs.get(language, 0.0))
+            rows.setdefault(language, []).append(row)
+        results = [None] * len(probs)
+        for language, indices in rows.items():
+            options = dataclasses.replace(self.__options, language=language)
+            decoded = self.__whisper.decode(self.__model, features[indices], options)
+            for row, result in zip(indices, decoded):
+                results[row] = result
+        return results
+
+    def transcribe(self, audio) -> str:
+        '''
+        Queues one window for the next batch and blocks until its text is decoded.
+        '''
+        if self.__thread is None:
+            self.__start()
+        future = Future()
+        self.__requests.put((audio, future))
+        return future.result()
+
+    def __start(self) -> None:
+        with self.__lock:
+            if self.__thread is None:
+                self.__thread = threading.Thread(target=self.__run, name="whisper-batch", daemon=True)
+                self.__thread.start()
+
+    def __run(self) -> None:
+        while True:
+            pending = [self.__requests.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(pending) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    pending.append(self.__requests.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            try:
+                texts = self.transcribe_batch([audio for audio, _ in pending])
+                for (_, future), text in zip(pending, texts):
+                    future.set_result(text)
+            except Exception as err:
+                self.__logger.error("Batch of %d windows failed: %s", len(pending), err)
+                for _, future in pending:
+                    future.set_exception(err)
@@ -0,0 +1,122 @@
+import numpy as np
+from include.Commands import COMMAND_TABLE_EN_DE, find_command, split_words
+from include.Metrics import METRICS
+
+FRAME_RATE = 16000
+# Audio added to the buffer between two decoding passes
+STEP_SECONDS = 1.0
+# Longest audio re-decoded per pass, older audio is dropped with its committed words
+BUFFER_SECONDS = 8.0
+# Silent steps after which the utterance is over and the buffer starts afresh
+SILENT_STEPS = 2
+# Committed words of earlier utterances handed to the decoder as context
+PROMPT_WORDS = 20
+
+class StreamingTranscriber:
+    '''
+    Streaming recognition with Whisper, which only decodes whole windows: audio is appended
+    to a buffer in short steps and the growing buffer is decoded again after every step.
+    A word is committed once two consecutive passes agree on it (local agreement), so a
+    command is reported about two steps after it was spoken instead of after a full window.
+
+    The buffer is started afresh after a committed command, at the end of an utterance
+    (SILENT_STEPS steps without speech) and when it exceeds buffer_seconds. The words
+    committed before are kept as the decoder prompt, together with the decode profile's.
+    '''
+    def __init__(self, model, command_table=COMMAND_TABLE_EN_DE, decode_profile=None, vad=None,
+                 buffer_seconds=BUFFER_SECONDS) -> None:
+        self.__model = model
+        self.__command_table = command_table
+        self.__profile = decode_profile
+        self.__vad = vad
+        self.__max_frames = int(FRAME_RATE * buffer_seconds)
+        self.__history = []
+        self.passes = 0
+        self.reset()
+
+    def reset(self) -> None:
+        '''
+        Drops the buffered audio and the uncommitted words, e.g. after the capture restarted.
+        '''
+        self.__audio = np.zeros(0, dtype=np.float32)
+        self.__committed = []
+        self.__previous = []
+        self.__silent_steps = 0
+        self.__language = None
+
+    def accept(self, audio):
+        '''
+        Appends a float32 16 kHz step to the buffer and decodes it. Returns the state of a
+        command among the newly committed words, or None.
+        '''
+        if self.__vad is not None:
+            with METRICS.timer("vad"):
+                speech = bool(self.__vad.segments(audio))
+            if not speech:
+                if not len(self.__audio):
+                    return None
+                self.__silent_steps += 1
+                if self.__silent_steps > SILENT_STEPS:
+                    self.__restart()
+                    return None
+            else:
+                self.__silent_steps = 0
+        if len(self.__audio) + len(audio) > self.__max_frames:
+            self.__restart()
+            # A step longer than the buffer keeps its most recent audio only
+            audio = audio[-self.__max_frames:]
+        self.__audio = np.concatenate((self.__audio, audio))
+
+        with METRICS.timer("transcribe"):
+            result = self.__model.transcribe(self.__audio, **self.__options())
+        self.passes += 1
+        hypothesis = split_words(result["text"])
+
+        # Commit the longest prefix the last two passes agree on
+        agreed = 0
+        for current, previous in zip(hypothesis, self.__previous):
+            if current != previous:
+                break
+            agreed += 1
+        self.__previous = hypothesis
+        if agreed <= len(self.__committed):
+            return None
+        self.__committed = hypothesis[:agreed]
+
+        with METRICS.timer("intent"):
+            _, state = find_command(self.__committed, self.__command_table)
+        if state is None:
+            return None
+        # The command is handled, its audio must not be heard again
+        self.__restart()
+        return state
+
+    @property
+    def room(self) -> int:
+        '''
+        Returns the frames the buffer takes before it is started afresh.
+        '''
+        return self.__max_frames - len(self.__audio)
+
+    @property
+    def text(self) -> str:
+        '''
+        Returns the committed words of the current buffer.
+        '''
+        return " ".join(self.__committed)
+
+    def __restart(self) -> None:
+        self.__history = (self.__history + self.__committed)[-PROMPT_WORDS:]
+        self.reset()
+
+    def __options(self) -> dict:
+        if self.__profile is None:
+            options = {"fp16": False, "temperature": 0.0, "condition_on_previous_text": False}
+            prompt = ""
+        else:
+            if self.__language is None:
+                self.__language = self.__profile.language_for(self.__model, self.__audio)
+            options = self.__profile.options(self.__language)
+            prompt = options["initial_prompt"]
+        options["initial_prompt"] = " ".join([prompt] + self.__history).strip() or None
+        return options
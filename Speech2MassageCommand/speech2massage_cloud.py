@@ -1,6 +1,28 @@
-import logging, socket, psutil
+import logging, os, socket
 from   include.SpeechController_Cloud import SpeechController
 from   include.SpeechController_Cloud import SpeechState
+from   include.AudioSource import create_audio_source
+from   include.HedgedRecognizer import vosk_backend
+from   include.ModelLoader import load_vosk_model
+from   include.Metrics import start_metrics
+from   include.ServiceDiscovery import ServiceDiscovery
+
+# Listen continuously and recognize utterances concurrently instead of one listen-recognize
+# round trip at a time, commands still come out in the order they were spoken
+BACKGROUND = True
+
+# Vosk model also decoding every utterance locally, racing the cloud (hedged recognition).
+# Empty to use the cloud only
+LOCAL_MODEL = os.environ.get("MCMS_LOCAL_MODEL", "")
+
+# Audio input: mic[:<device name or index>], wav:<path>, pcm:<path or ->,<rate>,<channels>
+# or unix:<socket path>,<rate>,<channels>
+AUDIO_SOURCE = os.environ.get("MCMS_AUDIO_SOURCE", "mic")
+
+# Local port of the Prometheus /metrics endpoint, 0 to disable
+METRICS_PORT = int(os.environ.get("MCMS_METRICS_PORT", "9150"))
+# File the metrics are written to as JSON every minute, empty to disable
+METRICS_DUMP = os.environ.get("MCMS_METRICS_DUMP", "")
 
 # --------------------------------------------------
 # *  Section:  Main - Subroutines                  *
@@ -23,14 +45,6 @@ def mainGetLocalIpAddress() -> str:
     return ip
 
 
-def find_service_ip_by_port(port_number):
-    for conn in psutil.net_connections():
-        if conn.status == psutil.CONN_LISTEN and conn.type == socket.SOCK_STREAM and conn.laddr.port == port_number:
-            ip_address = conn.laddr.ip
-            return ip_address
-    return None
-
-
 if __name__ == '__main__':
 
     name = "speech2Massage"
@@ -43,17 +57,30 @@ if __name__ == '__main__':
     #locIp   = mainGetLocalIpAddress()
     #locPort = 50001
 
+    start_metrics(logger, METRICS_PORT, METRICS_DUMP)
+
     restPort = 50000
-    restIp = find_service_ip_by_port(restPort)
+    # Override with MCMS_REST_ADDRESS, otherwise the last known address or a local probe
+    discovery = ServiceDiscovery(logger, restPort)
+    restIp = discovery.resolve()
 
-    sc = SpeechController(logger)
-    while True:
+    audio_source = create_audio_source(logger, AUDIO_SOURCE)
+    local_backend = None
+    if LOCAL_MODEL:
+        model, _ = load_vosk_model(logger, LOCAL_MODEL)
+        local_backend = vosk_backend(model)
+    sc = SpeechController(logger, audio_source=audio_source, background=BACKGROUND, local_backend=local_backend)
+    # Open the keep-alive connection and upload the sequences before the first command
+    sc.connect(restIp, restPort, discovery)
+    # A file or stdin source ends, the microphone does not
+    while not sc.finished:
         speechstate = sc.recognize_speech()
+        restIp, restPort = discovery.address
         if speechstate == SpeechState.mode_long:
             sc.start_mode_long(restIp, restPort)
         elif speechstate == SpeechState.mode_short:
             sc.start_mode_short(restIp, restPort)
         elif speechstate == SpeechState.stop:
             sc.stop_mode(restIp, restPort)
-        else:
+        elif not sc.finished:
             logger.error("Error %s", speechstate)
\ No newline at end of file
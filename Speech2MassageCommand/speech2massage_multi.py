@@ -0,0 +1,40 @@
+import logging, os
+from   include.MultiStation import StationServer, load_config
+from   include.Metrics import start_metrics
+
+# Stations served by this process: backend, model, worker count and one entry per chair
+# mapping its audio source to its REST endpoint, see assets/stations.json
+STATIONS_CONFIG = os.environ.get("MCMS_STATIONS", "assets/stations.json")
+
+# Local port of the Prometheus /metrics endpoint, 0 to disable
+METRICS_PORT = int(os.environ.get("MCMS_METRICS_PORT", "9150"))
+# File the metrics are written to as JSON every minute, empty to disable
+METRICS_DUMP = os.environ.get("MCMS_METRICS_DUMP", "")
+
+# --------------------------------------------------
+# *  Section:  Main - Subroutines                  *
+# --------------------------------------------------
+def mainReturnLogger(name:str, level:str):
+    logging.basicConfig(format='%(asctime)s  [%(filename)-16s] [%(levelname)-7s] [%(funcName)-20s]  %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
+    logger = logging.getLogger(name)
+    logger.setLevel(level)
+    return(logger)
+
+
+if __name__ == '__main__':
+
+    name = "speech2Massage"
+    logger = mainReturnLogger(name, logging.INFO)
+    logger.info('------------------------------------------------------------')
+    logger.info(f'***  {name} multi-station                    ***')
+    logger.info('------------------------------------------------------------')
+
+    start_metrics(logger, METRICS_PORT, METRICS_DUMP)
+
+    server = StationServer(logger, load_config(STATIONS_CONFIG))
+    try:
+        server.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stop()
@@ -1,6 +1,33 @@
-import logging, socket, psutil, threading, queue
+import logging, os, socket, threading
 from   include.SpeechController_Vosk_Th import SpeechController
 from   include.SpeechController_Vosk_Th import SpeechState
+from   include.AudioSource import create_audio_source
+from   include.Metrics import start_metrics
+from   include.ServiceDiscovery import ServiceDiscovery
+from   include.CommandProcessor import CommandProcessor
+from   include.CommandQueue import CommandQueue
+
+# Feed the recognizer chunk by chunk and queue commands as soon as they are stable
+STREAMING = True
+# Restrict the recognizer to the command phrases instead of the full model vocabulary
+GRAMMAR = True
+# (window seconds, hop seconds) for overlapping windows when STREAMING is off, None for back-to-back windows
+SLIDING_WINDOW = None
+
+# Recognized commands that waited longer than this many seconds for dispatch are dropped (a stop never is),
+# None keeps them all. Only the latest queued command is dispatched either way
+COMMAND_MAX_AGE = 3.0
+# Dispatch stops in a lane of their own, ahead of queued commands and cancelling a start in flight
+PRIORITY_STOP = True
+
+# Audio input: mic[:<device name or index>], wav:<path>, pcm:<path or ->,<rate>,<channels>
+# or unix:<socket path>,<rate>,<channels>
+AUDIO_SOURCE = os.environ.get("MCMS_AUDIO_SOURCE", "mic")
+
+# Local port of the Prometheus /metrics endpoint, 0 to disable
+METRICS_PORT = int(os.environ.get("MCMS_METRICS_PORT", "9150"))
+# File the metrics are written to as JSON every minute, empty to disable
+METRICS_DUMP = os.environ.get("MCMS_METRICS_DUMP", "")
 
 # --------------------------------------------------
 # *  Section:  Main - Subroutines                  *
@@ -23,33 +50,15 @@ def mainGetLocalIpAddress() -> str:
     return ip
 
 
-def find_service_ip_by_port(port_number):
-    for conn in psutil.net_connections():
-        if conn.status == psutil.CONN_LISTEN and conn.type == socket.SOCK_STREAM and conn.laddr.port == port_number:
-            ip_address = conn.laddr.ip
-            return ip_address
-    return None
-
-
 def recognize_speech_thread(sc):
     logger.info('Starting recognize speech thread')
-    while True:
+    # A file or stdin source ends, the microphone does not
+    while not sc.finished:
         sc.recognize_speech()
 
 
-def process_command_thread(sc, restIp, restPort):
-    logger.info('Starting process command thread')
-    while True:
-        speechstate = sc.command_queue.get()
-        if speechstate == SpeechState.mode_long:
-            sc.start_mode_long(restIp, restPort)
-        elif speechstate == SpeechState.mode_short:
-            sc.start_mode_short(restIp, restPort)
-        elif speechstate == SpeechState.stop:
-            sc.stop_mode(restIp, restPort)
-        elif speechstate == SpeechState.error:
-            sc.__logger.error("Error %s", speechstate)
-            break
+def process_command_thread(sc, discovery):
+    CommandProcessor(logger, sc.command_queue, sc, *discovery.address, discovery=discovery).run()
 
 if __name__ == '__main__':
 
@@ -59,14 +68,21 @@ if __name__ == '__main__':
     logger.info(f'***  {name}                                  ***')
     logger.info('------------------------------------------------------------')
 
+    start_metrics(logger, METRICS_PORT, METRICS_DUMP)
+
     restPort = 50000
-    restIp = find_service_ip_by_port(restPort)
+    # Override with MCMS_REST_ADDRESS, otherwise the last known address or a local probe
+    discovery = ServiceDiscovery(logger, restPort)
+    restIp = discovery.resolve()
 
-    command_queue = queue.Queue()
-    sc = SpeechController(logger, command_queue)
+    command_queue = CommandQueue(max_age=COMMAND_MAX_AGE, stop_lane=PRIORITY_STOP)
+    audio_source = create_audio_source(logger, AUDIO_SOURCE)
+    sc = SpeechController(logger, command_queue, streaming=STREAMING, grammar=GRAMMAR, sliding_window=SLIDING_WINDOW, audio_source=audio_source)
+    # Open the keep-alive connection and upload the sequences before the first command
+    sc.connect(restIp, restPort, discovery)
 
     recognize_thread = threading.Thread(target=recognize_speech_thread, args=(sc,))
-    process_thread = threading.Thread(target=process_command_thread, args=(sc, restIp, restPort))
+    process_thread = threading.Thread(target=process_command_thread, args=(sc, discovery))
 
     recognize_thread.start()
     process_thread.start()
@@ -1,6 +1,51 @@
-import logging, socket, psutil, threading, queue
+import logging, os, socket, threading
 from   include.SpeechController_Whisper_Th import SpeechController
 from   include.SpeechController_Whisper_Th import SpeechState
+from   include.AudioSource import create_audio_source
+from   include.Metrics import start_metrics
+from   include.ServiceDiscovery import ServiceDiscovery
+from   include.CommandProcessor import CommandProcessor
+from   include.CommandQueue import CommandQueue
+from   include.Commands import COMMAND_TABLE_EN_DE
+from   include.DecodeProfile import DecodeProfile
+
+# Decode a growing buffer every second and queue a command once two passes agree on it,
+# instead of transcribing whole windows. Not combined with PROCESSES
+STREAMING = False
+# (window seconds, hop seconds) for overlapping windows, None for back-to-back RECORD_SECONDS windows
+SLIDING_WINDOW = (3, 1)
+# Skip windows without speech instead of transcribing silence
+VAD = True
+# Compute the log-mel features while capturing instead of after each window (PyTorch engines)
+FEATURES = True
+# Windows that piled up while decoding are transcribed together in one batch of up to this size, 1 to disable
+BATCH_SIZE = 4
+# Transcribe in this many worker processes, each with a resident model, instead of in the
+# recognition thread. 0 decodes in-process, set per host with MCMS_POOL_SIZE
+PROCESSES = int(os.environ.get("MCMS_POOL_SIZE", "0"))
+
+# Whisper inference engine: torch (float32), torch-int8 (dynamically quantized linear layers)
+# or ctranslate2 (int8 CTranslate2 export run by faster-whisper)
+WHISPER_ENGINE = os.environ.get("MCMS_WHISPER_ENGINE", "torch")
+# Decode with the fast command profile: language only among LANGUAGES, greedy, no timestamps,
+# few tokens and the command words as prompt. False uses the stock transcribe() settings
+FAST_DECODE = True
+LANGUAGES = ("en", "de")
+
+# Recognized commands that waited longer than this many seconds for dispatch are dropped (a stop never is),
+# None keeps them all. Only the latest queued command is dispatched either way
+COMMAND_MAX_AGE = 3.0
+# Dispatch stops in a lane of their own, ahead of queued commands and cancelling a start in flight
+PRIORITY_STOP = True
+
+# Audio input: mic[:<device name or index>], wav:<path>, pcm:<path or ->,<rate>,<channels>
+# or unix:<socket path>,<rate>,<channels>
+AUDIO_SOURCE = os.environ.get("MCMS_AUDIO_SOURCE", "mic")
+
+# Local port of the Prometheus /metrics endpoint, 0 to disable
+METRICS_PORT = int(os.environ.get("MCMS_METRICS_PORT", "9150"))
+# File the metrics are written to as JSON every minute, empty to disable
+METRICS_DUMP = os.environ.get("MCMS_METRICS_DUMP", "")
 
 # --------------------------------------------------
 # *  Section:  Main - Subroutines                  *
@@ -23,33 +68,15 @@ def mainGetLocalIpAddress() -> str:
     return ip
 
 
-def find_service_ip_by_port(port_number):
-    for conn in psutil.net_connections():
-        if conn.status == psutil.CONN_LISTEN and conn.type == socket.SOCK_STREAM and conn.laddr.port == port_number:
-            ip_address = conn.laddr.ip
-            return ip_address
-    return None
-
-
 def recognize_speech_thread(sc):
     logger.info('Starting recognize speech thread')
-    while True:
+    # A file or stdin source ends, the microphone does not
+    while not sc.finished:
         sc.recognize_speech()
 
 
-def process_command_thread(sc, restIp, restPort):
-    logger.info('Starting process command thread')
-    while True:
-        speechstate = sc.command_queue.get()
-        if speechstate == SpeechState.mode_long:
-            sc.start_mode_long(restIp, restPort)
-        elif speechstate == SpeechState.mode_short:
-            sc.start_mode_short(restIp, restPort)
-        elif speechstate == SpeechState.stop:
-            sc.stop_mode(restIp, restPort)
-        elif speechstate == SpeechState.error:
-            sc.__logger.error("Error %s", speechstate)
-            break
+def process_command_thread(sc, discovery):
+    CommandProcessor(logger, sc.command_queue, sc, *discovery.address, discovery=discovery).run()
 
 if __name__ == '__main__':
 
@@ -59,14 +86,24 @@ if __name__ == '__main__':
     logger.info(f'***  {name}                                  ***')
     logger.info('------------------------------------------------------------')
 
-    restPort = 50000
-    restIp = find_service_ip_by_port(restPort)
+    start_metrics(logger, METRICS_PORT, METRICS_DUMP)
 
-    command_queue = queue.Queue()
-    sc = SpeechController(logger, command_queue)
+    restPort = 50000
+    # Override with MCMS_REST_ADDRESS, otherwise the last known address or a local probe
+    discovery = ServiceDiscovery(logger, restPort)
+    restIp = discovery.resolve()
+
+    command_queue = CommandQueue(max_age=COMMAND_MAX_AGE, stop_lane=PRIORITY_STOP)
+    audio_source = create_audio_source(logger, AUDIO_SOURCE)
+    sc = SpeechController(logger, command_queue, sliding_window=SLIDING_WINDOW, vad=VAD, audio_source=audio_source,
+                          batch_size=BATCH_SIZE, processes=PROCESSES, engine=WHISPER_ENGINE,
+                          decode_profile=DecodeProfile(LANGUAGES, COMMAND_TABLE_EN_DE) if FAST_DECODE else None,
+                          streaming=STREAMING, features=FEATURES)
+    # Open the keep-alive connection and upload the sequences before the first command
+    sc.connect(restIp, restPort, discovery)
 
     recognize_thread = threading.Thread(target=recognize_speech_thread, args=(sc,))
-    process_thread = threading.Thread(target=process_command_thread, args=(sc, restIp, restPort))
+    process_thread = threading.Thread(target=process_command_thread, args=(sc, discovery))
 
     recognize_thread.start()
     process_thread.start()
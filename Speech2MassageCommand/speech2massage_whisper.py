@@ -1,6 +1,26 @@
-import logging, socket, psutil
+import logging, os, socket
 from   include.SpeechController_Whisper import SpeechController
 from   include.SpeechController_Whisper import SpeechState
+from   include.AudioSource import create_audio_source
+from   include.Metrics import start_metrics
+from   include.ServiceDiscovery import ServiceDiscovery
+from   include.DecodeProfile import DecodeProfile
+
+# Whisper inference engine: torch (float32), torch-int8 (dynamically quantized linear layers)
+# or ctranslate2 (int8 CTranslate2 export run by faster-whisper)
+WHISPER_ENGINE = os.environ.get("MCMS_WHISPER_ENGINE", "torch")
+# Decode with the fast command profile: English only, greedy, no timestamps, few tokens and
+# the command words as prompt. False uses the stock transcribe() settings
+FAST_DECODE = True
+
+# Audio input: mic[:<device name or index>], wav:<path>, pcm:<path or ->,<rate>,<channels>
+# or unix:<socket path>,<rate>,<channels>
+AUDIO_SOURCE = os.environ.get("MCMS_AUDIO_SOURCE", "mic")
+
+# Local port of the Prometheus /metrics endpoint, 0 to disable
+METRICS_PORT = int(os.environ.get("MCMS_METRICS_PORT", "9150"))
+# File the metrics are written to as JSON every minute, empty to disable
+METRICS_DUMP = os.environ.get("MCMS_METRICS_DUMP", "")
 
 # --------------------------------------------------
 # *  Section:  Main - Subroutines                  *
@@ -23,14 +43,6 @@ def mainGetLocalIpAddress() -> str:
     return ip
 
 
-def find_service_ip_by_port(port_number):
-    for conn in psutil.net_connections():
-        if conn.status == psutil.CONN_LISTEN and conn.type == socket.SOCK_STREAM and conn.laddr.port == port_number:
-            ip_address = conn.laddr.ip
-            return ip_address
-    return None
-
-
 if __name__ == '__main__':
 
     name = "speech2Massage"
@@ -43,17 +55,26 @@ if __name__ == '__main__':
     #locIp   = mainGetLocalIpAddress()
     #locPort = 50001
 
+    start_metrics(logger, METRICS_PORT, METRICS_DUMP)
+
     restPort = 50000
-    restIp = find_service_ip_by_port(restPort)
+    # Override with MCMS_REST_ADDRESS, otherwise the last known address or a local probe
+    discovery = ServiceDiscovery(logger, restPort)
+    restIp = discovery.resolve()
 
-    sc = SpeechController(logger)
-    while True:
+    audio_source = create_audio_source(logger, AUDIO_SOURCE)
+    sc = SpeechController(logger, audio_source=audio_source, engine=WHISPER_ENGINE,
+                          decode_profile=DecodeProfile(("en",)) if FAST_DECODE else None)
+    # Open the keep-alive connection and upload the sequences before the first command
+    sc.connect(restIp, restPort, discovery)
+    while not sc.finished:
         speechstate = sc.recognize_speech()
+        restIp, restPort = discovery.address
         if speechstate == SpeechState.mode_long:
             sc.start_mode_long(restIp, restPort)
         elif speechstate == SpeechState.mode_short:
             sc.start_mode_short(restIp, restPort)
         elif speechstate == SpeechState.stop:
             sc.stop_mode(restIp, restPort)
-        else:
+        elif not sc.finished:
             logger.error("Error %s", speechstate)
\ No newline at end of file
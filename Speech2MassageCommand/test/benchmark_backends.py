@@ -0,0 +1,210 @@
+'''
+Replays a directory of labeled WAV recordings through the recognition backends without a
+microphone and writes latency, real-time factor, peak memory and command accuracy to JSON.
+
+Labels are read from labels.json in the directory ({"file.wav": "stop", "noise.wav": ""}),
+otherwise from the file name prefix ("stop_03.wav" expects stop, "noise_01.wav" no command).
+Each backend runs in its own process so its peak RSS is measured separately. Whisper backends
+are whisper-<model> (float32 PyTorch), whisper-<model>-int8 (dynamically quantized PyTorch)
+and whisper-<model>-ct2 (CTranslate2 int8), so the engines can be compared on the same corpus.
+
+    python test/benchmark_backends.py recordings/ --backends vosk whisper-tiny cloud-stub
+'''
+import argparse, json, multiprocessing, os, platform, random, resource, socket, subprocess, sys, time
+import logging
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from include.Commands import COMMAND_TABLE_EN_DE, match_command
+from include.AudioFrontend import load_wav, pcm16_to_float32, WHISPER_RATE
+
+DEFAULT_BACKENDS = ["vosk", "vosk-grammar", "whisper-tiny", "whisper-base", "whisper-tiny-int8", "whisper-base-int8",
+                    "cloud-stub"]
+# Suffix of the whisper-<model>-<engine> backends -> engine in include/WhisperEngine.py
+WHISPER_ENGINES = {"int8": "torch-int8", "ct2": "ctranslate2"}
+
+
+def load_corpus(directory):
+    '''
+    Returns a list of (file name, int16 samples at 16 kHz, expected command word or "").
+    '''
+    labels = {}
+    labels_path = os.path.join(directory, "labels.json")
+    if os.path.exists(labels_path):
+        with open(labels_path) as file:
+            labels = json.load(file)
+
+    corpus = []
+    for name in sorted(os.listdir(directory)):
+        if not name.lower().endswith(".wav"):
+            continue
+        if name in labels:
+            expected = labels[name] or ""
+        else:
+            prefix = name.split("_")[0].split("-")[0].lower()
+            expected = prefix if prefix in COMMAND_TABLE_EN_DE else ""
+        corpus.append((name, load_wav(os.path.join(directory, name)), expected))
+    return corpus
+
+
+class CloudStub:
+    '''
+    Stands in for the cloud recognizer: answers with the reference label after a simulated
+    network round trip, so the rest of the pipeline can be measured without network access.
+    '''
+    def __init__(self, latency, jitter, error_rate, seed=0) -> None:
+        self.__latency = latency
+        self.__jitter = jitter
+        self.__error_rate = error_rate
+        self.__random = random.Random(seed)
+        self.expected = ""
+
+    def __call__(self, audio) -> str:
+        time.sleep(max(0.0, self.__random.gauss(self.__latency, self.__jitter)))
+        if self.__random.random() < self.__error_rate:
+            raise ConnectionError("Simulated recognition request failure")
+        return self.expected
+
+
+def create_backend(name, logger, args):
+    '''
+    Returns (transcribe, load timings) where transcribe maps float32 16 kHz audio to text.
+    '''
+    if name.startswith("vosk"):
+        from vosk import KaldiRecognizer, SetLogLevel
+        from include.ModelLoader import load_vosk_model
+        from include.Commands import COMMAND_TABLE, build_grammar
+        SetLogLevel(-1)
+        model, timings = load_vosk_model(logger, args.vosk_model)
+
+        def transcribe(audio):
+            if name == "vosk-grammar":
+                rec = KaldiRecognizer(model, WHISPER_RATE, build_grammar(COMMAND_TABLE))
+            else:
+                rec = KaldiRecognizer(model, WHISPER_RATE)
+            rec.AcceptWaveform((audio * 32768).clip(-32768, 32767).astype(np.int16).tobytes())
+            return json.loads(rec.FinalResult())["text"]
+        return transcribe, timings
+
+    if name.startswith("whisper-"):
+        from include.WhisperEngine import load_whisper_engine
+        _, model_name, *engine = name.split("-")
+        model, timings = load_whisper_engine(logger, model_name, WHISPER_ENGINES[engine[0]] if engine else "torch")
+
+        def transcribe(audio):
+            return model.transcribe(audio, fp16=False)["text"]
+        return transcribe, timings
+
+    if name == "cloud-stub":
+        return CloudStub(args.stub_latency, args.stub_jitter, args.stub_error_rate), {}
+
+    raise ValueError(f"Unknown backend {name}")
+
+
+def run_backend(name, directory, args, results):
+    logging.basicConfig(format='%(asctime)s  [%(levelname)-7s]  %(message)s', level=logging.INFO)
+    logger = logging.getLogger("benchmark")
+    corpus = load_corpus(directory)
+    transcribe, timings = create_backend(name, logger, args)
+
+    latencies, audio_seconds, correct, errors, files = [], 0.0, 0, 0, []
+    for file_name, samples, expected in corpus:
+        audio = pcm16_to_float32(samples)
+        if isinstance(transcribe, CloudStub):
+            transcribe.expected = expected
+        for repeat in range(args.repeats):
+            start = time.perf_counter()
+            try:
+                text = transcribe(audio)
+            except Exception as err:
+                logger.warning("%s on %s failed: %s", name, file_name, err)
+                text = None
+            latencies.append(time.perf_counter() - start)
+            audio_seconds += len(audio) / WHISPER_RATE
+
+        if text is None:
+            errors += 1
+            recognized = None
+        else:
+            state = match_command(text, COMMAND_TABLE_EN_DE)
+            recognized = state.name if state else None
+            expected_state = COMMAND_TABLE_EN_DE.get(expected)
+            correct += int(state == expected_state)
+        files.append({"file": file_name, "expected": expected, "text": text, "command": recognized})
+        logger.info("[%s] %s: %r -> %s (expected %r)", name, file_name, text, recognized, expected)
+
+    results[name] = {
+        "files": len(corpus),
+        "audio_seconds": audio_seconds,
+        "real_time_factor": sum(latencies) / audio_seconds if audio_seconds else None,
+        "latency_p50": float(np.percentile(latencies, 50)) if latencies else None,
+        "latency_p95": float(np.percentile(latencies, 95)) if latencies else None,
+        "latency_p99": float(np.percentile(latencies, 99)) if latencies else None,
+        # ru_maxrss is in KiB on Linux and bytes on macOS
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024 if sys.platform != "darwin" else 1024 * 1024),
+        "accuracy": correct / len(corpus) if corpus else None,
+        "errors": errors,
+        "load_timings": timings,
+        "details": files,
+    }
+
+
+def environment():
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                         stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "commit": commit,
+        "host": socket.gethostname(),
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+        "cpu_count": os.cpu_count(),
+        "python": platform.python_version(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+    }
+
+
+def add_arguments(parser):
+    parser.add_argument("directory", help="directory with the labeled WAV recordings")
+    parser.add_argument("--backends", nargs="+", default=DEFAULT_BACKENDS)
+    parser.add_argument("--repeats", type=int, default=1)
+    parser.add_argument("--output", default=None, help="result file, defaults to bench_<commit>_<host>.json")
+    parser.add_argument("--vosk-model", default="vosk-model-small-en-us-0.15")
+    parser.add_argument("--stub-latency", type=float, default=0.4, help="cloud stub round trip in seconds")
+    parser.add_argument("--stub-jitter", type=float, default=0.1)
+    parser.add_argument("--stub-error-rate", type=float, default=0.0)
+
+
+def run(args, backends):
+    manager = multiprocessing.Manager()
+    results = manager.dict()
+    for name in backends:
+        process = multiprocessing.get_context("spawn").Process(target=run_backend, args=(name, args.directory, args, results))
+        process.start()
+        process.join()
+        if process.exitcode != 0:
+            results[name] = {"error": f"exit code {process.exitcode}"}
+
+    report = {"environment": environment(), "results": dict(results)}
+    output = args.output or f"bench_{(report['environment']['commit'] or 'nocommit')[:8]}_{report['environment']['host']}.json"
+    with open(output, "w") as file:
+        json.dump(report, file, indent=2)
+
+    print(f"{'backend':<16} {'RTF':>8} {'p50 s':>8} {'p95 s':>8} {'p99 s':>8} {'RSS MB':>8} {'accuracy':>9}")
+    for name, r in report["results"].items():
+        if "error" in r:
+            print(f"{name:<16} {r['error']}")
+            continue
+        print(f"{name:<16} {r['real_time_factor']:>8.3f} {r['latency_p50']:>8.3f} {r['latency_p95']:>8.3f} "
+              f"{r['latency_p99']:>8.3f} {r['peak_rss_mb']:>8.0f} {r['accuracy']:>9.2%}")
+    print(f"Results written to {output}")
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    add_arguments(parser)
+    args = parser.parse_args()
+    run(args, args.backends)
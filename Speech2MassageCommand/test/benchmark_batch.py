@@ -0,0 +1,42 @@
+'''
+Measures Whisper throughput in windows per second for several batch sizes on a directory of
+WAV recordings (see benchmark_backends.py), to check that batched decoding scales.
+
+    python test/benchmark_batch.py recordings/ --model tiny --batch-sizes 1 2 4 8
+'''
+import argparse, os, sys, time
+import logging
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from include.AudioFrontend import pcm16_to_float32
+from include.ModelLoader import load_whisper_model
+from include.WhisperBatcher import WhisperBatcher
+from benchmark_backends import load_corpus
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("directory", help="directory with the labeled WAV recordings")
+    parser.add_argument("--model", default="tiny")
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--repeats", type=int, default=2)
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s  [%(levelname)-7s]  %(message)s', level=logging.INFO)
+    logger = logging.getLogger("benchmark")
+    model, _ = load_whisper_model(logger, args.model)
+    windows = [pcm16_to_float32(samples) for _, samples, _ in load_corpus(args.directory)]
+
+    print(f"{'batch':>6} {'windows/s':>10} {'s/batch':>8} {'speed-up':>9}")
+    baseline = None
+    for batch_size in args.batch_sizes:
+        batcher = WhisperBatcher(logger, model, max_batch=batch_size)
+        batcher.transcribe_batch(windows[:batch_size])
+        start = time.perf_counter()
+        for _ in range(args.repeats):
+            for index in range(0, len(windows), batch_size):
+                batcher.transcribe_batch(windows[index:index + batch_size])
+        elapsed = time.perf_counter() - start
+        throughput = args.repeats * len(windows) / elapsed
+        baseline = baseline or throughput
+        print(f"{batch_size:>6} {throughput:>10.2f} {elapsed / (batcher.batches - 1):>8.3f} {throughput / baseline:>8.2f}x")
@@ -0,0 +1,97 @@
+'''
+Compares the open-vocabulary and the command-grammar Vosk recognizer on recorded WAV files.
+
+The expected command is taken from the file name prefix, e.g. "stop_03.wav" expects stop and
+"noise_01.wav" expects no command. Files must be 16 kHz mono 16-bit PCM.
+
+    python test/benchmark_vosk_grammar.py recordings/*.wav
+'''
+import argparse, json, logging, os, sys, time, wave
+from vosk import KaldiRecognizer, SetLogLevel
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from include.Commands import COMMAND_TABLE, match_command, build_grammar
+from include.ModelLoader import load_vosk_model
+
+CHUNK = 1024
+FRAME_RATE = 16000
+
+
+def expected_command(path):
+    prefix = os.path.basename(path).split("_")[0].split("-")[0].lower()
+    return COMMAND_TABLE.get(prefix)
+
+
+def decode(rec, frames):
+    '''
+    Feeds the audio chunk by chunk like the streaming controller and returns the full text.
+    '''
+    texts = []
+    for i in range(0, len(frames), CHUNK * 2):
+        if rec.AcceptWaveform(frames[i:i + CHUNK * 2]):
+            texts.append(json.loads(rec.Result())["text"])
+    texts.append(json.loads(rec.FinalResult())["text"])
+    return " ".join(texts)
+
+
+def run(name, model, grammar, recordings, repeats):
+    cpu_time, wall_time, audio_time = 0.0, 0.0, 0.0
+    correct, false_triggers = 0, 0
+    for path, frames, expected in recordings:
+        for _ in range(repeats):
+            if grammar:
+                rec = KaldiRecognizer(model, FRAME_RATE, build_grammar())
+            else:
+                rec = KaldiRecognizer(model, FRAME_RATE)
+            cpu_start, wall_start = time.process_time(), time.perf_counter()
+            text = decode(rec, frames)
+            cpu_time += time.process_time() - cpu_start
+            wall_time += time.perf_counter() - wall_start
+            audio_time += len(frames) / 2 / FRAME_RATE
+
+        state = match_command(text)
+        if state == expected:
+            correct += 1
+        elif expected is None:
+            false_triggers += 1
+        print(f"  [{name}] {os.path.basename(path)}: '{text}' -> {state.name if state else None}")
+
+    return {
+        "recognizer": name,
+        "cpu_per_audio_second": cpu_time / audio_time,
+        "real_time_factor": wall_time / audio_time,
+        "accuracy": correct / len(recordings),
+        "false_triggers": false_triggers,
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("wav", nargs="+")
+    parser.add_argument("--model", default="vosk-model-small-en-us-0.15",
+                        help="model directory in MCMS_MODEL_DIR or ~/.cache/vosk")
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s  [%(levelname)-7s]  %(message)s', level=logging.INFO)
+    SetLogLevel(-1)
+    # From the local model directory, never downloaded
+    model, _ = load_vosk_model(logging.getLogger("benchmark"), args.model)
+
+    recordings = []
+    for path in args.wav:
+        with wave.open(path, "rb") as wavFile:
+            if wavFile.getnchannels() != 1 or wavFile.getframerate() != FRAME_RATE or wavFile.getsampwidth() != 2:
+                print(f"Skipping {path}: not 16 kHz mono 16-bit")
+                continue
+            recordings.append((path, wavFile.readframes(wavFile.getnframes()), expected_command(path)))
+    if not recordings:
+        sys.exit("No usable recordings")
+
+    results = [run("open-vocabulary", model, False, recordings, args.repeats),
+               run("grammar", model, True, recordings, args.repeats)]
+
+    print(f"{'recognizer':<16} {'cpu/audio s':>12} {'RTF':>8} {'accuracy':>9} {'false triggers':>15}")
+    for r in results:
+        print(f"{r['recognizer']:<16} {r['cpu_per_audio_second']:>12.4f} {r['real_time_factor']:>8.4f} "
+              f"{r['accuracy']:>9.2%} {r['false_triggers']:>15d}")
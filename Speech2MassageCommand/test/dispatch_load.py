@@ -0,0 +1,180 @@
+'''
+Pushes SpeechState commands through the command processing thread of the _th entry scripts
+at a controlled rate and reports dispatch throughput and the latency from queueing a command
+to the end of its REST call, separately for stops.
+
+With --priority-stop stops go through the stop lane of the CommandQueue: they overtake queued
+commands and cancel a start in flight, and their latency is taken from the processor's
+stop_latencies, the stops that were sent to the server. The other commands are then
+coalesced, so only the stop latency is reported.
+
+By default a mock REST server (test/mock_rest_server.py) is started in-process, use --host
+and --port to target a running server instead.
+
+    python test/dispatch_load.py --rate 20 --count 500 --latency 0.05 --jitter 0.02
+    python test/dispatch_load.py --rate 20 --count 500 --latency 0.2 --priority-stop
+'''
+import argparse, collections, json, os, queue, random, sys, threading, time
+import logging
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from include.Commands import SpeechState
+from include.CommandProcessor import CommandProcessor
+from include.CommandQueue import CommandQueue
+from include.Metrics import METRICS
+from include.RestDispatcher import SEQUENCE_LONG, SEQUENCE_SHORT
+from include.SequenceControl import SequenceControl
+from mock_rest_server import MockRestServer, add_arguments as add_server_arguments
+
+ASSETS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "assets")
+SEQUENCES = {
+    SEQUENCE_LONG: os.path.join(ASSETS, "sample_long.json"),
+    SEQUENCE_SHORT: os.path.join(ASSETS, "sample_short.json"),
+}
+COMMANDS = [SpeechState.mode_long, SpeechState.mode_short, SpeechState.stop]
+
+
+class LoadController(SequenceControl):
+    '''
+    Stands in for a SpeechController on the dispatch side: the SequenceControl start/stop
+    methods the controllers use, without a model or microphone. Records the latency of every
+    command from the time it was queued, if queued holds (queue time, command) of every command.
+    '''
+    def __init__(self, logger, ip_addr, port) -> None:
+        SequenceControl.__init__(self, logger, SEQUENCES, "load")
+        self.connect(ip_addr, port)
+        self.queued = collections.deque()
+        self.latencies = collections.defaultdict(list)
+        self.failures = 0
+
+    @property
+    def cancelled(self) -> int:
+        return METRICS.counter("mcms_starts_cancelled_total").value
+
+    def get_current_state(self) -> SpeechState:
+        return SpeechState.idle
+
+    def close(self) -> None:
+        self.disconnect()
+
+    def start_mode_long(self, ip_addr, port) -> bool:
+        return self.__start(SequenceControl.start_mode_long, ip_addr, port)
+
+    def start_mode_short(self, ip_addr, port) -> bool:
+        return self.__start(SequenceControl.start_mode_short, ip_addr, port)
+
+    def stop_mode(self, ip_addr, port):
+        ok = SequenceControl.stop_mode(self, ip_addr, port)
+        if ok is False:
+            self.failures += 1
+        self.__record()
+        return ok
+
+    def __start(self, start, ip_addr, port) -> bool:
+        cancelled = self.cancelled
+        ok = start(self, ip_addr, port)
+        if not ok and self.cancelled == cancelled:
+            self.failures += 1
+        self.__record()
+        return ok
+
+    def __record(self) -> None:
+        if self.queued:
+            queued_at, command = self.queued.popleft()
+            self.latencies[command].append(time.perf_counter() - queued_at)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default=None, help="REST server to target instead of the in-process mock")
+    parser.add_argument("--port", type=int, default=50000)
+    parser.add_argument("--rate", type=float, default=10.0, help="commands queued per second, 0 for as fast as possible")
+    parser.add_argument("--count", type=int, default=200)
+    parser.add_argument("--priority-stop", action="store_true", help="dispatch stops through the stop lane")
+    parser.add_argument("--output", default=None, help="write the summary as JSON")
+    add_server_arguments(parser)
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s  [%(levelname)-7s]  %(message)s', level=logging.WARNING)
+    logger = logging.getLogger("dispatch_load")
+
+    server = None
+    host, port = args.host, args.port
+    if host is None:
+        server = MockRestServer(("127.0.0.1", 0), args.latency, args.jitter, args.error_rate, args.seed)
+        server.start_background()
+        host, port = server.server_address
+
+    controller = LoadController(logger, host, port)
+    if args.priority_stop:
+        command_queue = CommandQueue(stop_lane=True)
+        processor = CommandProcessor(logger, command_queue, controller, host, port)
+    else:
+        command_queue = queue.Queue()
+        # Every command is dispatched, coalescing would skip commands and skew the latencies
+        processor = CommandProcessor(logger, command_queue, controller, host, port, coalesce=False)
+    thread = threading.Thread(target=processor.run, name="process-command")
+    thread.start()
+
+    commands = random.Random(args.seed)
+    interval = 1.0 / args.rate if args.rate > 0 else 0.0
+    start = time.perf_counter()
+    for i in range(args.count):
+        time.sleep(max(0.0, start + i * interval - time.perf_counter()))
+        command = commands.choice(COMMANDS)
+        if not args.priority_stop:
+            controller.queued.append((time.perf_counter(), command))
+        command_queue.put(command)
+    command_queue.put(SpeechState.error)
+    thread.join()
+    elapsed = time.perf_counter() - start
+    controller.close()
+
+    summary = {
+        "commands": args.count,
+        "offered_rate": args.rate,
+        "throughput": args.count / elapsed,
+        "failures": controller.failures,
+        "cancelled_starts": controller.cancelled,
+    }
+    if args.priority_stop:
+        stops = np.array(processor.stop_latencies)
+        summary["stops_sent"] = len(stops)
+    else:
+        latencies = np.array([latency for values in controller.latencies.values() for latency in values])
+        stops = np.array(controller.latencies[SpeechState.stop])
+        summary.update({
+            "latency_mean": float(latencies.mean()),
+            "latency_p50": float(np.percentile(latencies, 50)),
+            "latency_p95": float(np.percentile(latencies, 95)),
+            "latency_p99": float(np.percentile(latencies, 99)),
+            "latency_max": float(latencies.max()),
+        })
+    # No stop may have been sent, e.g. when every stop found nothing started
+    summary.update({f"stop_latency_p{q}": float(np.percentile(stops, q)) if len(stops) else None for q in (50, 95, 99)})
+    if server is not None:
+        server.shutdown()
+        server.server_close()
+        summary["requests"] = len(server.timeline)
+        if args.timeline:
+            server.write_timeline(args.timeline)
+
+    print(f"{args.count} commands in {elapsed:.2f} s: {summary['throughput']:.1f} commands/s, {controller.failures} failed, "
+          f"{controller.cancelled} starts cancelled")
+    if not args.priority_stop:
+        print(f"latency mean {summary['latency_mean'] * 1000:.1f} ms, p50 {summary['latency_p50'] * 1000:.1f} ms, "
+              f"p95 {summary['latency_p95'] * 1000:.1f} ms, p99 {summary['latency_p99'] * 1000:.1f} ms, "
+              f"max {summary['latency_max'] * 1000:.1f} ms")
+    if len(stops):
+        print(f"stop latency p50 {summary['stop_latency_p50'] * 1000:.1f} ms, p95 {summary['stop_latency_p95'] * 1000:.1f} ms, "
+              f"p99 {summary['stop_latency_p99'] * 1000:.1f} ms")
+    else:
+        print("no stops sent")
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(summary, file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,206 @@
+'''
+Replays utterances through the HedgedRecognizer with a local stub in place of the cloud
+recognizer and writes the command accuracy, end-to-end latency and the per backend win
+rates and latencies to JSON.
+
+The cloud stub answers with the utterance's label after a simulated round trip. Outages
+(requests fail after --outage-delay) and slow periods (answers take --slow-latency) are
+given as ranges of utterance numbers, so the circuit breaker can be watched falling back
+to the local backend and recovering. The local backend is a stub as well, or Vosk on a
+directory of labeled WAV recordings (labeled as in test/benchmark_backends.py).
+
+    python test/hedge_replay.py --utterances 300 --outage 100:150 --slow 200:250
+    python test/hedge_replay.py --corpus recordings/ --local vosk
+
+--check runs the circuit breaker checks instead and exits with an error if one fails: the
+breaker opens after consecutive cloud failures, refuses requests until the retry time,
+closes after a successful trial request, and tries again after an abandoned trial.
+'''
+import argparse, json, logging, os, random, sys, time
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from include.Commands import COMMAND_TABLE, COMMAND_TABLE_EN_DE
+from include.HedgedRecognizer import HedgedRecognizer, CircuitBreaker, vosk_backend
+
+
+class Utterance:
+    '''
+    One replayed utterance with its expected command word, providing the get_raw_data() of
+    sr.AudioData to the Vosk backend.
+    '''
+    def __init__(self, name, expected, samples=None) -> None:
+        self.name = name
+        self.expected = expected
+        self.samples = samples
+
+    def get_raw_data(self, convert_rate=None, convert_width=None) -> bytes:
+        # load_wav already returns 16 kHz 16-bit mono
+        return self.samples.tobytes()
+
+
+class StubBackend:
+    '''
+    Answers with the utterance's label after latency (normal distribution, jitter standard
+    deviation). With error_rate the answer is empty, in the numbered utterances of outages
+    the request fails after outage_delay and in those of slow periods it takes slow_latency.
+    '''
+    def __init__(self, latency, jitter, error_rate, confidence, outages=(), slow=(), outage_delay=5.0,
+                 slow_latency=3.0, seed=0) -> None:
+        self.__latency = latency
+        self.__jitter = jitter
+        self.__error_rate = error_rate
+        self.__confidence = confidence
+        self.__outages = outages
+        self.__slow = slow
+        self.__outage_delay = outage_delay
+        self.__slow_latency = slow_latency
+        self.__random = random.Random(seed)
+        self.number = 0
+
+    def __call__(self, utterance):
+        number = self.number
+        if any(start <= number < end for start, end in self.__outages):
+            time.sleep(self.__outage_delay)
+            raise ConnectionError("Simulated network outage")
+        latency = self.__slow_latency if any(start <= number < end for start, end in self.__slow) else self.__latency
+        time.sleep(max(0.0, self.__random.gauss(latency, self.__jitter)))
+        if self.__random.random() < self.__error_rate:
+            return "", None
+        return utterance.expected, self.__confidence()
+
+
+def parse_ranges(ranges):
+    return [tuple(int(value) for value in text.split(":")) for text in ranges]
+
+
+def load_utterances(args):
+    if args.corpus:
+        from benchmark_backends import load_corpus
+        return [Utterance(name, expected, samples) for name, samples, expected in load_corpus(args.corpus)]
+    words = sorted(COMMAND_TABLE)
+    generator = random.Random(args.seed)
+    return [Utterance(f"synthetic-{number}", generator.choice(words)) for number in range(args.utterances)]
+
+
+def check_breaker(logger):
+    breaker = CircuitBreaker(failure_threshold=3, retry_seconds=0.2)
+    for _ in range(3):
+        assert breaker.allow(), "closed breaker refused a request"
+        breaker.record(False)
+    assert breaker.open and not breaker.allow(), "breaker not open after 3 failures"
+    time.sleep(0.25)
+    assert breaker.allow(), "no trial request after the retry time"
+    assert not breaker.allow(), "second request while the trial is in flight"
+    breaker.abandon()
+    assert breaker.allow(), "no new trial after an abandoned one"
+    breaker.record(False)
+    assert breaker.open and not breaker.allow(), "breaker not open again after a failed trial"
+    time.sleep(0.25)
+    assert breaker.allow()
+    breaker.record(True)
+    assert not breaker.open and breaker.allow(), "breaker not closed after a successful trial"
+
+    # The same through the HedgedRecognizer, the cloud stub fails for the first 3 utterances
+    cloud = StubBackend(0.01, 0.0, 0.0, lambda: 0.9, outages=[(0, 3)], outage_delay=0.01)
+    local = StubBackend(0.05, 0.0, 0.0, lambda: 0.9, seed=1)
+    hedged = HedgedRecognizer(logger, cloud, local, COMMAND_TABLE_EN_DE,
+                              breaker=CircuitBreaker(failure_threshold=3, retry_seconds=0.2))
+    utterance = Utterance("check", sorted(COMMAND_TABLE)[0])
+    for number in range(3):
+        cloud.number = number
+        hedged.recognize(utterance)
+    assert hedged.breaker.open, "hedged breaker not open after 3 cloud failures"
+    cloud.number = 3
+    _, backend, _ = hedged.recognize(utterance)
+    assert backend == "local", "cloud asked while the breaker is open"
+    time.sleep(0.25)
+    _, backend, _ = hedged.recognize(utterance)
+    assert backend == "cloud" and not hedged.breaker.open, "hedged breaker not closed after a successful trial"
+    hedged.close()
+    print("Circuit breaker checks passed")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--corpus", help="directory of labeled WAV recordings, otherwise synthetic utterances")
+    parser.add_argument("--utterances", type=int, default=200, help="number of synthetic utterances")
+    parser.add_argument("--local", choices=["stub", "vosk"], default="stub")
+    parser.add_argument("--vosk-model", default="vosk-model-small-en-us-0.15")
+    parser.add_argument("--cloud-latency", type=float, default=0.4)
+    parser.add_argument("--cloud-jitter", type=float, default=0.15)
+    parser.add_argument("--cloud-error-rate", type=float, default=0.02)
+    parser.add_argument("--local-latency", type=float, default=0.3)
+    parser.add_argument("--local-jitter", type=float, default=0.1)
+    parser.add_argument("--local-error-rate", type=float, default=0.05)
+    parser.add_argument("--outage", nargs="*", default=[], help="utterance ranges start:end the cloud is down")
+    parser.add_argument("--outage-delay", type=float, default=2.0, help="seconds until a request fails in an outage")
+    parser.add_argument("--slow", nargs="*", default=[], help="utterance ranges start:end the cloud is slow")
+    parser.add_argument("--slow-latency", type=float, default=2.0)
+    parser.add_argument("--retry", type=float, default=5.0, help="seconds until the open breaker tries the cloud again")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="hedge_replay.json")
+    parser.add_argument("--check", action="store_true", help="run the circuit breaker checks")
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s  [%(levelname)-7s]  %(message)s', level=logging.INFO)
+    logger = logging.getLogger("hedge")
+    if args.check:
+        check_breaker(logger)
+        return
+    utterances = load_utterances(args)
+    generator = random.Random(args.seed + 1)
+
+    cloud = StubBackend(args.cloud_latency, args.cloud_jitter, args.cloud_error_rate, lambda: 0.9,
+                        parse_ranges(args.outage), parse_ranges(args.slow), args.outage_delay, args.slow_latency,
+                        seed=args.seed)
+    if args.local == "vosk":
+        from include.ModelLoader import load_vosk_model
+        model, _ = load_vosk_model(logger, args.vosk_model)
+        local = vosk_backend(model)
+    else:
+        local = StubBackend(args.local_latency, args.local_jitter, args.local_error_rate,
+                            lambda: generator.uniform(0.5, 1.0), seed=args.seed + 2)
+    hedged = HedgedRecognizer(logger, cloud, local, COMMAND_TABLE_EN_DE,
+                              breaker=CircuitBreaker(retry_seconds=args.retry))
+
+    latencies, correct, details = [], 0, []
+    for number, utterance in enumerate(utterances):
+        cloud.number = number
+        if isinstance(local, StubBackend):
+            local.number = number
+        start = time.perf_counter()
+        try:
+            state, backend, text = hedged.recognize(utterance)
+        except Exception as err:
+            logger.warning("%s failed on all backends: %s", utterance.name, err)
+            state, backend, text = None, None, None
+        latencies.append(time.perf_counter() - start)
+        correct += int(state == COMMAND_TABLE_EN_DE.get(utterance.expected))
+        details.append({"utterance": utterance.name, "expected": utterance.expected,
+                        "command": state.name if state else None, "backend": backend,
+                        "latency": latencies[-1], "cloud_breaker_open": hedged.breaker.open})
+    hedged.close()
+
+    results = {
+        "utterances": len(utterances),
+        "accuracy": correct / len(utterances) if utterances else None,
+        "latency_p50": float(np.percentile(latencies, 50)) if latencies else None,
+        "latency_p95": float(np.percentile(latencies, 95)) if latencies else None,
+        "latency_p99": float(np.percentile(latencies, 99)) if latencies else None,
+        "backends": hedged.statistics(),
+        "details": details,
+    }
+    with open(args.output, "w") as file:
+        json.dump(results, file, indent=2)
+
+    print(f"{len(utterances)} utterances, accuracy {results['accuracy']:.1%}, "
+          f"latency p50 {results['latency_p50']:.3f} s p95 {results['latency_p95']:.3f} s")
+    for name, stats in results["backends"].items():
+        print(f"  {name:5}  requests {stats['requests']:4}  wins {stats['wins']:4}  win rate {stats['win_rate']:.1%}"
+              f"  failures {stats['failures']:3}  latency mean {stats['latency_mean'] or 0:.3f} s")
+    print(f"Results written to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+'''
+Local stand-in for the massage REST server, for end-to-end dispatch tests without a chair.
+
+Serves PUT /sequence/<n> (upload), PUT /sequence/<n>/start and PUT /sequence/<n>/stop with
+a configurable response latency, jitter and error rate, and records every request in a
+timeline that can be written as JSON lines.
+
+    python test/mock_rest_server.py --port 50000 --latency 0.05 --jitter 0.02 --error-rate 0.01
+'''
+import argparse, json, random, re, sys, threading, time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+SEQUENCE_PATH = re.compile(r"^/sequence/(\d+)(?:/(start|stop))?$")
+
+
+class MockRestServer(ThreadingHTTPServer):
+    '''
+    Threading HTTP server imitating the REST API. Started sequences are kept per sequence
+    number, uploads are required before a start like on the chair.
+    '''
+    daemon_threads = True
+
+    def __init__(self, address, latency=0.0, jitter=0.0, error_rate=0.0, seed=None) -> None:
+        super().__init__(address, MockRestHandler)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.sequences = {}
+        self.running = set()
+        self.timeline = []
+        self.lock = threading.Lock()
+        self.__random = random.Random(seed)
+        self.__start = time.monotonic()
+
+    def delay(self) -> float:
+        with self.lock:
+            return max(0.0, self.__random.gauss(self.latency, self.jitter))
+
+    def fail(self) -> bool:
+        with self.lock:
+            return self.__random.random() < self.error_rate
+
+    def record(self, method, path, status, received, latency) -> None:
+        with self.lock:
+            self.timeline.append({"t": received - self.__start, "method": method, "path": path,
+                                  "status": status, "latency": latency})
+
+    def start_background(self) -> threading.Thread:
+        thread = threading.Thread(target=self.serve_forever, name="mock-rest", daemon=True)
+        thread.start()
+        return thread
+
+    def write_timeline(self, path) -> None:
+        with self.lock, open(path, "w") as file:
+            for entry in self.timeline:
+                file.write(json.dumps(entry) + "\n")
+
+
+class MockRestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers and body go out in separate writes, do not let Nagle hold back the body
+    disable_nagle_algorithm = True
+
+    def do_PUT(self):
+        received = time.monotonic()
+        body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        delay = self.server.delay()
+        time.sleep(delay)
+
+        match = SEQUENCE_PATH.match(self.path)
+        if self.server.fail():
+            status, reply = 500, "injected error"
+        elif not match:
+            status, reply = 404, "unknown path"
+        else:
+            status, reply = self.__handle(int(match.group(1)), match.group(2), body)
+
+        self.server.record("PUT", self.path, status, received, time.monotonic() - received)
+        payload = json.dumps({"status": reply}).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def __handle(self, sequence, action, body):
+        with self.server.lock:
+            if action is None:
+                try:
+                    self.server.sequences[sequence] = json.loads(body)
+                except ValueError:
+                    return 400, "invalid json"
+                return 200, "uploaded"
+            if sequence not in self.server.sequences:
+                return 404, "sequence not uploaded"
+            if action == "start":
+                self.server.running = {sequence}
+                return 200, "started"
+            self.server.running.discard(sequence)
+            return 200, "stopped"
+
+    def log_message(self, format, *args):
+        pass
+
+
+def add_arguments(parser):
+    parser.add_argument("--latency", type=float, default=0.02, help="mean response latency in seconds")
+    parser.add_argument("--jitter", type=float, default=0.01, help="standard deviation of the latency")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests answered with 500")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--timeline", default=None, help="write the request timeline as JSON lines")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=50000)
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    server = MockRestServer((args.host, args.port), args.latency, args.jitter, args.error_rate, args.seed)
+    print(f"Mock REST server listening on {args.host}:{args.port}", file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if args.timeline:
+            server.write_timeline(args.timeline)
+            print(f"{len(server.timeline)} requests written to {args.timeline}", file=sys.stderr)